@@ -1,5 +1,6 @@
 import os
 import json
+import re
 import logging
 import sys
 import csv
@@ -11,11 +12,21 @@ from io import StringIO, BytesIO
 import asyncio
 import traceback
 import time
-import requests
-import socket
+import functools
+import hashlib
+import multiprocessing
+import httpx
+import select
+import threading
+import zipfile
+import uuid
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Bot
-from telegram.error import Conflict
+from telegram.error import BadRequest, Conflict
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -25,25 +36,23 @@ from telegram.ext import (
     ContextTypes
 )
 
-# Налаштування логування
-logging.basicConfig(
-    format='%(asctime)s - ADMIN - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    level=logging.DEBUG,
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('admin_bot_debug.log', encoding='utf-8')
-    ]
-)
+def setup_logging():
+    """Налаштування логування; викликається з main(), бо воркери пулу зображень теж імпортують модуль"""
+    logging.basicConfig(
+        format='%(asctime)s - ADMIN - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
+        level=logging.DEBUG,
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler('admin_bot_debug.log', encoding='utf-8')
+        ]
+    )
+
 logger = logging.getLogger(__name__)
 
 # Додаткове логування для відладки
 debug_logger = logging.getLogger('debug')
 debug_logger.setLevel(logging.DEBUG)
 
-logger.info("=" * 80)
-logger.info("ЗАПУСК АДМІН-БОТА З РОЗШИРЕНОЮ ВІДЛАДКОЮ")
-logger.info("=" * 80)
-
 KYIV_TZ = None
 try:
     import pytz
@@ -53,6 +62,38 @@ except ImportError:
     logger.warning("⚠️ Бібліотека pytz не встановлена, використовую UTC")
     KYIV_TZ = None
 
+# Важкі необов'язкові бібліотеки імпортуються при першому використанні, а не під час запуску
+pa = None
+pq = None
+
+@functools.lru_cache(maxsize=None)
+def load_pyarrow() -> bool:
+    """Імпортує pyarrow при першому експорті Parquet"""
+    global pa, pq
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        logger.info("✅ Бібліотека pyarrow завантажена, доступний експорт Parquet")
+        return True
+    except ImportError:
+        logger.warning("⚠️ Бібліотека pyarrow не встановлена, експорт Parquet недоступний")
+        return False
+
+Image = None
+ImageOps = None
+
+@functools.lru_cache(maxsize=None)
+def load_pillow() -> bool:
+    """Імпортує Pillow при першій обробці фото"""
+    global Image, ImageOps
+    try:
+        from PIL import Image, ImageOps
+        logger.info("✅ Бібліотека Pillow завантажена, фото товарів нормалізуються")
+        return True
+    except ImportError:
+        logger.warning("⚠️ Бібліотека Pillow не встановлена, фото зберігаються без обробки")
+        return False
+
 def get_kyiv_time():
     if KYIV_TZ:
         return datetime.now(KYIV_TZ)
@@ -77,74 +118,45 @@ def format_kyiv_time(dt_str):
         logger.error(f"Помилка форматування часу: {e}")
         return str(dt_str)[:16]
 
-# Діагностика
-logger.info("📂 Поточна папка: %s", os.getcwd())
-logger.info("📄 Файли в папці: %s", os.listdir('.'))
+KYIV_TZ_NAME = 'Europe/Kyiv'
 
-# Перевіряємо наявність requirements.txt
-if os.path.exists('requirements.txt'):
-    logger.info("✅ requirements.txt знайдено")
-    with open('requirements.txt', 'r') as f:
-        content = f.read()
-        logger.info("📄 Вміст requirements.txt:\n%s", content)
-else:
-    logger.error("❌ requirements.txt НЕ знайдено!")
+def kyiv_time_sql(column: str = "created_at") -> str:
+    """SQL-вираз, що переводить UTC-час колонки в київський (результат - datetime без tzinfo)"""
+    alias = column.split(".")[-1]
+    return f"({column} AT TIME ZONE 'UTC' AT TIME ZONE '{KYIV_TZ_NAME}') AS {alias}"
 
-# Перевіряємо чи requests встановлено
-try:
-    import requests
-    logger.info("✅ requests вже встановлено, версія: %s", requests.__version__)
-except ImportError:
-    logger.error("❌ requests не встановлено")
-    
-    import subprocess
-    logger.info("📦 Встановлюю requests...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "requests"])
-    logger.info("✅ requests встановлено")
-    import requests
+KYIV_CREATED_AT = kyiv_time_sql()
 
-def check_single_instance():
-    """Перевіряє чи не запущено інший екземпляр бота"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)
-        result = sock.connect_ex(('127.0.0.1', 9999))
-        sock.close()
-        if result == 0:
-            logger.error("⚠️ Другий екземпляр бота вже запущено!")
-            return False
-        return True
-    except Exception as e:
-        logger.error(f"⚠️ Помилка перевірки екземпляра: {e}")
-        return True
+def get_kyiv_now() -> datetime:
+    """Поточний київський час без tzinfo - у тому ж вигляді, що й дати з запитів"""
+    return get_kyiv_time().replace(tzinfo=None)
+
+def format_datetime(dt, fmt: str = '%Y-%m-%d %H:%M') -> str:
+    """Форматує дату тільки під час відображення"""
+    if not dt:
+        return "Н/Д"
+    if isinstance(dt, datetime):
+        return dt.strftime(fmt)
+    return str(dt)[:16]
 
 # Отримуємо токени з оточення
 TOKEN = os.getenv("ADMIN_BOT_TOKEN")
 if not TOKEN:
     logger.error("❌ ADMIN_BOT_TOKEN не знайдено!")
     sys.exit(1)
-else:
-    logger.info(f"✅ ADMIN_BOT_TOKEN отримано: {TOKEN[:10]}...")
 
 MAIN_BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not MAIN_BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не знайдено!")
     sys.exit(1)
-else:
-    logger.info(f"✅ MAIN_BOT_TOKEN отримано: {MAIN_BOT_TOKEN[:10]}...")
 
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")
-logger.info(f"✅ ADMIN_PASSWORD конфігуровано: {'так' if ADMIN_PASSWORD else 'ні'}")
-
 ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
-logger.info(f"✅ ADMIN_IDS: {ADMIN_IDS}")
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     logger.error("❌ DATABASE_URL не знайдено!")
     sys.exit(1)
-else:
-    logger.info(f"✅ DATABASE_URL отримано: {DATABASE_URL[:20]}...")
 
 def get_db_connection():
     """Підключення до бази даних з детальним логуванням помилок"""
@@ -158,178 +170,380 @@ def get_db_connection():
         logger.error(traceback.format_exc())
         return None
 
-def init_database_if_empty():
-    """Ініціалізація бази даних з детальним логуванням"""
-    logger.info("=" * 60)
-    logger.info("🔄 Ініціалізація бази даних...")
-    logger.info("=" * 60)
+# Джерела daily_metrics: таблиця, вид запису та події, що змінюють підсумки
+DAILY_METRICS_SOURCES = (
+    ("orders", "order", "INSERT OR DELETE OR UPDATE OF status, total, created_at"),
+    ("quick_orders", "quick_order", "INSERT OR DELETE OR UPDATE OF status, created_at"),
+    ("messages", "message", "INSERT OR DELETE OR UPDATE OF created_at"),
+)
+
+def backfill_daily_metrics(cursor):
+    """Перераховує daily_metrics з таблиць замовлень і повідомлень"""
+    cursor.execute('DELETE FROM daily_metrics')
+    cursor.execute('''
+        INSERT INTO daily_metrics (day, kind, status, count, revenue)
+        SELECT (created_at AT TIME ZONE 'UTC' AT TIME ZONE %s)::date, kind, status, COUNT(*), COALESCE(SUM(total), 0)
+        FROM (
+            SELECT 'order' AS kind, COALESCE(status, '') AS status, total, created_at FROM orders
+            UNION ALL
+            SELECT 'quick_order', COALESCE(status, ''), 0, created_at FROM quick_orders
+            UNION ALL
+            SELECT 'message', '', 0, created_at FROM messages
+        ) source
+        WHERE created_at IS NOT NULL
+        GROUP BY 1, 2, 3
+    ''', (KYIV_TZ_NAME,))
+    logger.info(f"✅ daily_metrics перераховано: {cursor.rowcount} рядків")
+
+def reset_invalid_temp_data(cursor):
+    """Скидає в '{}' значення temp_data, що не є JSON-об'єктом (перед переведенням у JSONB)"""
+    cursor.execute("SELECT user_id, temp_data FROM user_sessions WHERE NULLIF(temp_data, '') IS NOT NULL")
+    invalid = []
+    for row in cursor.fetchall():
+        try:
+            value = json.loads(row['temp_data'])
+        except ValueError:
+            value = None
+        if not isinstance(value, dict):
+            invalid.append(row['user_id'])
+    if invalid:
+        cursor.execute("UPDATE user_sessions SET temp_data = '{}' WHERE user_id = ANY(%s)", (invalid,))
+        logger.info(f"🧹 Скинуто некоректних temp_data: {len(invalid)}")
+
+# ========== МІГРАЦІЇ СХЕМИ ==========
+
+# Схема змінюється лише нумерованими міграціями з MIGRATIONS: застосовані версії
+# записуються в schema_migrations, нова зміна схеми - це нова міграція в кінці списку
+SCHEMA_COMPONENT = "admin"
+SCHEMA_MIGRATIONS_LOCK_ID = 7310000
+
+def migration_001_baseline(cursor):
+    """Базова схема: таблиці, індекси, тригери та початковий контент"""
+    # Створення таблиць
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     
-    conn = get_db_connection()
-    if not conn:
-        logger.error("❌ Не вдалося підключитись до БД для ініціалізації")
-        return False
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id BIGINT PRIMARY KEY,
+            state TEXT DEFAULT '',
+            temp_data JSONB DEFAULT '{}'::jsonb,
+            last_section TEXT DEFAULT 'main_menu',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     
-    try:
-        cursor = conn.cursor()
-        
-        # Створення таблиць
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id BIGINT PRIMARY KEY,
-                state TEXT DEFAULT '',
-                temp_data TEXT DEFAULT '{}',
-                last_section TEXT DEFAULT 'main_menu',
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS carts (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                product_id INTEGER,
-                quantity REAL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                order_id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                user_name TEXT,
-                username TEXT,
-                phone TEXT,
-                city TEXT,
-                np_department TEXT,
-                total REAL,
-                status TEXT DEFAULT 'нове',
-                order_type TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS order_items (
-                id SERIAL PRIMARY KEY,
-                order_id INTEGER,
-                product_name TEXT,
-                quantity REAL,
-                price_per_unit REAL
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                user_name TEXT,
-                username TEXT,
-                text TEXT,
-                message_type TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS quick_orders (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                user_name TEXT,
-                username TEXT,
-                phone TEXT,
-                product_id INTEGER,
-                product_name TEXT,
-                quantity REAL,
-                contact_method TEXT,
-                message TEXT,
-                status TEXT DEFAULT 'нове',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                price REAL NOT NULL,
-                category TEXT,
-                description TEXT,
-                unit TEXT DEFAULT 'банка',
-                image TEXT,
-                image_data BYTEA,
-                details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
+    # temp_data зберігається як JSONB (раніше TEXT)
+    cursor.execute('''
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'user_sessions' AND column_name = 'temp_data'
+    ''')
+    row = cursor.fetchone()
+    if row and row['data_type'] == 'text':
+        # Сесії тимчасові - непарсабельні значення просто скидаємо
+        reset_invalid_temp_data(cursor)
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                added_by INTEGER,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            ALTER TABLE user_sessions
+                ALTER COLUMN temp_data DROP DEFAULT,
+                ALTER COLUMN temp_data TYPE JSONB USING COALESCE(NULLIF(temp_data, ''), '{}')::jsonb,
+                ALTER COLUMN temp_data SET DEFAULT '{}'::jsonb
         ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS company_info (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                text TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_by BIGINT
-            )
+        logger.info("✅ user_sessions.temp_data переведено в JSONB")
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS carts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            product_id INTEGER,
+            quantity REAL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            user_name TEXT,
+            username TEXT,
+            phone TEXT,
+            city TEXT,
+            np_department TEXT,
+            total REAL,
+            status TEXT DEFAULT 'нове',
+            order_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            id SERIAL PRIMARY KEY,
+            order_id INTEGER,
+            product_name TEXT,
+            quantity REAL,
+            price_per_unit REAL
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            user_name TEXT,
+            username TEXT,
+            text TEXT,
+            message_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS quick_orders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            user_name TEXT,
+            username TEXT,
+            phone TEXT,
+            product_id INTEGER,
+            product_name TEXT,
+            quantity REAL,
+            contact_method TEXT,
+            message TEXT,
+            status TEXT DEFAULT 'нове',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            category TEXT,
+            description TEXT,
+            unit TEXT DEFAULT 'банка',
+            image TEXT,
+            image_data BYTEA,
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            added_by INTEGER,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS company_info (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            text TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_by BIGINT
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS welcome_message (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            text TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_by BIGINT
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS faq (
+            id SERIAL PRIMARY KEY,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            position INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Додаємо колонки якщо їх немає
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image TEXT')
+    logger.info("✅ Колонка image додана до таблиці products")
+    
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image_data BYTEA')
+    logger.info("✅ Колонка image_data додана до таблиці products")
+    
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS telegram_file_id TEXT')
+    logger.info("✅ Колонка telegram_file_id додана до таблиці products")
+    
+    # Нормалізовані зображення товарів, дедупліковані за хешем вмісту
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_images (
+            hash TEXT PRIMARY KEY,
+            data BYTEA NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image_hash TEXT')
+    logger.info("✅ Таблиця product_images та колонка image_hash готові")
+    
+    # Версії контенту: тригери збільшують лічильник і надсилають NOTIFY content_changed
+    # при зміні каталогу, FAQ чи текстів, а боти оновлюють кеші лише коли версія змінилась
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS content_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION bump_content_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO content_versions (name, version) VALUES (TG_ARGV[0], 1)
+            ON CONFLICT (name) DO UPDATE
+            SET version = content_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+            PERFORM pg_notify('content_changed', TG_ARGV[0]);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    content_triggers = (
+        ("products", "catalog", "INSERT OR DELETE OR TRUNCATE OR UPDATE OF name, price, category, description, unit, image, details"),
+        ("faq", "faq", "INSERT OR DELETE OR TRUNCATE OR UPDATE"),
+        ("company_info", "company", "INSERT OR DELETE OR TRUNCATE OR UPDATE"),
+        ("welcome_message", "welcome", "INSERT OR DELETE OR TRUNCATE OR UPDATE"),
+    )
+    for table, name, events in content_triggers:
+        cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_content_version ON {table}')
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_content_version
+            AFTER {events} ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_content_version('{name}')
         ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS welcome_message (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                text TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_by BIGINT
-            )
+    logger.info("✅ Версіонування контенту налаштовано")
+    
+    # Нормалізований телефон (E.164) з індексами для точного, префіксного та суфіксного пошуку
+    for table in ("orders", "quick_orders"):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS phone_normalized TEXT')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_phone_normalized ON {table} (phone_normalized text_pattern_ops)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_phone_normalized_rev ON {table} (reverse(phone_normalized) text_pattern_ops)')
+        logger.info(f"✅ Колонка phone_normalized додана до таблиці {table}")
+    
+    # Повнотекстовий пошук по повідомленнях та коментарях швидких замовлень
+    cursor.execute("SELECT 1 FROM pg_ts_config WHERE cfgname = 'ukrainian'")
+    fts_config = 'ukrainian' if cursor.fetchone() else 'simple'
+    for table, column in (("messages", "text"), ("quick_orders", "message")):
+        cursor.execute(f'''
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('{fts_config}'::regconfig, COALESCE({column}, ''))) STORED
         ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS faq (
-                id SERIAL PRIMARY KEY,
-                question TEXT NOT NULL,
-                answer TEXT NOT NULL,
-                position INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_search_tsv ON {table} USING GIN (search_tsv)')
+    logger.info(f"✅ Повнотекстовий пошук налаштовано (конфігурація {fts_config})")
+    
+    # Щоденна зведена статистика: тригери оновлюють daily_metrics при кожній зміні замовлень
+    # і повідомлень, а статистика читає кілька рядків замість повного перегляду таблиць.
+    # Кожна зміна також надсилається в NOTIFY activity для живого дашборду адмін-бота
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_metrics (
+            day DATE NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT '',
+            count INTEGER NOT NULL DEFAULT 0,
+            revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, kind, status)
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE OR REPLACE FUNCTION track_daily_metrics() RETURNS trigger AS $$
+        DECLARE
+            rec JSONB;
+            delta INTEGER;
+            metric_day DATE;
+        BEGIN
+            FOR rec, delta IN
+                SELECT to_jsonb(OLD), -1 WHERE TG_OP IN ('UPDATE', 'DELETE')
+                UNION ALL
+                SELECT to_jsonb(NEW), 1 WHERE TG_OP IN ('INSERT', 'UPDATE')
+            LOOP
+                CONTINUE WHEN rec->>'created_at' IS NULL;
+                metric_day := ((rec->>'created_at')::timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{KYIV_TZ_NAME}')::date;
+                INSERT INTO daily_metrics AS m (day, kind, status, count, revenue)
+                VALUES (
+                    metric_day, TG_ARGV[0], COALESCE(rec->>'status', ''), delta,
+                    delta * COALESCE((rec->>'total')::float8, 0)
+                )
+                ON CONFLICT (day, kind, status) DO UPDATE
+                SET count = m.count + EXCLUDED.count, revenue = m.revenue + EXCLUDED.revenue;
+                -- id у payload, щоб однакові сповіщення в одній транзакції не злились
+                PERFORM pg_notify('activity', json_build_object(
+                    'kind', TG_ARGV[0], 'id', COALESCE(rec->>'order_id', rec->>'id'),
+                    'status', COALESCE(rec->>'status', ''), 'day', metric_day, 'delta', delta,
+                    'revenue', delta * COALESCE((rec->>'total')::float8, 0)
+                )::text);
+            END LOOP;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION notify_user_activity() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('activity', json_build_object(
+                'kind', 'user', 'id', COALESCE(NEW.user_id, OLD.user_id),
+                'delta', CASE WHEN TG_OP = 'DELETE' THEN -1 ELSE 1 END
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_users_activity ON users')
+    cursor.execute('''
+        CREATE TRIGGER trg_users_activity
+        AFTER INSERT OR DELETE ON users
+        FOR EACH ROW EXECUTE FUNCTION notify_user_activity()
+    ''')
+    for table, kind, events in DAILY_METRICS_SOURCES:
+        cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_daily_metrics ON {table}')
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_daily_metrics
+            AFTER {events} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION track_daily_metrics('{kind}')
         ''')
-        
-        # Додаємо колонки якщо їх немає
-        try:
-            cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image TEXT')
-            logger.info("✅ Колонка image додана до таблиці products")
-        except Exception as e:
-            logger.error(f"❌ Помилка додавання колонки image: {e}")
-        
-        try:
-            cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image_data BYTEA')
-            logger.info("✅ Колонка image_data додана до таблиці products")
-        except Exception as e:
-            logger.error(f"❌ Помилка додавання колонки image_data: {e}")
-        
-        # Додаємо початкові дані для company_info
-        cursor.execute("SELECT COUNT(*) FROM company_info")
-        company_count = cursor.fetchone()['count']
-        
-        if company_count == 0:
-            company_text = """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM daily_metrics) AS filled")
+    if not cursor.fetchone()['filled']:
+        backfill_daily_metrics(cursor)
+    logger.info("✅ Щоденна статистика daily_metrics налаштована")
+    
+    # Сесії адмінів: переживають перезапуск і спільні для всіх реплік бота
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_state (
+            namespace TEXT NOT NULL,
+            key BIGINT NOT NULL,
+            value JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (namespace, key)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_state_expires_at ON admin_state(expires_at)')
+    
+    # Додаємо початкові дані для company_info
+    cursor.execute("SELECT COUNT(*) FROM company_info")
+    company_count = cursor.fetchone()['count']
+    
+    if company_count == 0:
+        company_text = """
 <b>🌱 Компанія Бонелет</b>
 
 Ми спеціалізуємося на вирощуванні овочів та фруктів на полях Одещини.
@@ -352,17 +566,17 @@ def init_database_if_empty():
 • Самовивіз з Одеської області, с. Великий Дальник
 • Терміни доставки: 1-4 дні в залежності від регіону
 """
-            cursor.execute('''
-                INSERT INTO company_info (id, text) VALUES (1, %s)
-            ''', (company_text,))
-            logger.info("✅ Додано початкові дані company_info")
-        
-        # Додаємо початкові дані для welcome_message
-        cursor.execute("SELECT COUNT(*) FROM welcome_message")
-        welcome_count = cursor.fetchone()['count']
-        
-        if welcome_count == 0:
-            welcome_text = """
+        cursor.execute('''
+            INSERT INTO company_info (id, text) VALUES (1, %s)
+        ''', (company_text,))
+        logger.info("✅ Додано початкові дані company_info")
+    
+    # Додаємо початкові дані для welcome_message
+    cursor.execute("SELECT COUNT(*) FROM welcome_message")
+    welcome_count = cursor.fetchone()['count']
+    
+    if welcome_count == 0:
+        welcome_text = """
 <b>🇺🇦 Вітаємо у боті компанії Бонелет! 🌱</b>
 
 Ми спеціалізуємося на вирощуванні овочів та фруктів на полях Одещини:
@@ -377,32 +591,70 @@ def init_database_if_empty():
 • Доставка Новою Поштою по всій Україні
 
 <b>Оберіть опцію з меню 👇</b>
-    """
+"""
+        cursor.execute('''
+            INSERT INTO welcome_message (id, text) VALUES (1, %s)
+        ''', (welcome_text,))
+        logger.info("✅ Додано початкові дані welcome_message")
+    
+    # Додаємо початкові FAQ
+    cursor.execute("SELECT COUNT(*) FROM faq")
+    faq_count = cursor.fetchone()['count']
+    
+    if faq_count == 0:
+        faqs = [
+            ("Які способи оплати ви приймаєте?", "✅ Готівка при отриманні\n✅ Переказ на карту ПриватБанку\n✅ Оплата через LiqPay", 0),
+            ("Які терміни доставки?", "🚚 Київ - 1-2 дні\n🚚 Україна - 2-4 дні\n🚛 Великі партії - 3-5 днів", 1)
+        ]
+        for question, answer, position in faqs:
             cursor.execute('''
-                INSERT INTO welcome_message (id, text) VALUES (1, %s)
-            ''', (welcome_text,))
-            logger.info("✅ Додано початкові дані welcome_message")
-        
-        # Додаємо початкові FAQ
-        cursor.execute("SELECT COUNT(*) FROM faq")
-        faq_count = cursor.fetchone()['count']
-        
-        if faq_count == 0:
-            faqs = [
-                ("Які способи оплати ви приймаєте?", "✅ Готівка при отриманні\n✅ Переказ на карту ПриватБанку\n✅ Оплата через LiqPay", 0),
-                ("Які терміни доставки?", "🚚 Київ - 1-2 дні\n🚚 Україна - 2-4 дні\n🚛 Великі партії - 3-5 днів", 1)
-            ]
-            for question, answer, position in faqs:
-                cursor.execute('''
-                    INSERT INTO faq (question, answer, position) VALUES (%s, %s, %s)
-                ''', (question, answer, position))
-            logger.info("✅ Додано початкові FAQ")
+                INSERT INTO faq (question, answer, position) VALUES (%s, %s, %s)
+            ''', (question, answer, position))
+        logger.info("✅ Додано початкові FAQ")
+
+
+MIGRATIONS = (
+    (1, "baseline", migration_001_baseline),
+)
+
+def run_migrations() -> bool:
+    """Застосовує нові міграції схеми; звичайний старт робить лише один SELECT"""
+    conn = get_db_connection()
+    if not conn:
+        return False
+    
+    try:
+        cursor = conn.cursor()
+        # Обидва боти та всі репліки застосовують міграції по черзі
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                component TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (component, version)
+            )
+        ''')
+        cursor.execute("SELECT version FROM schema_migrations WHERE component = %s", (SCHEMA_COMPONENT,))
+        applied = {row['version'] for row in cursor.fetchall()}
+        
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            started = time.perf_counter()
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (component, version, name) VALUES (%s, %s, %s)",
+                (SCHEMA_COMPONENT, version, name)
+            )
+            logger.info(f"✅ Міграція {version:03d}_{name} застосована за {time.perf_counter() - started:.2f} с")
         
         conn.commit()
-        logger.info("✅ База даних успішно ініціалізована!")
         return True
     except Exception as e:
-        logger.error(f"❌ Помилка ініціалізації бази даних: {e}")
+        conn.rollback()
+        logger.error(f"❌ Помилка міграції схеми: {e}")
         logger.error(traceback.format_exc())
         return False
     finally:
@@ -687,13 +939,500 @@ def move_faq_down(faq_id: int) -> bool:
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 REPORTS_DIR = os.path.join(BASE_DIR, "reports")
-os.makedirs(REPORTS_DIR, exist_ok=True)
-logger.info(f"✅ Директорія для звітів: {REPORTS_DIR}")
 
-admin_sessions = {}
-last_password_check = {}
-orders_offset = {}
-messages_offset = {}
+# ========== ВИБІР ЛІДЕРА ==========
+
+# Polling і фонові задачі виконує лише репліка, що тримає advisory-блокування в Postgres.
+# Решта ініціалізують БД і кеші та чекають у резерві. Блокування звільняється разом
+# зі з'єднанням, тож при падінні лідера резервна репліка підхоплює роботу за LEADER_RETRY_INTERVAL
+LEADER_LOCK_ID = int(os.getenv("LEADER_LOCK_ID", "7310002"))
+LEADER_RETRY_INTERVAL = int(os.getenv("LEADER_RETRY_INTERVAL", "5"))
+
+class LeaderElector:
+    """Лідерство через pg_try_advisory_lock на окремому з'єднанні"""
+    
+    def __init__(self, lock_id: int, retry_interval: int = LEADER_RETRY_INTERVAL):
+        self.lock_id = lock_id
+        self.retry_interval = retry_interval
+        self.conn = None
+        self.is_leader = False
+        self.lost = False
+    
+    def _close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+        self.is_leader = False
+    
+    def try_acquire(self) -> bool:
+        """Одна спроба захопити блокування"""
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(DATABASE_URL, keepalives=1, keepalives_idle=10, keepalives_interval=5, keepalives_count=3)
+                self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                # Блокування тримає серверний процес: без цих налаштувань Postgres помітить зниклого
+                # лідера лише через системний TCP keepalive (близько двох годин)
+                self.conn.cursor().execute("SET tcp_keepalives_idle = 10; SET tcp_keepalives_interval = 5; SET tcp_keepalives_count = 3")
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_id,))
+            self.is_leader = cursor.fetchone()[0]
+        except Exception as e:
+            logger.warning(f"⚠️ Помилка захоплення лідерства: {e}")
+            self._close()
+        return self.is_leader
+    
+    def wait_for_leadership(self):
+        """Блокує, поки цей екземпляр не стане лідером"""
+        self.lost = False
+        waiting = False
+        while not self.try_acquire():
+            if not waiting:
+                logger.info("⏳ Лідер уже працює, екземпляр чекає в резерві")
+                waiting = True
+            time.sleep(self.retry_interval)
+        logger.info("👑 Екземпляр став лідером")
+    
+    def check(self) -> bool:
+        """Перевіряє, що блокування досі наше; після обриву з'єднання пробує захопити знову"""
+        if self.is_leader and self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.cursor().execute("SELECT 1")
+                return True
+            except Exception as e:
+                logger.warning(f"⚠️ З'єднання лідера обірвалось: {e}")
+                self._close()
+        self.lost = not self.try_acquire()
+        return not self.lost
+    
+    def release(self):
+        if self.is_leader and self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (self.lock_id,))
+                logger.info("👋 Лідерство звільнено")
+            except Exception as e:
+                logger.warning(f"⚠️ Помилка звільнення лідерства: {e}")
+        self._close()
+
+leader = LeaderElector(LEADER_LOCK_ID)
+leader_task: Optional[asyncio.Task] = None
+
+async def leader_watchdog(application: Application):
+    """Зупиняє polling, якщо лідерство перейшло до іншої репліки"""
+    while True:
+        await asyncio.sleep(leader.retry_interval)
+        if not await asyncio.to_thread(leader.check):
+            logger.error("❌ Лідерство втрачено - зупиняємо polling")
+            application.stop_running()
+            return
+
+# ========== СХОВИЩЕ СЕСІЙ ==========
+
+SESSION_CHANNEL = "admin_state"
+ADMIN_SESSION_TTL = int(os.getenv("ADMIN_SESSION_TTL", str(24 * 3600)))
+SESSION_CACHE_MAX_ENTRIES = 1024
+# Скільки пам'ятаємо, що сесії в БД немає (інші репліки скидають це сповіщенням)
+SESSION_NEGATIVE_TTL = 300
+# Ідентифікатор процесу, щоб не скидати власний кеш своїми ж сповіщеннями
+REPLICA_ID = uuid.uuid4().hex[:12]
+
+_MISSING = object()
+session_stores = {}
+
+class SessionConnection:
+    """Одне повторно використовуване з'єднання сховища сесій з перепідключенням при обриві"""
+    
+    def __init__(self):
+        self.conn = None
+        self.lock = threading.Lock()
+    
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+    
+    def execute(self, query: str, params: tuple):
+        """Виконує запит в autocommit і повертає перший рядок (або None)"""
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.conn is None or self.conn.closed:
+                        self.conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+                        self.conn.autocommit = True
+                    cursor = self.conn.cursor()
+                    cursor.execute(query, params)
+                    return cursor.fetchone() if cursor.description else None
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    # З'єднання могло застаріти - одна повторна спроба з новим
+                    self.close()
+                    if attempt:
+                        raise
+
+class SessionWriter:
+    """Фоновий потік, що записує зміни сесій у БД, не блокуючи цикл подій.
+    
+    Кілька змін одного ключа до запису зливаються в одну: пишеться останній стан.
+    """
+    
+    def __init__(self):
+        self.pending = OrderedDict()
+        # Запис, що саме виконується: ((namespace, key), (payload, expires_at))
+        self.current = None
+        self.busy = False
+        self.condition = threading.Condition()
+        self.db = SessionConnection()
+        self.thread = None
+    
+    def submit(self, namespace: str, key, payload: Optional[str], expires_at: float):
+        """Ставить у чергу запис (payload - JSON) або видалення (payload None)"""
+        with self.condition:
+            self.pending[(namespace, key)] = (payload, expires_at)
+            self.pending.move_to_end((namespace, key))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="session-writer", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+    
+    def run(self):
+        while True:
+            with self.condition:
+                self.current = None
+                while not self.pending:
+                    self.busy = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+                self.current = self.pending.popitem(last=False)
+                self.busy = True
+            (namespace, key), (payload, expires_at) = self.current
+            self.write(namespace, key, payload, expires_at)
+    
+    def pending_entry(self, namespace: str, key):
+        """(payload, expires_at) ще не записаної зміни ключа або None"""
+        with self.condition:
+            entry = self.pending.get((namespace, key))
+            if entry is None and self.current is not None and self.current[0] == (namespace, key):
+                entry = self.current[1]
+            return entry
+    
+    def pending_keys(self, namespace: str) -> set:
+        """Ключі простору, зміни яких ще не записані в БД"""
+        with self.condition:
+            keys = {key for ns, key in self.pending if ns == namespace}
+            if self.current is not None and self.current[0][0] == namespace:
+                keys.add(self.current[0][1])
+            return keys
+    
+    def write(self, namespace: str, key, payload: Optional[str], expires_at: float):
+        # Запис і сповіщення інших реплік - один оператор: без запису немає й сповіщення
+        notice = f"{REPLICA_ID}:{namespace}:{key}"
+        try:
+            if payload is None:
+                self.db.execute('''
+                    WITH removed AS (
+                        DELETE FROM admin_state WHERE namespace = %s AND key = %s RETURNING key
+                    )
+                    SELECT pg_notify(%s, %s) FROM removed
+                ''', (namespace, key, SESSION_CHANNEL, notice))
+            else:
+                self.db.execute('''
+                    WITH saved AS (
+                        INSERT INTO admin_state (namespace, key, value, expires_at)
+                        VALUES (%s, %s, %s::jsonb, to_timestamp(%s))
+                        ON CONFLICT (namespace, key) DO UPDATE
+                        SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+                        RETURNING key
+                    )
+                    SELECT pg_notify(%s, %s) FROM saved
+                ''', (namespace, key, payload, expires_at, SESSION_CHANNEL, notice))
+        except Exception as e:
+            logger.error(f"❌ Помилка збереження сесії {namespace}/{key}: {e}")
+    
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Чекає, поки всі зміни будуть записані (при зупинці бота)"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+session_writer = SessionWriter()
+session_reader = SessionConnection()
+
+class StoredDict(dict):
+    """Значення сховища, що записує себе в БД при кожній зміні"""
+    
+    def __init__(self, store, key, data):
+        super().__init__(data)
+        self._store = store
+        self._key = key
+    
+    def _save(self):
+        self._store.persist(self._key, self)
+    
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self._save()
+    
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self._save()
+    
+    def pop(self, name, *default):
+        value = super().pop(name, *default)
+        self._save()
+        return value
+    
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._save()
+    
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+    
+    def clear(self):
+        super().clear()
+        self._save()
+
+class SessionStore(MutableMapping):
+    """Словник user_id -> значення з TTL у таблиці admin_state і LRU-кешем у пам'яті.
+    
+    Після preload кеш містить усі чинні сесії простору (complete), тож промах кешу
+    означає відсутність сесії і не потребує запиту до БД з циклу подій.
+    """
+    
+    def __init__(self, namespace: str, ttl: int = ADMIN_SESSION_TTL, max_entries: int = SESSION_CACHE_MAX_ENTRIES):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.complete = False
+        self.lock = threading.Lock()
+        session_stores[namespace] = self
+    
+    def _store_entry(self, key, value, expires_at: float):
+        """Кладе значення в кеш; викликається під self.lock"""
+        if value is _MISSING and self.complete:
+            # У повному кеші відсутність ключа і так означає, що сесії немає
+            self.cache.pop(key, None)
+            return
+        self.cache[key] = (value, expires_at)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            _, (evicted, _) = self.cache.popitem(last=False)
+            if evicted is not _MISSING:
+                self.complete = False
+    
+    def _remember(self, key, value, expires_at: float):
+        with self.lock:
+            self._store_entry(key, value, expires_at)
+    
+    def _remember_loaded(self, key, marker, value, expires_at: float):
+        """Кладе прочитане з БД, лише якщо ключ не змінився локально під час читання"""
+        with self.lock:
+            if self.cache.get(key) is marker:
+                self._store_entry(key, value, expires_at)
+            entry = self.cache.get(key)
+            return entry[0] if entry is not None else _MISSING
+    
+    def _wrap(self, key, value):
+        if isinstance(value, dict) and not isinstance(value, StoredDict):
+            return StoredDict(self, key, value)
+        return value
+    
+    def _from_pending(self, key):
+        """Значення з черги запису, якщо його зміна ще не дійшла до БД"""
+        entry = session_writer.pending_entry(self.namespace, key)
+        if entry is None:
+            return None
+        payload, expires_at = entry
+        if payload is None:
+            return _MISSING, time.time() + SESSION_NEGATIVE_TTL
+        return self._wrap(key, json.loads(payload)), expires_at
+    
+    def _load(self, key):
+        """Читає значення з черги запису або з БД; None - якщо БД недоступна"""
+        pending = self._from_pending(key)
+        if pending is not None:
+            return pending
+        try:
+            row = session_reader.execute('''
+                SELECT value, EXTRACT(EPOCH FROM expires_at)::float8 AS expires_at
+                FROM admin_state
+                WHERE namespace = %s AND key = %s AND expires_at > NOW()
+            ''', (self.namespace, key))
+        except Exception as e:
+            logger.error(f"❌ Помилка читання сесії {self.namespace}/{key}: {e}")
+            return None
+        if not row:
+            return _MISSING, time.time() + SESSION_NEGATIVE_TTL
+        return self._wrap(key, row['value']), row['expires_at']
+    
+    def _lookup(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.cache.move_to_end(key)
+                    return entry[0]
+                del self.cache[key]
+            if self.complete:
+                return _MISSING
+        
+        # Запасний шлях, поки кеш не повний (до preload або після витіснення)
+        loaded = self._load(key)
+        if loaded is None:
+            return _MISSING
+        return self._remember_loaded(key, None, *loaded)
+    
+    def preload(self):
+        """Завантажує всі чинні сесії простору в кеш (у фоновому потоці, не в циклі подій)"""
+        with self.lock:
+            before = dict(self.cache)
+        conn = get_db_connection()
+        if not conn:
+            self.invalidate()
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT key, value, EXTRACT(EPOCH FROM expires_at)::float8 AS expires_at
+                FROM admin_state
+                WHERE namespace = %s AND expires_at > NOW()
+                ORDER BY expires_at
+            ''', (self.namespace,))
+            rows = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"❌ Помилка завантаження сесій {self.namespace}: {e}")
+            self.invalidate()
+            return
+        finally:
+            conn.close()
+        
+        loaded = OrderedDict(
+            (row['key'], (self._wrap(row['key'], row['value']), row['expires_at'])) for row in rows
+        )
+        pending = session_writer.pending_keys(self.namespace)
+        with self.lock:
+            # Локальні зміни, зроблені під час читання або ще не записані, новіші за БД
+            for key in pending | set(before) | set(self.cache):
+                current = self.cache.get(key)
+                if key not in pending and current is before.get(key):
+                    continue
+                if current is None:
+                    current = self._from_pending(key)
+                if current is None or current[0] is _MISSING:
+                    loaded.pop(key, None)
+                else:
+                    loaded[key] = current
+            self.cache = loaded
+            self.complete = len(loaded) <= self.max_entries
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+    
+    def refresh(self, key):
+        """Перечитує ключ після зміни іншою реплікою (у потоці слухача, не в циклі подій)"""
+        with self.lock:
+            marker = self.cache.get(key)
+        loaded = self._load(key)
+        if loaded is None:
+            self.invalidate(key)
+            return
+        self._remember_loaded(key, marker, *loaded)
+    
+    def persist(self, key, value):
+        """Оновлює кеш і ставить запис у БД у фонову чергу, подовжуючи TTL"""
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        try:
+            payload = json.dumps(value, ensure_ascii=False)
+        except (TypeError, ValueError) as e:
+            logger.error(f"❌ Сесію {self.namespace}/{key} неможливо зберегти в БД: {e}")
+            return
+        session_writer.submit(self.namespace, key, payload, expires_at)
+    
+    def invalidate(self, key=None):
+        """Скидає кеш для ключа (або весь), наступне читання піде в БД.
+        
+        Ключі з ще не записаними змінами лишаються: у БД для них застарілий стан.
+        """
+        pending = session_writer.pending_keys(self.namespace)
+        with self.lock:
+            self.complete = False
+            for cached_key in (list(self.cache) if key is None else [key]):
+                if cached_key not in pending:
+                    self.cache.pop(cached_key, None)
+    
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+    
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+    
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+    
+    def __setitem__(self, key, value):
+        self.persist(key, self._wrap(key, value))
+    
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._remember(key, _MISSING, time.time() + SESSION_NEGATIVE_TTL)
+        session_writer.submit(self.namespace, key, None, 0)
+    
+    def _cached(self) -> dict:
+        now = time.time()
+        with self.lock:
+            return {key: value for key, (value, expires_at) in self.cache.items()
+                    if value is not _MISSING and expires_at > now}
+    
+    def __iter__(self):
+        return iter(self._cached())
+    
+    def __len__(self):
+        return len(self._cached())
+    
+    def __repr__(self):
+        return f"SessionStore({self.namespace!r}, {self._cached()!r})"
+
+def on_session_changed(payload: str):
+    """Сповіщення іншої репліки: перечитуємо змінене значення"""
+    replica_id, _, rest = payload.partition(":")
+    namespace, _, key = rest.partition(":")
+    store = session_stores.get(namespace)
+    if replica_id == REPLICA_ID or store is None or not key.lstrip("-").isdigit():
+        return
+    store.refresh(int(key))
+
+def purge_expired_sessions():
+    """Видаляє прострочені сесії з БД"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM admin_state WHERE expires_at <= NOW()")
+        if cursor.rowcount:
+            logger.info(f"🧹 Видалено прострочених сесій: {cursor.rowcount}")
+        conn.commit()
+    except Exception as e:
+        logger.error(f"❌ Помилка очищення сесій: {e}")
+    finally:
+        conn.close()
+
+admin_sessions = SessionStore("auth")
+last_password_check = SessionStore("password_check")
+orders_offset = SessionStore("orders_offset")
+messages_offset = SessionStore("messages_offset")
+# Прогрес розсилки потрібен лише процесу-лідеру, що її виконує, і змінюється після кожного одержувача
 broadcast_in_progress = {}
 
 def is_authenticated(user_id: int) -> bool:
@@ -704,23 +1443,166 @@ def is_authenticated(user_id: int) -> bool:
         logger.debug(f"Сесія користувача {user_id}: {admin_sessions[user_id]}")
     return result
 
-async def download_image_from_url_to_bytes(url: str) -> bytes:
-    """Завантажує зображення за URL і повертає як байти"""
-    logger.info(f"🌐 Спроба завантажити URL: {url}")
+# ========== ОБРОБКА ЗОБРАЖЕНЬ ==========
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+image_executor = None
+
+def normalize_product_image(raw: bytes) -> Tuple[bytes, str, Optional[int], Optional[int]]:
+    """Зменшує фото, перестискає в JPEG без метаданих і рахує sha256 (виконується в пулі процесів)"""
+    if not load_pillow():
+        return raw, hashlib.sha256(raw).hexdigest(), None, None
     
+    with Image.open(BytesIO(raw)) as img:
+        # Для JPEG декодуємо одразу в зменшеному масштабі
+        img.draft('RGB', (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        # EXIF та інші метадані не передаються в save, тому не потрапляють у файл
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+        data = output.getvalue()
+        width, height = img.size
+    
+    return data, hashlib.sha256(data).hexdigest(), width, height
+
+def get_image_executor() -> ProcessPoolExecutor:
+    """Пул процесів для декодування зображень (створюється при першому використанні)"""
+    global image_executor
+    if image_executor is None:
+        # spawn, а не fork: у процесі вже працюють потоки, і форкнута дитина могла б успадкувати
+        # захоплене блокування (logging, libpq, OpenSSL); імпорт модуля тепер без побічних ефектів
+        image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return image_executor
+
+async def prepare_product_image(raw: bytes) -> Optional[Tuple[bytes, str, Optional[int], Optional[int]]]:
+    """Нормалізує зображення в пулі процесів, не блокуючи цикл подій"""
+    global image_executor
+    loop = asyncio.get_running_loop()
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.get(url, timeout=30, allow_redirects=True, headers=headers)
-        response.raise_for_status()
-        
-        logger.info(f"✅ Зображення завантажено, розмір: {len(response.content)} байт")
-        return response.content
-        
+        result = await loop.run_in_executor(get_image_executor(), normalize_product_image, raw)
+    except BrokenProcessPool as e:
+        logger.error(f"❌ Пул обробки зображень зупинився, буде створено новий: {e}")
+        image_executor = None
+        return None
     except Exception as e:
-        logger.error(f"❌ Помилка завантаження зображення: {e}")
+        logger.error(f"❌ Не вдалося обробити зображення: {e}")
         return None
+    
+    data, image_hash, width, height = result
+    logger.info(f"🖼 Зображення нормалізовано: {len(raw)} → {len(data)} байт, {width}x{height}, {image_hash[:12]}")
+    return result
+
+# ========== ЗАВАНТАЖЕННЯ ЗОБРАЖЕНЬ ЗА URL ==========
+
+IMAGE_DOWNLOAD_MAX_BYTES = int(os.getenv("IMAGE_DOWNLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_DOWNLOAD_TIMEOUT = 30
+IMAGE_SNIFF_BYTES = 16
+http_client = None
+
+class ImageDownloadError(Exception):
+    """Помилка завантаження зображення, текст якої можна показати адміну"""
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Визначає формат зображення за сигнатурою перших байтів"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    return None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Спільний HTTP-клієнт з пулом з'єднань для завантаження зображень"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(IMAGE_DOWNLOAD_TIMEOUT, connect=10),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            follow_redirects=True,
+            headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+        )
+    return http_client
+
+async def close_http_client(application: Application):
+    """Закриває HTTP-клієнт при зупинці бота"""
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
+
+async def download_image(url: str, client: Optional[httpx.AsyncClient] = None, max_bytes: int = IMAGE_DOWNLOAD_MAX_BYTES) -> bytes:
+    """Потоково завантажує зображення, обриваючи передачу при перевищенні ліміту або не-зображенні"""
+    client = client or get_http_client()
+    try:
+        async with client.stream('GET', url) as response:
+            if response.status_code >= 400:
+                raise ImageDownloadError(f"сервер відповів кодом {response.status_code}")
+            
+            content_length = response.headers.get('content-length', '')
+            if content_length.isdigit() and int(content_length) > max_bytes:
+                raise ImageDownloadError(f"файл завеликий ({int(content_length) // 1024} КБ, максимум {max_bytes // 1024} КБ)")
+            
+            buffer = bytearray()
+            sniffed = False
+            async for chunk in response.aiter_bytes():
+                buffer.extend(chunk)
+                if len(buffer) > max_bytes:
+                    raise ImageDownloadError(f"файл завеликий (понад {max_bytes // 1024} КБ)")
+                # Заголовку Content-Type не довіряємо - перевіряємо сигнатуру вмісту
+                if not sniffed and len(buffer) >= IMAGE_SNIFF_BYTES:
+                    if not sniff_image_type(bytes(buffer[:IMAGE_SNIFF_BYTES])):
+                        content_type = response.headers.get('content-type', 'невідомий тип')
+                        raise ImageDownloadError(f"посилання веде не на зображення ({content_type})")
+                    sniffed = True
+            
+            if not sniffed and not sniff_image_type(bytes(buffer)):
+                raise ImageDownloadError("посилання веде не на зображення")
+    except httpx.TimeoutException:
+        raise ImageDownloadError(f"сервер не відповів за {IMAGE_DOWNLOAD_TIMEOUT} с")
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        raise ImageDownloadError(f"помилка з'єднання: {e}")
+    
+    logger.info(f"✅ Зображення завантажено, розмір: {len(buffer)} байт")
+    return bytes(buffer)
+
+async def save_product_image_from_url(bot: Bot, chat_id: int, product_id: int, url: str):
+    """Завантажує, нормалізує та зберігає фото товару за URL"""
+    logger.info(f"🌐 Спроба завантажити URL: {url}")
+    try:
+        image_bytes = await download_image(url)
+    except ImageDownloadError as e:
+        logger.error(f"❌ Помилка завантаження зображення: {e}")
+        await bot.send_message(
+            chat_id,
+            f"❌ Помилка при завантаженні зображення: {e}. Перевірте посилання та спробуйте ще раз.",
+            reply_markup=get_products_menu()
+        )
+        return
+    
+    image = await prepare_product_image(image_bytes)
+    
+    # Оновлюємо товар в БД - зберігаємо нормалізоване фото
+    if not image:
+        text = "❌ Не вдалося обробити зображення. Перевірте, що посилання веде на картинку."
+    elif save_product_image(product_id, *image):
+        text = f"✅ Фото товару #{product_id} оновлено! (збережено в БД)"
+    else:
+        text = "❌ Помилка при оновленні фото в базі даних"
+    await bot.send_message(chat_id, text, reply_markup=get_products_menu())
 
 async def download_telegram_file_to_bytes(file_id: str, bot: Bot) -> bytes:
     """Завантажує файл з Telegram і повертає як байти"""
@@ -957,9 +1839,9 @@ def get_all_orders(include_quick: bool = True, limit: int = None, offset: int =
     try:
         cursor = conn.cursor()
         
-        query = '''
-            SELECT *, 'regular' as order_type FROM orders 
-            ORDER BY created_at DESC
+        query = f'''
+            SELECT *, 'regular' as order_type, {KYIV_CREATED_AT} FROM orders 
+            ORDER BY orders.created_at DESC
         '''
         if limit:
             query += f' LIMIT {limit} OFFSET {offset}'
@@ -970,7 +1852,6 @@ def get_all_orders(include_quick: bool = True, limit: int = None, offset: int =
         all_orders = []
         for row in regular_orders:
             order = dict(row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             
             cursor.execute('''
                 SELECT * FROM order_items 
@@ -981,7 +1862,6 @@ def get_all_orders(include_quick: bool = True, limit: int = None, offset: int =
             order_items = []
             for item in items:
                 item_dict = dict(item)
-                item_dict['created_at'] = format_kyiv_time(item_dict.get('created_at'))
                 order_items.append(item_dict)
             
             order['items'] = order_items
@@ -989,9 +1869,9 @@ def get_all_orders(include_quick: bool = True, limit: int = None, offset: int =
             all_orders.append(order)
         
         if include_quick:
-            query = '''
-                SELECT *, 'quick' as order_type FROM quick_orders 
-                ORDER BY created_at DESC
+            query = f'''
+                SELECT *, 'quick' as order_type, {KYIV_CREATED_AT} FROM quick_orders 
+                ORDER BY quick_orders.created_at DESC
             '''
             if limit:
                 query += f' LIMIT {limit} OFFSET {offset}'
@@ -1001,7 +1881,6 @@ def get_all_orders(include_quick: bool = True, limit: int = None, offset: int =
             
             for row in quick_orders:
                 order = dict(row)
-                order['created_at'] = format_kyiv_time(order.get('created_at'))
                 order['order_id'] = order['id']
                 order['display_id'] = order['id']
                 order['total'] = safe_get(order, 'total', 0)
@@ -1009,7 +1888,7 @@ def get_all_orders(include_quick: bool = True, limit: int = None, offset: int =
                 order['np_department'] = order.get('np_department', 'Н/Д')
                 all_orders.append(order)
         
-        all_orders.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+        all_orders.sort(key=lambda x: x.get('created_at') or datetime.min, reverse=True)
         
         logger.debug(f"Отримано {len(all_orders)} замовлень")
         return all_orders
@@ -1025,25 +1904,13 @@ def get_recent_orders(hours: int = 1, min_count: int = 3):
     logger.debug(f"Виклик get_recent_orders(hours={hours}, min_count={min_count})")
     all_orders = get_all_orders(include_quick=True)
     
-    kyiv_now = get_kyiv_time()
-    time_limit = kyiv_now - timedelta(hours=hours)
+    time_limit = get_kyiv_now() - timedelta(hours=hours)
     
     recent_orders = []
     for order in all_orders:
-        try:
-            order_time_str = order.get('created_at', '')
-            if not order_time_str:
-                continue
-            order_time = datetime.strptime(str(order_time_str)[:19], '%Y-%m-%d %H:%M:%S')
-            if KYIV_TZ:
-                try:
-                    order_time = KYIV_TZ.localize(order_time)
-                except:
-                    pass
-            if order_time >= time_limit:
-                recent_orders.append(order)
-        except:
-            continue
+        order_time = order.get('created_at')
+        if order_time and order_time >= time_limit:
+            recent_orders.append(order)
     
     if len(recent_orders) < min_count:
         additional = all_orders[:min_count]
@@ -1074,9 +1941,9 @@ def format_order_text(order: dict) -> str:
     phone = order.get('phone', 'Н/Д')
     total = safe_get(order, 'total', 0)
     status = order.get('status', 'нове')
-    created_at = order.get('created_at', '')
+    created_at = format_datetime(order.get('created_at'))
     
-    text = f"{order_type} <b>№{order_id}</b> | {created_at[:16] if created_at else 'Н/Д'}\n"
+    text = f"{order_type} <b>№{order_id}</b> | {created_at}\n"
     text += f"👤 Клієнт: {user_name}\n"
     text += f"📞 Телефон: {phone}\n"
     
@@ -1093,6 +1960,39 @@ def format_order_text(order: dict) -> str:
     text += f"📊 Статус: {status}\n"
     return text
 
+PHONE_SEARCH_MIN_DIGITS = 3
+
+def validate_phone(phone: str) -> Tuple[bool, str]:
+    """Перевіряє та нормалізує номер (та сама логіка, що й в основному боті)"""
+    phone = phone.strip().replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
+    
+    if re.match(r'^(\+38|38)?0\d{9}$', phone):
+        if phone.startswith("0"):
+            phone = "+38" + phone
+        elif phone.startswith("38"):
+            phone = "+" + phone
+        return True, phone
+    return False, phone
+
+def get_phone_search_condition(text: str) -> Optional[Tuple[str, tuple]]:
+    """Будує індексовану умову пошуку за повним номером або його частиною"""
+    is_valid, formatted_phone = validate_phone(text)
+    if is_valid:
+        return "phone_normalized = %s", (formatted_phone,)
+    
+    digits = re.sub(r'\D', '', text)
+    if len(digits) < PHONE_SEARCH_MIN_DIGITS:
+        return None
+    
+    # Часткове введення: кінець номера або початок у форматі 0XX... / 380XX... / іноземний код.
+    # Номери, що не пройшли перевірку, зберігаються як '+' і цифри, тож теж знаходяться
+    suffix_pattern = digits[::-1] + "%"
+    if digits.startswith("0"):
+        prefix_pattern = "+38" + digits + "%"
+    else:
+        prefix_pattern = "+" + digits + "%"
+    return "(phone_normalized LIKE %s OR reverse(phone_normalized) LIKE %s)", (prefix_pattern, suffix_pattern)
+
 def get_orders_by_phone(phone: str):
     """Шукає замовлення за телефоном"""
     logger.debug(f"Виклик get_orders_by_phone(phone={phone})")
@@ -1100,33 +2000,37 @@ def get_orders_by_phone(phone: str):
     if not conn:
         return []
     
+    condition = get_phone_search_condition(phone)
+    if not condition:
+        conn.close()
+        return []
+    where_sql, params = condition
+    
     try:
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT *, 'regular' as order_type FROM orders 
-            WHERE phone LIKE %s 
-            ORDER BY created_at DESC
-        ''', (f"%{phone}%",))
+        cursor.execute(f'''
+            SELECT *, 'regular' as order_type, {KYIV_CREATED_AT} FROM orders 
+            WHERE {where_sql} 
+            ORDER BY orders.created_at DESC
+        ''', params)
         regular_orders = cursor.fetchall()
         
         all_orders = []
         for row in regular_orders:
             order = dict(row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             order['display_id'] = order['order_id']
             all_orders.append(order)
         
-        cursor.execute('''
-            SELECT *, 'quick' as order_type FROM quick_orders 
-            WHERE phone LIKE %s 
-            ORDER BY created_at DESC
-        ''', (f"%{phone}%",))
+        cursor.execute(f'''
+            SELECT *, 'quick' as order_type, {KYIV_CREATED_AT} FROM quick_orders 
+            WHERE {where_sql} 
+            ORDER BY quick_orders.created_at DESC
+        ''', params)
         quick_orders = cursor.fetchall()
         
         for row in quick_orders:
             order = dict(row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             order['order_id'] = order['id']
             order['display_id'] = order['id']
             order['total'] = safe_get(order, 'total', 0)
@@ -1149,17 +2053,16 @@ def get_new_orders():
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *, 'regular' as order_type FROM orders 
+        cursor.execute(f'''
+            SELECT *, 'regular' as order_type, {KYIV_CREATED_AT} FROM orders 
             WHERE status = 'нове'
-            ORDER BY created_at DESC
+            ORDER BY orders.created_at DESC
         ''')
         rows = cursor.fetchall()
         
         orders = []
         for row in rows:
             order = dict(row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             order['display_id'] = order['order_id']
             orders.append(order)
         
@@ -1180,16 +2083,15 @@ def get_quick_orders():
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM quick_orders 
-            ORDER BY created_at DESC
+        cursor.execute(f'''
+            SELECT *, {KYIV_CREATED_AT} FROM quick_orders 
+            ORDER BY quick_orders.created_at DESC
         ''')
         rows = cursor.fetchall()
         
         orders = []
         for row in rows:
             order = dict(row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             order['order_id'] = order['id']
             order['display_id'] = order['id']
             order['total'] = safe_get(order, 'total', 0)
@@ -1223,6 +2125,7 @@ def update_order_status(order_id: int, status: str, order_type: str = 'regular')
             ''', (status, order_id))
         
         conn.commit()
+        bump_report_data_version()
         logger.info(f"✅ Статус замовлення #{order_id} оновлено на '{status}'")
         return True
     except Exception as e:
@@ -1243,14 +2146,13 @@ def get_order_by_id(order_id: int, order_type: str = 'regular'):
         cursor = conn.cursor()
         
         if order_type == 'regular' or order_type == 'orders':
-            cursor.execute('SELECT * FROM orders WHERE order_id = %s', (order_id,))
+            cursor.execute(f'SELECT *, {KYIV_CREATED_AT} FROM orders WHERE order_id = %s', (order_id,))
             order_row = cursor.fetchone()
             if not order_row:
                 logger.warning(f"Замовлення #{order_id} не знайдено")
                 return None
             
             order = dict(order_row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             
             cursor.execute('SELECT * FROM order_items WHERE order_id = %s', (order_id,))
             items = cursor.fetchall()
@@ -1258,20 +2160,18 @@ def get_order_by_id(order_id: int, order_type: str = 'regular'):
             order_items = []
             for item in items:
                 item_dict = dict(item)
-                item_dict['created_at'] = format_kyiv_time(item_dict.get('created_at'))
                 order_items.append(item_dict)
             
             order['items'] = order_items
             order['order_type'] = 'regular'
         else:
-            cursor.execute('SELECT * FROM quick_orders WHERE id = %s', (order_id,))
+            cursor.execute(f'SELECT *, {KYIV_CREATED_AT} FROM quick_orders WHERE id = %s', (order_id,))
             order_row = cursor.fetchone()
             if not order_row:
                 logger.warning(f"Швидке замовлення #{order_id} не знайдено")
                 return None
             
             order = dict(order_row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             order['order_id'] = order['id']
             order['order_type'] = 'quick'
             order['items'] = []
@@ -1321,9 +2221,9 @@ def get_all_messages(limit: int = 50, offset: int = 0):
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM messages 
-            ORDER BY created_at DESC 
+        cursor.execute(f'''
+            SELECT *, {KYIV_CREATED_AT} FROM messages 
+            ORDER BY messages.created_at DESC 
             LIMIT %s OFFSET %s
         ''', (limit, offset))
         rows = cursor.fetchall()
@@ -1331,7 +2231,6 @@ def get_all_messages(limit: int = 50, offset: int = 0):
         messages = []
         for row in rows:
             msg = dict(row)
-            msg['created_at'] = format_kyiv_time(msg.get('created_at'))
             messages.append(msg)
         
         return messages
@@ -1351,11 +2250,10 @@ def get_message_by_id(message_id: int):
     
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM messages WHERE id = %s', (message_id,))
+        cursor.execute(f'SELECT *, {KYIV_CREATED_AT} FROM messages WHERE id = %s', (message_id,))
         row = cursor.fetchone()
         if row:
             msg = dict(row)
-            msg['created_at'] = format_kyiv_time(msg.get('created_at'))
             return msg
         return None
     except Exception as e:
@@ -1370,25 +2268,13 @@ def get_recent_messages(hours: int = 24, min_count: int = 5):
     logger.debug(f"Виклик get_recent_messages(hours={hours}, min_count={min_count})")
     all_messages = get_all_messages(limit=100)
     
-    kyiv_now = get_kyiv_time()
-    time_limit = kyiv_now - timedelta(hours=hours)
+    time_limit = get_kyiv_now() - timedelta(hours=hours)
     
     recent_messages = []
     for msg in all_messages:
-        try:
-            msg_time_str = msg.get('created_at', '')
-            if not msg_time_str:
-                continue
-            msg_time = datetime.strptime(str(msg_time_str)[:19], '%Y-%m-%d %H:%M:%S')
-            if KYIV_TZ:
-                try:
-                    msg_time = KYIV_TZ.localize(msg_time)
-                except:
-                    pass
-            if msg_time >= time_limit:
-                recent_messages.append(msg)
-        except:
-            continue
+        msg_time = msg.get('created_at')
+        if msg_time and msg_time >= time_limit:
+            recent_messages.append(msg)
     
     if len(recent_messages) < min_count:
         additional = all_messages[:min_count]
@@ -1416,7 +2302,7 @@ def format_message_text(msg: dict) -> str:
     text += f"👤 <b>Клієнт:</b> {msg['user_name']}\n"
     text += f"📱 <b>Username:</b> @{msg['username']}\n"
     text += f"🆔 <b>ID:</b> {msg['user_id']}\n"
-    text += f"📅 <b>Час:</b> {msg['created_at'][:16]}\n"
+    text += f"📅 <b>Час:</b> {format_datetime(msg.get('created_at'))}\n"
     text += f"📝 <b>Тип:</b> {msg['message_type']}\n"
     text += f"💬 <b>Текст:</b> {msg['text']}\n"
     return text
@@ -1430,17 +2316,16 @@ def get_messages_by_user(user_id: int):
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM messages 
+        cursor.execute(f'''
+            SELECT *, {KYIV_CREATED_AT} FROM messages 
             WHERE user_id = %s 
-            ORDER BY created_at DESC
+            ORDER BY messages.created_at DESC
         ''', (user_id,))
         rows = cursor.fetchall()
         
         messages = []
         for row in rows:
             msg = dict(row)
-            msg['created_at'] = format_kyiv_time(msg.get('created_at'))
             messages.append(msg)
         
         return messages
@@ -1459,7 +2344,7 @@ def format_messages_text(messages: list) -> str:
     text = "💬 <b>ОСТАННІ ПОВІДОМЛЕННЯ</b>\n\n"
     for i, msg in enumerate(messages[:20], 1):
         text += f"<b>{i}. {msg['user_name']}</b> (@{msg['username']})\n"
-        text += f"📅 {msg['created_at'][:16]}\n"
+        text += f"📅 {format_datetime(msg.get('created_at'))}\n"
         text += f"📝 {msg['text'][:100]}{'...' if len(msg['text']) > 100 else ''}\n"
         text += f"🆔 ID: {msg['user_id']}\n"
         text += f"📋 Тип: {msg['message_type']}\n"
@@ -1482,7 +2367,7 @@ def generate_messages_file(messages: list) -> bytes:
     for i, msg in enumerate(messages, 1):
         output.write(f"{i}. {msg['user_name']} (@{msg['username']})\n")
         output.write(f"ID: {msg['user_id']}\n")
-        output.write(f"Дата: {msg['created_at']}\n")
+        output.write(f"Дата: {format_datetime(msg.get('created_at'), '%Y-%m-%d %H:%M:%S')}\n")
         output.write(f"Тип: {msg['message_type']}\n")
         output.write(f"Текст: {msg['text']}\n")
         output.write("-" * 40 + "\n")
@@ -1498,16 +2383,15 @@ def get_all_users():
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM users 
-            ORDER BY created_at DESC
+        cursor.execute(f'''
+            SELECT *, {KYIV_CREATED_AT} FROM users 
+            ORDER BY users.created_at DESC
         ''')
         rows = cursor.fetchall()
         
         users = []
         for row in rows:
             user = dict(row)
-            user['created_at'] = format_kyiv_time(user.get('created_at'))
             users.append(user)
         
         return users
@@ -1525,22 +2409,30 @@ def get_user_by_phone(phone: str):
     if not conn:
         return None
     
+    condition = get_phone_search_condition(phone)
+    if not condition:
+        conn.close()
+        return None
+    where_sql, params = condition
+    
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT DISTINCT user_id, user_name, username FROM orders 
-            WHERE phone LIKE %s 
+        cursor.execute(f'''
+            SELECT user_id FROM (
+                SELECT user_id, created_at FROM orders WHERE {where_sql}
+                UNION ALL
+                SELECT user_id, created_at FROM quick_orders WHERE {where_sql}
+            ) AS found
             ORDER BY created_at DESC LIMIT 1
-        ''', (f"%{phone}%",))
+        ''', params + params)
         order_user = cursor.fetchone()
         
         if order_user:
             user_id = order_user['user_id']
-            cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
+            cursor.execute(f'SELECT *, {KYIV_CREATED_AT} FROM users WHERE user_id = %s', (user_id,))
             user_row = cursor.fetchone()
             if user_row:
                 user = dict(user_row)
-                user['created_at'] = format_kyiv_time(user.get('created_at'))
                 return user
         
         return None
@@ -1560,11 +2452,10 @@ def get_user_by_id(user_id: int):
     
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
+        cursor.execute(f'SELECT *, {KYIV_CREATED_AT} FROM users WHERE user_id = %s', (user_id,))
         row = cursor.fetchone()
         if row:
             user = dict(row)
-            user['created_at'] = format_kyiv_time(user.get('created_at'))
             return user
         return None
     except Exception as e:
@@ -1583,17 +2474,16 @@ def get_user_orders(user_id: int):
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT *, 'regular' as order_type FROM orders 
+        cursor.execute(f'''
+            SELECT *, 'regular' as order_type, {KYIV_CREATED_AT} FROM orders 
             WHERE user_id = %s 
-            ORDER BY created_at DESC
+            ORDER BY orders.created_at DESC
         ''', (user_id,))
         rows = cursor.fetchall()
         
         orders = []
         for row in rows:
             order = dict(row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             
             cursor.execute('''
                 SELECT * FROM order_items 
@@ -1604,7 +2494,6 @@ def get_user_orders(user_id: int):
             order_items = []
             for item in items:
                 item_dict = dict(item)
-                item_dict['created_at'] = format_kyiv_time(item_dict.get('created_at'))
                 order_items.append(item_dict)
             
             order['items'] = order_items
@@ -1666,17 +2555,16 @@ def get_user_messages(user_id: int):
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM messages 
+        cursor.execute(f'''
+            SELECT *, {KYIV_CREATED_AT} FROM messages 
             WHERE user_id = %s 
-            ORDER BY created_at DESC LIMIT 10
+            ORDER BY messages.created_at DESC LIMIT 10
         ''', (user_id,))
         rows = cursor.fetchall()
         
         messages = []
         for row in rows:
             msg = dict(row)
-            msg['created_at'] = format_kyiv_time(msg.get('created_at'))
             messages.append(msg)
         
         return messages
@@ -1696,17 +2584,16 @@ def get_user_quick_orders(user_id: int):
     
     try:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM quick_orders 
+        cursor.execute(f'''
+            SELECT *, {KYIV_CREATED_AT} FROM quick_orders 
             WHERE user_id = %s 
-            ORDER BY created_at DESC
+            ORDER BY quick_orders.created_at DESC
         ''', (user_id,))
         rows = cursor.fetchall()
         
         orders = []
         for row in rows:
             order = dict(row)
-            order['created_at'] = format_kyiv_time(order.get('created_at'))
             order['order_id'] = order['id']
             order['total'] = safe_get(order, 'total', 0)
             orders.append(order)
@@ -1727,22 +2614,9 @@ def get_customer_segment(user_data: dict, orders: list) -> str:
     total_orders = len(orders)
     total_spent = sum(order.get('total', 0) for order in orders)
     
-    if orders:
-        last_order = max(orders, key=lambda x: x.get('created_at', ''))
-        last_order_date_str = last_order.get('created_at', '')
-        if last_order_date_str:
-            try:
-                last_order_date = datetime.strptime(str(last_order_date_str)[:19], '%Y-%m-%d %H:%M:%S')
-                if KYIV_TZ:
-                    try:
-                        last_order_date = KYIV_TZ.localize(last_order_date)
-                    except:
-                        pass
-                days_since_last = (get_kyiv_time() - last_order_date).days
-            except:
-                days_since_last = 999
-        else:
-            days_since_last = 999
+    order_dates = [order['created_at'] for order in orders if order.get('created_at')]
+    if order_dates:
+        days_since_last = (get_kyiv_now() - max(order_dates)).days
     else:
         days_since_last = 999
     
@@ -1766,14 +2640,16 @@ def get_all_products():
     
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT id, name, price, category, description, unit, image, details, created_at FROM products ORDER BY id')
+        cursor.execute(f'''
+            SELECT id, name, price, category, description, unit, image, details, {KYIV_CREATED_AT},
+                   (image_hash IS NOT NULL OR image_data IS NOT NULL) AS has_image
+            FROM products ORDER BY id
+        ''')
         rows = cursor.fetchall()
         
         products = []
         for row in rows:
             product = dict(row)
-            if product.get('created_at'):
-                product['created_at'] = format_kyiv_time(product.get('created_at'))
             products.append(product)
         logger.debug(f"Отримано {len(products)} товарів")
         return products
@@ -1812,6 +2688,9 @@ def update_product(product_id: int, **kwargs):
                 values.append(value)
             else:
                 fields.append(f"{key} = NULL")
+        if "image_data" in kwargs:
+            # file_id у Telegram належить старому фото
+            fields.append("telegram_file_id = NULL")
         
         if not fields:
             logger.warning(f"Спроба оновити товар #{product_id} без даних")
@@ -1830,6 +2709,33 @@ def update_product(product_id: int, **kwargs):
     finally:
         conn.close()
 
+def save_product_image(product_id: int, image_data: bytes, image_hash: str, width: Optional[int] = None, height: Optional[int] = None) -> bool:
+    """Зберігає нормалізоване фото в product_images (без дублікатів) і прив'язує до товару"""
+    conn = get_db_connection()
+    if not conn:
+        return False
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO product_images (hash, data, width, height, size)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (hash) DO NOTHING
+        ''', (image_hash, psycopg2.Binary(image_data), width, height, len(image_data)))
+        cursor.execute('''
+            UPDATE products SET image_hash = %s, image_data = NULL, telegram_file_id = NULL
+            WHERE id = %s
+        ''', (image_hash, product_id))
+        conn.commit()
+        logger.info(f"✅ Фото товару #{product_id} збережено ({len(image_data)} байт, {image_hash[:12]})")
+        return True
+    except Exception as e:
+        logger.error(f"Помилка збереження фото товару: {e}")
+        logger.error(traceback.format_exc())
+        return False
+    finally:
+        conn.close()
+
 def add_product(name: str, price: float, category: str, description: str, unit: str, details: str):
     """Додає новий товар"""
     logger.info(f"📦 Спроба додати товар: {name}, ціна: {price}, категорія: {category}")
@@ -1889,14 +2795,11 @@ def get_all_admins():
     
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, added_by, added_at FROM admins')
+        cursor.execute(f'SELECT user_id, username, added_by, {kyiv_time_sql("added_at")} FROM admins')
         rows = cursor.fetchall()
         admins = []
         for row in rows:
-            admin = dict(row)
-            if admin.get('added_at'):
-                admin['added_at'] = format_kyiv_time(admin.get('added_at'))
-            admins.append(admin)
+            admins.append(dict(row))
         return admins
     except Exception as e:
         logger.error(f"Помилка отримання адмінів: {e}")
@@ -2010,7 +2913,7 @@ async def check_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if text == ADMIN_PASSWORD:
         admin_sessions[user_id] = {"state": "authenticated", "authenticated_at": get_kyiv_time().isoformat()}
-        last_password_check[user_id] = get_kyiv_time()
+        last_password_check[user_id] = get_kyiv_time().isoformat()
         
         logger.info(f"✅ Адмін {user_id} успішно автентифікований, сесія: {admin_sessions[user_id]}")
         
@@ -2038,7 +2941,7 @@ def generate_orders_report(orders: list, format: str = "txt"):
         for order in orders:
             order_id = order.get('order_id', order.get('id', 'Н/Д'))
             output.write(f"Номер: {order_id}\n")
-            output.write(f"Дата: {order['created_at']}\n")
+            output.write(f"Дата: {format_datetime(order.get('created_at'), '%Y-%m-%d %H:%M:%S')}\n")
             output.write(f"Клієнт: {order.get('user_name', 'Н/Д')}\n")
             output.write(f"Телефон: {order.get('phone', 'Н/Д')}\n")
             output.write(f"Username: @{order.get('username', 'Н/Д')}\n")
@@ -2060,7 +2963,7 @@ def generate_orders_report(orders: list, format: str = "txt"):
             order_id = order.get('order_id', order.get('id', 'Н/Д'))
             writer.writerow([
                 order_id,
-                order['created_at'],
+                format_datetime(order.get('created_at'), '%Y-%m-%d %H:%M:%S'),
                 order.get('user_name', 'Н/Д'),
                 order.get('phone', 'Н/Д'),
                 order.get('username', 'Н/Д'),
@@ -2072,7 +2975,7 @@ def generate_orders_report(orders: list, format: str = "txt"):
         
         return output.getvalue().encode('utf-8-sig')
 
-def generate_users_report(users: list) -> bytes:
+def generate_users_report(users: list, progress=None) -> bytes:
     """Генерує звіт по користувачах"""
     logger.debug(f"Генерація звіту по користувачах, кількість: {len(users)}")
     output = StringIO()
@@ -2082,7 +2985,9 @@ def generate_users_report(users: list) -> bytes:
     output.write(f"Всього користувачів: {len(users)}\n")
     output.write("=" * 100 + "\n\n")
     
-    for user in users:
+    for index, user in enumerate(users, 1):
+        if progress:
+            progress(index, len(users))
         user_id = user['user_id']
         orders = get_user_orders(user_id)
         quick_orders = get_user_quick_orders(user_id)
@@ -2095,7 +3000,7 @@ def generate_users_report(users: list) -> bytes:
         output.write(f"ID: {user_id}\n")
         output.write(f"Ім'я: {user['first_name']} {user['last_name']}\n")
         output.write(f"Username: @{user['username']}\n")
-        output.write(f"Дата реєстрації: {user['created_at'][:16]}\n")
+        output.write(f"Дата реєстрації: {format_datetime(user.get('created_at'))}\n")
         output.write(f"Сегмент: {segment}\n\n")
         
         if phones:
@@ -2118,7 +3023,7 @@ def generate_users_report(users: list) -> bytes:
             for i, order in enumerate(all_orders[:3], 1):
                 order_id = order.get('order_id', order.get('id', 'Н/Д'))
                 order_type = "⚡" if order.get('order_type') == 'quick' else "📦"
-                created_at = order.get('created_at', '')[:16]
+                created_at = format_datetime(order.get('created_at'))
                 status = order.get('status', 'нове')
                 total = order.get('total', 0)
                 phone = order.get('phone', '')
@@ -2140,7 +3045,7 @@ def generate_users_report(users: list) -> bytes:
             output.write(f"\n💬 ПОВІДОМЛЕННЯ: {len(messages)}\n")
             output.write("  Останні повідомлення:\n")
             for i, msg in enumerate(messages[:3], 1):
-                created_at = msg.get('created_at', '')[:16]
+                created_at = format_datetime(msg.get('created_at'))
                 text = msg.get('text', '')
                 output.write(f"    {i}. {created_at}: {text[:100]}{'...' if len(text) > 100 else ''}\n")
         
@@ -2161,7 +3066,7 @@ def generate_quick_orders_report(orders: list, format: str = "txt"):
         
         for order in orders:
             output.write(f"Номер: {order['id']}\n")
-            output.write(f"Дата: {order['created_at']}\n")
+            output.write(f"Дата: {format_datetime(order.get('created_at'), '%Y-%m-%d %H:%M:%S')}\n")
             output.write(f"Клієнт: {order['user_name']}\n")
             output.write(f"Телефон: {order['phone']}\n")
             output.write(f"Username: @{order['username']}\n")
@@ -2182,7 +3087,7 @@ def generate_quick_orders_report(orders: list, format: str = "txt"):
         for order in orders:
             writer.writerow([
                 order['id'],
-                order['created_at'],
+                format_datetime(order.get('created_at'), '%Y-%m-%d %H:%M:%S'),
                 order['user_name'],
                 order['phone'],
                 order['username'],
@@ -2215,6 +3120,13 @@ def generate_stats_report(stats: dict, format: str = "txt"):
         output.write(f"   Кількість: {stats.get('last_30_days_orders', 0)}\n")
         output.write(f"   Сума: {stats.get('last_30_days_revenue', 0):.2f} грн\n\n")
         
+        daily_trend = stats.get('daily_trend', [])
+        if daily_trend:
+            output.write(f"📈 Замовлення за {len(daily_trend)} днів:\n")
+            for day in daily_trend:
+                output.write(f"   {day['day'].strftime('%Y-%m-%d')}: {day['orders']} | {day['revenue']:.2f} грн\n")
+            output.write("\n")
+        
         output.write("📊 Статуси замовлень:\n")
         for status, count in stats.get('orders_by_status', {}).items():
             output.write(f"   • {status}: {count}\n")
@@ -2245,7 +3157,7 @@ def generate_messages_report(messages: list, format: str = "txt"):
             output.write(f"User ID: {msg['user_id']}\n")
             output.write(f"Ім'я: {msg['user_name']}\n")
             output.write(f"Username: @{msg['username']}\n")
-            output.write(f"Дата: {msg['created_at']}\n")
+            output.write(f"Дата: {format_datetime(msg.get('created_at'), '%Y-%m-%d %H:%M:%S')}\n")
             output.write(f"Тип: {msg['message_type']}\n")
             output.write(f"Текст: {msg['text']}\n")
             output.write("-" * 40 + "\n")
@@ -2263,15 +3175,25 @@ def generate_messages_report(messages: list, format: str = "txt"):
                 msg['user_id'],
                 msg['user_name'],
                 msg['username'],
-                msg['created_at'],
+                format_datetime(msg.get('created_at'), '%Y-%m-%d %H:%M:%S'),
                 msg['message_type'],
                 msg['text']
             ])
         
         return output.getvalue().encode('utf-8-sig')
 
+STATS_TREND_DAYS = 14
+SPARKLINE_BARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values: List[float]) -> str:
+    """Мініграфік зі смужок Unicode"""
+    peak = max(values, default=0)
+    if peak <= 0:
+        return SPARKLINE_BARS[0] * len(values)
+    return "".join(SPARKLINE_BARS[round(value / peak * (len(SPARKLINE_BARS) - 1))] for value in values)
+
 def get_statistics():
-    """Отримує статистику"""
+    """Отримує статистику з daily_metrics"""
     logger.debug("Виклик get_statistics()")
     conn = get_db_connection()
     if not conn:
@@ -2280,58 +3202,79 @@ def get_statistics():
     try:
         cursor = conn.cursor()
         
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        regular_orders = cursor.fetchone()['count'] or 0
-        
-        cursor.execute("SELECT COUNT(*) FROM quick_orders")
-        quick_orders_count = cursor.fetchone()['count'] or 0
-        
         cursor.execute("SELECT COUNT(*) FROM users")
         total_users = cursor.fetchone()['count'] or 0
         
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        total_messages = cursor.fetchone()['count'] or 0
-        
-        cursor.execute("SELECT COALESCE(SUM(total), 0) FROM orders")
-        regular_revenue = cursor.fetchone()['coalesce'] or 0
-        
-        cursor.execute("SELECT COALESCE(SUM(total), 0) FROM quick_orders")
-        quick_revenue = cursor.fetchone()['coalesce'] or 0
-        
-        total_orders = regular_orders + quick_orders_count
-        total_revenue = regular_revenue + quick_revenue
+        today = get_kyiv_now().date()
+        cursor.execute('''
+            SELECT kind, status, SUM(count) AS count, SUM(revenue) AS revenue,
+                   COALESCE(SUM(count) FILTER (WHERE day > %(since)s), 0) AS recent_count,
+                   COALESCE(SUM(revenue) FILTER (WHERE day > %(since)s), 0) AS recent_revenue
+            FROM daily_metrics
+            GROUP BY kind, status
+        ''', {"since": today - timedelta(days=30)})
+        
+        counts = {"order": 0, "quick_order": 0, "message": 0}
+        total_revenue = 0
+        last_30_days_count = 0
+        last_30_days_sum = 0
+        orders_by_status = {}
+        for row in cursor.fetchall():
+            counts[row['kind']] = counts.get(row['kind'], 0) + row['count']
+            if row['kind'] == 'message':
+                continue
+            total_revenue += row['revenue']
+            last_30_days_count += row['recent_count']
+            last_30_days_sum += row['recent_revenue']
+            if row['count']:
+                orders_by_status[row['status']] = orders_by_status.get(row['status'], 0) + row['count']
         
+        total_orders = counts["order"] + counts["quick_order"]
         avg_check = total_revenue / total_orders if total_orders > 0 else 0
         
-        cursor.execute("SELECT status, COUNT(*) FROM orders GROUP BY status")
-        rows = cursor.fetchall()
-        orders_by_status = {row['status']: row['count'] for row in rows}
-        
-        cursor.execute("SELECT status, COUNT(*) FROM quick_orders GROUP BY status")
-        quick_rows = cursor.fetchall()
-        for row in quick_rows:
-            status = row['status']
-            if status in orders_by_status:
-                orders_by_status[status] += row['count']
-            else:
-                orders_by_status[status] = row['count']
-        
+        trend_start = today - timedelta(days=STATS_TREND_DAYS - 1)
         cursor.execute('''
-            SELECT COALESCE(COUNT(*), 0), COALESCE(SUM(total), 0) FROM orders 
-            WHERE created_at >= NOW() - INTERVAL '30 days'
-        ''')
-        last_30_days_regular = cursor.fetchone()
-        
+            SELECT day, SUM(count) AS orders, SUM(revenue) AS revenue
+            FROM daily_metrics
+            WHERE kind IN ('order', 'quick_order') AND day >= %s
+            GROUP BY day
+        ''', (trend_start,))
+        by_day = {row['day']: row for row in cursor.fetchall()}
+        daily_trend = []
+        for offset in range(STATS_TREND_DAYS):
+            day = trend_start + timedelta(days=offset)
+            row = by_day.get(day)
+            daily_trend.append({
+                "day": day,
+                "orders": row['orders'] if row else 0,
+                "revenue": row['revenue'] if row else 0
+            })
+        
+        # Сегменти за тими ж правилами, що й get_customer_segment, одним запитом
         cursor.execute('''
-            SELECT COALESCE(COUNT(*), 0), COALESCE(SUM(total), 0) FROM quick_orders 
-            WHERE created_at >= NOW() - INTERVAL '30 days'
+            WITH per_user AS (
+                SELECT u.user_id, COUNT(o.user_id) AS orders, COALESCE(SUM(o.total), 0) AS spent,
+                       MAX(o.created_at) AS last_at
+                FROM users u
+                LEFT JOIN (
+                    SELECT user_id, total, created_at FROM orders
+                    UNION ALL
+                    SELECT user_id, 0, created_at FROM quick_orders
+                ) o ON o.user_id = u.user_id
+                GROUP BY u.user_id
+            )
+            SELECT CASE
+                       WHEN orders = 0 THEN 'new'
+                       WHEN orders >= 5 AND spent >= 5000 THEN 'vip'
+                       WHEN orders >= 3 THEN 'regular'
+                       WHEN last_at IS NULL OR last_at <= (NOW() AT TIME ZONE 'UTC') - INTERVAL '91 days' THEN 'inactive'
+                       WHEN orders = 1 THEN 'new'
+                       ELSE 'active'
+                   END AS segment,
+                   COUNT(*) AS users
+            FROM per_user
+            GROUP BY 1
         ''')
-        last_30_days_quick = cursor.fetchone()
-        
-        last_30_days_count = (last_30_days_regular['coalesce'] or 0) + (last_30_days_quick['coalesce'] or 0)
-        last_30_days_sum = (last_30_days_regular['coalesce_2'] or 0) + (last_30_days_quick['coalesce_2'] or 0)
-        
-        users = get_all_users()
         segments = {
             "vip": 0,
             "regular": 0,
@@ -2339,33 +3282,20 @@ def get_statistics():
             "inactive": 0,
             "active": 0
         }
-        
-        for user in users:
-            orders = get_user_orders(user['user_id'])
-            quick_orders = get_user_quick_orders(user['user_id'])
-            all_orders = orders + quick_orders
-            segment = get_customer_segment(user, all_orders)
-            if "VIP" in segment:
-                segments["vip"] += 1
-            elif "Постійний" in segment:
-                segments["regular"] += 1
-            elif "Неактивний" in segment:
-                segments["inactive"] += 1
-            elif "Новий" in segment:
-                segments["new"] += 1
-            else:
-                segments["active"] += 1
+        for row in cursor.fetchall():
+            segments[row['segment']] = row['users']
         
         return {
             "total_orders": total_orders,
             "total_users": total_users,
-            "total_quick_orders": quick_orders_count,
-            "total_messages": total_messages,
+            "total_quick_orders": counts["quick_order"],
+            "total_messages": counts["message"],
             "total_revenue": total_revenue,
             "avg_check": avg_check,
             "orders_by_status": orders_by_status,
             "last_30_days_orders": last_30_days_count,
             "last_30_days_revenue": last_30_days_sum,
+            "daily_trend": daily_trend,
             "segments": segments
         }
     except Exception as e:
@@ -2375,6 +3305,689 @@ def get_statistics():
     finally:
         conn.close()
 
+# ========== ЖИВИЙ ДАШБОРД ==========
+
+ACTIVITY_CHANNEL = "activity"
+# Як часто оновлюється повідомлення дашборду, с
+LIVE_DASHBOARD_INTERVAL = 15
+# Як часто лічильники звіряються з daily_metrics, с
+LIVE_RECONCILE_INTERVAL = 300
+# Через скільки дашборд вимикається сам, с
+LIVE_DASHBOARD_TTL = 3600
+
+class LiveStats:
+    """Лічильники активності в пам'яті: оновлюються з NOTIFY activity і періодично звіряються з БД"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals: Dict[str, float] = {}
+        self.today_totals: Dict[str, float] = {}
+        self.orders_by_status: Dict[str, int] = {}
+        self.today = None
+        self.reconciled_at = 0.0
+        self.changed_at: Optional[datetime] = None
+    
+    def reconcile(self) -> bool:
+        """Перечитує підсумки з daily_metrics"""
+        conn = get_db_connection()
+        if not conn:
+            return False
+        
+        try:
+            cursor = conn.cursor()
+            today = get_kyiv_now().date()
+            cursor.execute('''
+                SELECT kind, status, SUM(count) AS count, SUM(revenue) AS revenue,
+                       COALESCE(SUM(count) FILTER (WHERE day = %(today)s), 0) AS today_count,
+                       COALESCE(SUM(revenue) FILTER (WHERE day = %(today)s), 0) AS today_revenue
+                FROM daily_metrics
+                GROUP BY kind, status
+            ''', {"today": today})
+            rows = cursor.fetchall()
+            cursor.execute("SELECT COUNT(*) FROM users")
+            users = cursor.fetchone()['count']
+            
+            totals = {"order": 0, "quick_order": 0, "message": 0, "revenue": 0.0, "user": users}
+            today_totals = {"order": 0, "quick_order": 0, "message": 0, "revenue": 0.0}
+            orders_by_status = {}
+            for row in rows:
+                totals[row['kind']] = totals.get(row['kind'], 0) + row['count']
+                today_totals[row['kind']] = today_totals.get(row['kind'], 0) + row['today_count']
+                if row['kind'] != 'message':
+                    totals["revenue"] += row['revenue']
+                    today_totals["revenue"] += row['today_revenue']
+                    if row['count']:
+                        orders_by_status[row['status']] = orders_by_status.get(row['status'], 0) + row['count']
+            
+            with self.lock:
+                if (totals, today_totals, orders_by_status) != (self.totals, self.today_totals, self.orders_by_status):
+                    self.changed_at = get_kyiv_now()
+                self.totals = totals
+                self.today_totals = today_totals
+                self.orders_by_status = orders_by_status
+                self.today = today
+                self.reconciled_at = time.monotonic()
+            return True
+        except Exception as e:
+            logger.error(f"❌ Помилка звірки живої статистики: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    def apply(self, event: Dict):
+        """Застосовує одну подію з NOTIFY activity"""
+        kind = event.get("kind")
+        delta = event.get("delta", 0)
+        revenue = event.get("revenue") or 0
+        with self.lock:
+            if not self.reconciled_at:
+                return
+            self.totals[kind] = self.totals.get(kind, 0) + delta
+            if kind in ("order", "quick_order"):
+                self.totals["revenue"] = self.totals.get("revenue", 0) + revenue
+                status = event.get("status", "")
+                self.orders_by_status[status] = self.orders_by_status.get(status, 0) + delta
+            if event.get("day") == str(self.today):
+                self.today_totals[kind] = self.today_totals.get(kind, 0) + delta
+                if kind in ("order", "quick_order"):
+                    self.today_totals["revenue"] = self.today_totals.get("revenue", 0) + revenue
+            self.changed_at = get_kyiv_now()
+    
+    def invalidate(self):
+        """Позначає лічильники застарілими - наступний тік дашборду звірить їх з БД"""
+        with self.lock:
+            self.reconciled_at = 0.0
+    
+    def needs_reconcile(self) -> bool:
+        with self.lock:
+            return (
+                not self.reconciled_at
+                or time.monotonic() - self.reconciled_at > LIVE_RECONCILE_INTERVAL
+                or get_kyiv_now().date() != self.today
+            )
+    
+    def render(self) -> str:
+        with self.lock:
+            totals = dict(self.totals)
+            today_totals = dict(self.today_totals)
+            orders_by_status = dict(self.orders_by_status)
+            changed_at = self.changed_at
+        
+        text = "📡 ЖИВА СТАТИСТИКА\n"
+        text += f"🕒 Дані на: {format_datetime(changed_at, '%H:%M:%S')}\n\n"
+        text += "📅 Сьогодні:\n"
+        text += f"   📋 Замовлень: {today_totals.get('order', 0) + today_totals.get('quick_order', 0)}\n"
+        text += f"   💰 Виручка: {today_totals.get('revenue', 0):.2f} грн\n"
+        text += f"   💬 Повідомлень: {today_totals.get('message', 0)}\n\n"
+        text += "📊 Всього:\n"
+        text += f"   📋 Замовлень: {totals.get('order', 0) + totals.get('quick_order', 0)}\n"
+        text += f"   ⚡ Швидких замовлень: {totals.get('quick_order', 0)}\n"
+        text += f"   💰 Виручка: {totals.get('revenue', 0):.2f} грн\n"
+        text += f"   👥 Клієнтів: {totals.get('user', 0)}\n"
+        text += f"   💬 Повідомлень: {totals.get('message', 0)}\n\n"
+        text += "📊 Статуси замовлень:\n"
+        for status, count in orders_by_status.items():
+            if count:
+                text += f"   • {status}: {count}\n"
+        return text
+
+live_stats = LiveStats()
+# chat_id -> {"message_id", "expires_at", "text"} для кожного відкритого дашборду
+live_dashboards: Dict[int, Dict] = {}
+live_dashboard_task: Optional[asyncio.Task] = None
+
+def listen_for_activity():
+    """Фоновий потік: слухає NOTIFY activity та admin_state і перепідключається при обриві"""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {ACTIVITY_CHANNEL}")
+            cursor.execute(f"LISTEN {SESSION_CHANNEL}")
+            # Поки підписки не було, події могли загубитись
+            live_stats.invalidate()
+            for store in session_stores.values():
+                store.preload()
+            logger.info("👂 Підписка на активність активна")
+            while True:
+                if not select.select([conn], [], [], 60)[0]:
+                    cursor.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if notify.channel == SESSION_CHANNEL:
+                        on_session_changed(notify.payload)
+                        continue
+                    try:
+                        live_stats.apply(json.loads(notify.payload))
+                    except ValueError:
+                        logger.warning(f"⚠️ Некоректна подія активності: {notify.payload}")
+        except Exception as e:
+            logger.warning(f"⚠️ Підписка на активність перервалась: {e}")
+        finally:
+            if conn:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(5)
+
+def get_live_dashboard_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Зупинити", callback_data="admin_stats_live_stop")]])
+
+async def start_live_dashboard(bot: Bot, chat_id: int):
+    """Надсилає і закріплює повідомлення дашборду в чаті адміна"""
+    await stop_live_dashboard(bot, chat_id)
+    if live_stats.needs_reconcile():
+        await asyncio.to_thread(live_stats.reconcile)
+    
+    text = live_stats.render()
+    message = await bot.send_message(chat_id=chat_id, text=text, reply_markup=get_live_dashboard_keyboard())
+    try:
+        await bot.pin_chat_message(chat_id=chat_id, message_id=message.message_id, disable_notification=True)
+    except Exception as e:
+        logger.warning(f"⚠️ Не вдалося закріпити дашборд: {e}")
+    live_dashboards[chat_id] = {
+        "message_id": message.message_id,
+        "expires_at": time.monotonic() + LIVE_DASHBOARD_TTL,
+        "text": text
+    }
+    logger.info(f"📡 Живий дашборд відкрито в чаті {chat_id}")
+
+async def stop_live_dashboard(bot: Bot, chat_id: int, reason: str = "⏹ Живий режим вимкнено"):
+    """Зупиняє оновлення дашборду та відкріплює повідомлення"""
+    dashboard = live_dashboards.pop(chat_id, None)
+    if not dashboard:
+        return
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=dashboard["message_id"], text=f"{dashboard['text']}\n{reason}")
+        await bot.unpin_chat_message(chat_id=chat_id, message_id=dashboard["message_id"])
+    except Exception as e:
+        logger.debug(f"Не вдалося закрити дашборд у чаті {chat_id}: {e}")
+
+async def refresh_live_dashboards(bot: Bot):
+    """Один тік: за потреби звіряє лічильники і редагує дашборди, текст яких змінився"""
+    if live_stats.needs_reconcile():
+        await asyncio.to_thread(live_stats.reconcile)
+    
+    text = live_stats.render()
+    now = time.monotonic()
+    for chat_id, dashboard in list(live_dashboards.items()):
+        if now > dashboard["expires_at"]:
+            await stop_live_dashboard(bot, chat_id, "⏹ Живий режим вимкнено за часом")
+            continue
+        if dashboard["text"] == text:
+            continue
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=dashboard["message_id"],
+                text=text,
+                reply_markup=get_live_dashboard_keyboard()
+            )
+            dashboard["text"] = text
+        except BadRequest as e:
+            if "message is not modified" in str(e).lower():
+                dashboard["text"] = text
+            else:
+                logger.warning(f"⚠️ Дашборд у чаті {chat_id} недоступний: {e}")
+                live_dashboards.pop(chat_id, None)
+        except Exception as e:
+            logger.warning(f"⚠️ Помилка оновлення дашборду в чаті {chat_id}: {e}")
+
+async def live_dashboard_loop(bot: Bot):
+    """Оновлює відкриті дашборди з фіксованою періодичністю"""
+    while True:
+        await asyncio.sleep(LIVE_DASHBOARD_INTERVAL)
+        if live_dashboards:
+            await refresh_live_dashboards(bot)
+
+async def on_startup(application: Application):
+    """Запускає фонові задачі після ініціалізації бота"""
+    global live_dashboard_task, leader_task
+    await asyncio.to_thread(purge_expired_sessions)
+    live_dashboard_task = asyncio.create_task(live_dashboard_loop(application.bot))
+    leader_task = asyncio.create_task(leader_watchdog(application))
+
+async def on_shutdown(application: Application):
+    """Зупиняє фонові задачі та звільняє ресурси"""
+    for task in (live_dashboard_task, leader_task):
+        if task is not None:
+            task.cancel()
+    await asyncio.to_thread(session_writer.flush)
+    await close_http_client(application)
+
+# ========== ПОВНОТЕКСТОВИЙ ПОШУК ==========
+
+SEARCH_PAGE_SIZE = 5
+fts_config_cache = None
+
+def get_fts_config(cursor) -> str:
+    """Конфігурація, з якою побудована колонка search_tsv (ukrainian або simple)"""
+    global fts_config_cache
+    if fts_config_cache is None:
+        cursor.execute('''
+            SELECT generation_expression FROM information_schema.columns
+            WHERE table_name = 'messages' AND column_name = 'search_tsv'
+        ''')
+        row = cursor.fetchone()
+        match = re.search(r"'(\w+)'::regconfig", (row or {}).get('generation_expression') or '')
+        fts_config_cache = match.group(1) if match else 'simple'
+    return fts_config_cache
+
+def search_customer_texts(query_text: str, after: Optional[list] = None, limit: int = SEARCH_PAGE_SIZE) -> Tuple[List[Dict], Optional[list]]:
+    """Ранжований пошук по повідомленнях і коментарях швидких замовлень (after - ключ попередньої сторінки)"""
+    logger.debug(f"Виклик search_customer_texts(query_text={query_text}, after={after})")
+    conn = get_db_connection()
+    if not conn:
+        return [], None
+    
+    try:
+        cursor = conn.cursor()
+        fts_config = get_fts_config(cursor)
+        after_rank, after_source, after_id = after if after else (None, None, None)
+        cursor.execute(f'''
+            WITH q AS (
+                SELECT websearch_to_tsquery(%(config)s::regconfig, %(query)s) AS query
+            ),
+            found AS (
+                SELECT 'message' AS source, m.id, m.user_id, m.user_name, m.username,
+                       m.text AS body, {kyiv_time_sql("m.created_at")},
+                       ROUND(ts_rank_cd(m.search_tsv, q.query)::numeric, 6) AS rank
+                FROM messages m, q
+                WHERE m.search_tsv @@ q.query
+                UNION ALL
+                SELECT 'quick' AS source, qo.id, qo.user_id, qo.user_name, qo.username,
+                       qo.message AS body, {kyiv_time_sql("qo.created_at")},
+                       ROUND(ts_rank_cd(qo.search_tsv, q.query)::numeric, 6) AS rank
+                FROM quick_orders qo, q
+                WHERE qo.search_tsv @@ q.query
+            ),
+            page AS (
+                SELECT * FROM found
+                WHERE %(after_rank)s::numeric IS NULL
+                   OR (rank, source, id) < (%(after_rank)s::numeric, %(after_source)s::text, %(after_id)s::integer)
+                ORDER BY rank DESC, source DESC, id DESC
+                LIMIT %(limit)s
+            )
+            SELECT page.*,
+                   ts_headline(%(config)s::regconfig, page.body, q.query,
+                               'MaxWords=25, MinWords=8, StartSel=«, StopSel=»') AS snippet
+            FROM page, q
+            ORDER BY rank DESC, source DESC, id DESC
+        ''', {
+            "config": fts_config,
+            "query": query_text,
+            "after_rank": after_rank,
+            "after_source": after_source,
+            "after_id": after_id,
+            "limit": limit + 1,
+        })
+        rows = [dict(row) for row in cursor.fetchall()]
+        
+        next_after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_after = [str(last['rank']), last['source'], last['id']]
+        
+        return rows, next_after
+    except Exception as e:
+        logger.error(f"Помилка повнотекстового пошуку: {e}")
+        logger.error(traceback.format_exc())
+        return [], None
+    finally:
+        conn.close()
+
+def format_search_results(query_text: str, rows: List[Dict]) -> str:
+    """Форматує сторінку результатів пошуку"""
+    text = f"🔍 Результати пошуку: {query_text}\n\n"
+    for row in rows:
+        icon = "💬" if row['source'] == 'message' else "⚡"
+        label = "Повідомлення" if row['source'] == 'message' else "Швидке замовлення"
+        text += f"{icon} {label} #{row['id']}\n"
+        text += f"👤 {row.get('user_name') or 'Н/Д'} (@{row.get('username') or 'Н/Д'})\n"
+        text += f"📅 {format_datetime(row.get('created_at'))}\n"
+        text += f"📝 {row.get('snippet') or ''}\n"
+        text += f"{'─'*30}\n"
+    return text
+
+def get_search_results_keyboard(rows: List[Dict], has_more: bool) -> InlineKeyboardMarkup:
+    """Клавіатура з результатами пошуку та переходом на наступну сторінку"""
+    buttons = []
+    for row in rows:
+        if row['source'] == 'message':
+            buttons.append([{"text": f"💬 Повідомлення #{row['id']}", "callback_data": f"message_view_{row['id']}"}])
+        else:
+            buttons.append([{"text": f"⚡ Замовлення №{row['id']}", "callback_data": f"order_view_{row['id']}_quick"}])
+    if has_more:
+        buttons.append([{"text": "➡️ Наступні результати", "callback_data": "admin_messages_search_more"}])
+    buttons.append([{"text": "🔍 Новий пошук", "callback_data": "admin_messages_search"}])
+    buttons.append([{"text": "🔙 Назад", "callback_data": "back_to_messages"}])
+    return create_inline_keyboard(buttons)
+
+# ========== КОЛОНКОВИЙ ЕКСПОРТ ДЛЯ АНАЛІТИКИ ==========
+
+ANALYTICS_BATCH_SIZE = 5000
+
+# Таблиця -> (запит, колонки з типами). Час зберігається в UTC, як у БД
+ANALYTICS_EXPORTS = [
+    ("orders", '''
+        SELECT order_id, user_id, user_name, username, phone, city, np_department,
+               total, status, order_type, created_at
+        FROM orders ORDER BY order_id
+    ''', [
+        ("order_id", "int"), ("user_id", "int"), ("user_name", "text"), ("username", "text"),
+        ("phone", "text"), ("city", "text"), ("np_department", "text"), ("total", "float"),
+        ("status", "category"), ("order_type", "category"), ("created_at", "timestamp"),
+    ]),
+    ("order_items", '''
+        SELECT id, order_id, product_name, quantity, price_per_unit
+        FROM order_items ORDER BY id
+    ''', [
+        ("id", "int"), ("order_id", "int"), ("product_name", "category"),
+        ("quantity", "float"), ("price_per_unit", "float"),
+    ]),
+    ("quick_orders", '''
+        SELECT id, user_id, user_name, username, phone, product_id, product_name, quantity,
+               contact_method, message, status, created_at
+        FROM quick_orders ORDER BY id
+    ''', [
+        ("id", "int"), ("user_id", "int"), ("user_name", "text"), ("username", "text"),
+        ("phone", "text"), ("product_id", "int"), ("product_name", "category"), ("quantity", "float"),
+        ("contact_method", "category"), ("message", "text"), ("status", "category"), ("created_at", "timestamp"),
+    ]),
+    ("messages", '''
+        SELECT id, user_id, user_name, username, text, message_type, created_at
+        FROM messages ORDER BY id
+    ''', [
+        ("id", "int"), ("user_id", "int"), ("user_name", "text"), ("username", "text"),
+        ("text", "text"), ("message_type", "category"), ("created_at", "timestamp"),
+    ]),
+]
+
+def get_arrow_type(kind: str):
+    """Arrow-тип для колонки експорту"""
+    return {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "text": pa.string(),
+        "category": pa.dictionary(pa.int32(), pa.string()),
+        "timestamp": pa.timestamp("us", tz="UTC"),
+    }[kind]
+
+def rows_to_record_batch(rows: list, columns: list, schema):
+    """Перетворює пачку рядків з БД у колонковий RecordBatch"""
+    values = list(zip(*rows))
+    arrays = []
+    for index, (name, kind) in enumerate(columns):
+        if kind == "category":
+            arrays.append(pa.array(values[index], type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values[index], type=get_arrow_type(kind)))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def export_table_to_parquet(conn, table: str, query: str, columns: list) -> Tuple[bytes, int]:
+    """Вивантажує таблицю серверним курсором пачками у Parquet (zstd)"""
+    schema = pa.schema([(name, get_arrow_type(kind)) for name, kind in columns])
+    output = BytesIO()
+    total_rows = 0
+    cursor = conn.cursor(name=f"export_{table}", cursor_factory=psycopg2.extensions.cursor)
+    cursor.itersize = ANALYTICS_BATCH_SIZE
+    try:
+        cursor.execute(query)
+        with pq.ParquetWriter(output, schema, compression="zstd") as writer:
+            while True:
+                rows = cursor.fetchmany(ANALYTICS_BATCH_SIZE)
+                if not rows:
+                    break
+                writer.write_batch(rows_to_record_batch(rows, columns, schema))
+                total_rows += len(rows)
+    finally:
+        cursor.close()
+    return output.getvalue(), total_rows
+
+def generate_analytics_export(progress=None) -> Optional[bytes]:
+    """Генерує zip-архів з Parquet-файлами замовлень, товарів, швидких замовлень та повідомлень"""
+    if not load_pyarrow():
+        logger.warning("⚠️ Експорт Parquet недоступний: pyarrow не встановлено")
+        return None
+    conn = get_db_connection()
+    if not conn:
+        return None
+    
+    try:
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as zf:
+            for index, (table, query, columns) in enumerate(ANALYTICS_EXPORTS, 1):
+                data, rows_count = export_table_to_parquet(conn, table, query, columns)
+                zf.writestr(f"{table}.parquet", data)
+                logger.info(f"✅ Експортовано {table}: {rows_count} рядків, {len(data)} байт")
+                if progress:
+                    progress(index, len(ANALYTICS_EXPORTS))
+        return archive.getvalue()
+    except Exception as e:
+        logger.error(f"Помилка експорту Parquet: {e}")
+        logger.error(traceback.format_exc())
+        return None
+    finally:
+        conn.close()
+
+# ========== ФОНОВА ГЕНЕРАЦІЯ ЗВІТІВ ==========
+
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "600"))
+REPORT_CACHE_MAX_ITEMS = 20
+REPORT_PROGRESS_INTERVAL = 2.0
+
+report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+report_cache = OrderedDict()
+report_cache_lock = threading.Lock()
+report_jobs_in_progress = set()
+report_data_version = 0
+
+# Первинні ключі таблиць, з яких рахується відбиток даних
+REPORT_TABLE_KEYS = {
+    "orders": "order_id",
+    "order_items": "id",
+    "quick_orders": "id",
+    "messages": "id",
+    "users": "user_id",
+}
+
+# Від яких таблиць залежить кожен звіт
+REPORT_WATERMARK_TABLES = {
+    "orders": ("orders", "quick_orders"),
+    "quick": ("quick_orders",),
+    "users": ("users", "orders", "quick_orders", "messages"),
+    "messages": ("messages",),
+    "stats": ("users", "orders", "quick_orders", "messages"),
+    "analytics": ("orders", "order_items", "quick_orders", "messages"),
+}
+
+REPORT_TITLES = {
+    "orders": ("orders_report", "📋 Звіт по замовленнях"),
+    "users": ("users_report", "👥 Звіт по клієнтах"),
+    "quick": ("quick_orders_report", "⚡ Звіт по швидких замовленнях"),
+    "messages": ("messages_report", "💬 Звіт по повідомленнях"),
+    "stats": ("stats_report", "📊 Статистика"),
+    "analytics": ("analytics", "📊 Аналітика (Parquet)"),
+}
+
+# Пари (тип звіту, формат), які генератори справді підтримують
+REPORT_FORMATS = {
+    ("orders", "txt"), ("orders", "csv"),
+    ("users", "txt"),
+    ("quick", "txt"), ("quick", "csv"),
+    ("messages", "txt"), ("messages", "csv"),
+    ("stats", "txt"),
+    ("analytics", "parquet"),
+}
+
+# Розширення файлу для форматів, що не збігаються з назвою формату
+REPORT_FILE_EXTENSIONS = {
+    "parquet": "zip",
+}
+
+def bump_report_data_version():
+    """Позначає зміну даних, яку не видно по кількості рядків (наприклад, статус)"""
+    global report_data_version
+    report_data_version += 1
+
+def get_report_watermark(report_type: str) -> Optional[tuple]:
+    """Повертає дешевий відбиток даних звіту: кількість рядків та максимальні ID"""
+    tables = REPORT_WATERMARK_TABLES.get(report_type)
+    if not tables:
+        return None
+    conn = get_db_connection()
+    if not conn:
+        return None
+    
+    try:
+        cursor = conn.cursor()
+        parts = []
+        for table in tables:
+            key = REPORT_TABLE_KEYS[table]
+            parts.append(f"(SELECT COUNT(*) FROM {table})")
+            parts.append(f"(SELECT COALESCE(MAX({key}), 0) FROM {table})")
+        cursor.execute(f"SELECT ARRAY[{', '.join(parts)}]::BIGINT[] AS watermark")
+        row = cursor.fetchone()
+        return tuple(row['watermark']) + (report_data_version,)
+    except Exception as e:
+        logger.error(f"Помилка отримання відбитку даних звіту: {e}")
+        logger.error(traceback.format_exc())
+        return None
+    finally:
+        conn.close()
+
+def get_cached_report(cache_key) -> Optional[bytes]:
+    """Повертає готовий звіт з кешу, якщо дані не змінились і TTL не минув"""
+    if cache_key is None:
+        return None
+    with report_cache_lock:
+        entry = report_cache.get(cache_key)
+        if not entry:
+            return None
+        created_at, report_data = entry
+        if time.monotonic() - created_at > REPORT_CACHE_TTL:
+            report_cache.pop(cache_key, None)
+            return None
+        report_cache.move_to_end(cache_key)
+        return report_data
+
+def put_cached_report(cache_key, report_data: bytes):
+    """Зберігає звіт у кеш, витісняючи найстаріші записи"""
+    if cache_key is None:
+        return
+    with report_cache_lock:
+        report_cache[cache_key] = (time.monotonic(), report_data)
+        report_cache.move_to_end(cache_key)
+        while len(report_cache) > REPORT_CACHE_MAX_ITEMS:
+            report_cache.popitem(last=False)
+
+def build_report(report_type: str, fmt: str, progress=None) -> Optional[bytes]:
+    """Збирає дані та генерує звіт (виконується у фоновому потоці)"""
+    if report_type == "orders":
+        return generate_orders_report(get_all_orders(include_quick=True), fmt)
+    if report_type == "quick":
+        return generate_quick_orders_report(get_quick_orders(), fmt)
+    if report_type == "users":
+        users = get_all_users()
+        return generate_users_report(users, progress) if users else None
+    if report_type == "messages":
+        messages = get_all_messages(limit=1000)
+        return generate_messages_report(messages, fmt) if messages else None
+    if report_type == "stats":
+        return generate_stats_report(get_statistics(), fmt)
+    if report_type == "analytics":
+        return generate_analytics_export(progress)
+    return None
+
+def format_report_progress(caption: str, progress: dict, elapsed: float) -> str:
+    """Текст повідомлення з прогресом генерації звіту"""
+    text = f"⏳ Генерую звіт...\n\n{caption}\n"
+    if progress.get("total"):
+        percent = progress["done"] * 100 // progress["total"]
+        text += f"Оброблено: {progress['done']} з {progress['total']} ({percent}%)\n"
+    text += f"⏱ Минуло: {int(elapsed)} с"
+    return text
+
+async def run_report_job(bot: Bot, chat_id: int, message_id: int, report_type: str, fmt: str,
+                         filename: str, caption: str, reply_markup: InlineKeyboardMarkup = None):
+    """Генерує звіт у фоні та оновлює одне повідомлення з прогресом"""
+    job_key = (chat_id, report_type, fmt)
+    if job_key in report_jobs_in_progress:
+        await bot.edit_message_text("⏳ Цей звіт вже генерується, зачекайте...", chat_id=chat_id, message_id=message_id)
+        return
+    report_jobs_in_progress.add(job_key)
+    started = time.monotonic()
+    
+    try:
+        loop = asyncio.get_running_loop()
+        watermark = await loop.run_in_executor(report_executor, get_report_watermark, report_type)
+        cache_key = (report_type, fmt, watermark) if watermark is not None else None
+        report_data = get_cached_report(cache_key)
+        
+        if report_data is not None:
+            logger.info(f"✅ Звіт {report_type}/{fmt} взято з кешу")
+        else:
+            progress = {"done": 0, "total": 0}
+            
+            def on_progress(done: int, total: int):
+                progress["done"] = done
+                progress["total"] = total
+            
+            future = loop.run_in_executor(report_executor, build_report, report_type, fmt, on_progress)
+            last_text = None
+            while True:
+                done, _ = await asyncio.wait({future}, timeout=REPORT_PROGRESS_INTERVAL)
+                if done:
+                    break
+                text = format_report_progress(caption, progress, time.monotonic() - started)
+                if text != last_text:
+                    try:
+                        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+                        last_text = text
+                    except Exception as e:
+                        logger.debug(f"Не вдалося оновити прогрес звіту: {e}")
+            report_data = future.result()
+            if report_data:
+                put_cached_report(cache_key, report_data)
+            logger.info(f"✅ Звіт {report_type}/{fmt} згенеровано за {time.monotonic() - started:.1f} с")
+        
+        if not report_data:
+            await bot.edit_message_text("❌ Немає даних для звіту", chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+            return
+        
+        await bot.send_document(
+            chat_id=chat_id,
+            document=report_data,
+            filename=f"{filename}_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.{REPORT_FILE_EXTENSIONS.get(fmt, fmt)}",
+            caption=caption
+        )
+        await bot.edit_message_text("✅ Звіт згенеровано!", chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Помилка генерації звіту {report_type}/{fmt}: {e}")
+        logger.error(traceback.format_exc())
+        try:
+            await bot.edit_message_text("❌ Помилка генерації звіту", chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+        except Exception:
+            pass
+    finally:
+        report_jobs_in_progress.discard(job_key)
+
+async def start_report_job(query, context: ContextTypes.DEFAULT_TYPE, report_type: str, fmt: str,
+                           filename: str, caption: str, reply_markup: InlineKeyboardMarkup = None):
+    """Ставить звіт у чергу і одразу звільняє обробник"""
+    await query.edit_message_text(f"⏳ Генерую звіт...\n\n{caption}\n\nМожна продовжувати роботу, файл прийде окремим повідомленням.")
+    context.application.create_task(
+        run_report_job(context.bot, query.message.chat_id, query.message.message_id,
+                       report_type, fmt, filename, caption, reply_markup)
+    )
+
 def create_inline_keyboard(buttons: List[List[Dict]]) -> InlineKeyboardMarkup:
     """Створює Inline клавіатуру"""
     keyboard = []
@@ -2390,6 +4003,32 @@ def create_inline_keyboard(buttons: List[List[Dict]]) -> InlineKeyboardMarkup:
         keyboard.append(keyboard_row)
     return InlineKeyboardMarkup(keyboard)
 
+# ========== КЕШ КЛАВІАТУР ==========
+
+markup_cache: Dict[str, InlineKeyboardMarkup] = {}
+static_menu_builders = []
+
+def cached_markup(name: str):
+    """Декоратор: статичне меню будується один раз, далі віддається з кешу"""
+    def decorator(builder):
+        @functools.wraps(builder)
+        def wrapper() -> InlineKeyboardMarkup:
+            markup = markup_cache.get(name)
+            if markup is None:
+                markup = builder()
+                markup_cache[name] = markup
+            return markup
+        static_menu_builders.append(wrapper)
+        return wrapper
+    return decorator
+
+def warm_markup_cache():
+    """Будує всі статичні меню під час запуску"""
+    for builder in static_menu_builders:
+        builder()
+    logger.info(f"✅ Клавіатури підготовлено: {len(markup_cache)}")
+
+@cached_markup("main_menu")
 def get_main_menu():
     """Головне меню адмін-панелі"""
     keyboard = [
@@ -2410,11 +4049,13 @@ def get_main_menu():
     ]
     return create_inline_keyboard(keyboard)
 
+@functools.lru_cache(maxsize=128)
 def get_back_keyboard(back_to: str) -> InlineKeyboardMarkup:
     """Клавіатура з кнопкою Назад"""
     buttons = [[{"text": "🔙 Назад", "callback_data": f"back_to_{back_to}"}]]
     return create_inline_keyboard(buttons)
 
+@cached_markup("products")
 def get_products_menu():
     """Меню керування товарами"""
     keyboard = [
@@ -2426,6 +4067,7 @@ def get_products_menu():
     ]
     return create_inline_keyboard(keyboard)
 
+@cached_markup("orders")
 def get_orders_menu():
     """Меню керування замовленнями"""
     keyboard = [
@@ -2438,6 +4080,7 @@ def get_orders_menu():
     ]
     return create_inline_keyboard(keyboard)
 
+@cached_markup("customers")
 def get_customers_menu():
     """Меню керування клієнтами"""
     keyboard = [
@@ -2452,16 +4095,19 @@ def get_customers_menu():
     ]
     return create_inline_keyboard(keyboard)
 
+@cached_markup("messages")
 def get_messages_menu():
     """Меню керування повідомленнями"""
     keyboard = [
         [{"text": "📋 Останні повідомлення", "callback_data": "admin_messages_recent"}],
         [{"text": "📋 Всі повідомлення", "callback_data": "admin_messages_all"}],
+        [{"text": "🔍 Пошук по тексту", "callback_data": "admin_messages_search"}],
         [{"text": "📁 Всі повідомлення файлом", "callback_data": "messages_all_file"}],
         [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
     ]
     return create_inline_keyboard(keyboard)
 
+@cached_markup("broadcast")
 def get_broadcast_menu():
     """Меню розсилок"""
     keyboard = [
@@ -2474,11 +4120,13 @@ def get_broadcast_menu():
     ]
     return create_inline_keyboard(keyboard)
 
+@cached_markup("broadcast_input_back")
 def get_broadcast_input_back_keyboard() -> InlineKeyboardMarkup:
     """Клавіатура для повернення з розсилки"""
     buttons = [[{"text": "🔙 Назад", "callback_data": "back_to_broadcast"}]]
     return create_inline_keyboard(buttons)
 
+@cached_markup("reports")
 def get_reports_menu():
     """Меню звітів"""
     keyboard = [
@@ -2491,10 +4139,12 @@ def get_reports_menu():
         [{"text": "💬 Повідомлення (TXT)", "callback_data": "report_messages_txt"}],
         [{"text": "💬 Повідомлення (CSV)", "callback_data": "report_messages_csv"}],
         [{"text": "📊 Статистика (TXT)", "callback_data": "report_stats_txt"}],
+        [{"text": "📊 Аналітика (Parquet)", "callback_data": "report_analytics_parquet"}],
         [{"text": "🔙 Назад", "callback_data": "back_to_main"}]
     ]
     return create_inline_keyboard(keyboard)
 
+@cached_markup("admins")
 def get_admins_menu():
     """Меню керування адмінами"""
     keyboard = [
@@ -2505,6 +4155,7 @@ def get_admins_menu():
     ]
     return create_inline_keyboard(keyboard)
 
+@cached_markup("settings")
 def get_settings_menu():
     """Меню налаштувань"""
     keyboard = [
@@ -2515,6 +4166,7 @@ def get_settings_menu():
 
 # ========== МЕНЮ ДЛЯ РЕДАГУВАННЯ КОМПАНІЇ ==========
 
+@cached_markup("company_edit")
 def get_company_edit_menu() -> InlineKeyboardMarkup:
     """Меню редагування інформації про компанію"""
     buttons = [
@@ -2526,6 +4178,7 @@ def get_company_edit_menu() -> InlineKeyboardMarkup:
 
 # ========== МЕНЮ ДЛЯ РЕДАГУВАННЯ ВІТАННЯ ==========
 
+@cached_markup("welcome_edit")
 def get_welcome_edit_menu() -> InlineKeyboardMarkup:
     """Меню редагування вітального повідомлення"""
     buttons = [
@@ -2537,6 +4190,7 @@ def get_welcome_edit_menu() -> InlineKeyboardMarkup:
 
 # ========== НОВЕ МЕНЮ ДЛЯ РЕДАГУВАННЯ FAQ ==========
 
+@cached_markup("faq_edit_main")
 def get_faq_edit_main_menu() -> InlineKeyboardMarkup:
     """Головне меню редагування FAQ"""
     buttons = [
@@ -3050,7 +4704,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.edit_message_text(f"❌ Помилка: товар з ID {product_id} не знайдено", reply_markup=get_products_menu())
                 return
             
-            if update_product(product_id, image_data=None):
+            if update_product(product_id, image_data=None, image_hash=None):
                 await query.edit_message_text(
                     f"✅ Фото товару #{product_id} видалено!",
                     reply_markup=get_back_keyboard(f"edit_product_{product_id}")
@@ -3113,7 +4767,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             if field == "image":
                 product = get_product_by_id(product_id)
-                has_image = product and product.get('image_data') is not None
+                has_image = bool(product and product.get('has_image'))
                 admin_sessions[user_id] = {"state": "authenticated", "action": "edit_product_image", "product_id": product_id}
                 await query.edit_message_text(
                     "📷 Виберіть спосіб завантаження фото:",
@@ -3312,7 +4966,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 text = f"🆕 Нові замовлення\n\nВсього: {len(orders)}\n\n"
                 for order in orders[:10]:
-                    text += f"№{order['order_id']} | {order['created_at'][:16]}\n"
+                    text += f"№{order['order_id']} | {format_datetime(order.get('created_at'))}\n"
                     text += f"Клієнт: {order['user_name']}\n"
                     text += f"Сума: {order.get('total', 0):.2f} грн\n"
                     text += f"Телефон: {order['phone']}\n"
@@ -3328,7 +4982,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 text = f"⚡ Швидкі замовлення\n\nВсього: {len(orders)}\n\n"
                 for order in orders[:10]:
-                    text += f"⚡ №{order['id']} | {order['created_at'][:16]}\n"
+                    text += f"⚡ №{order['id']} | {format_datetime(order.get('created_at'))}\n"
                     text += f"Клієнт: {order['user_name']}\n"
                     text += f"Телефон: {order['phone']}\n"
                     text += f"Продукт: {order['product_name']}\n"
@@ -3341,7 +4995,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif data == "admin_order_by_phone":
             admin_sessions[user_id] = {"state": "authenticated", "action": "search_orders_by_phone"}
-            await query.edit_message_text("📞 Пошук замовлень за телефоном\n\nВведіть номер телефону клієнта:", reply_markup=get_back_keyboard("orders"))
+            await query.edit_message_text("📞 Пошук замовлень за телефоном\n\nВведіть номер телефону клієнта або його частину (мінімум 3 цифри):", reply_markup=get_back_keyboard("orders"))
             return
         
         elif data.startswith("order_view_"):
@@ -3364,7 +5018,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             text = f"📋 ЗАМОВЛЕННЯ №{order_id}\n\n"
-            text += f"📅 Дата: {order['created_at']}\n"
+            text += f"📅 Дата: {format_datetime(order.get('created_at'), '%Y-%m-%d %H:%M:%S')}\n"
             text += f"👤 Клієнт: {order['user_name']}\n"
             text += f"📞 Телефон: {order['phone']}\n"
             text += f"📱 Username: @{order['username']}\n"
@@ -3578,7 +5232,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             for msg in recent_messages:
                 text += f"💬 <b>Повідомлення #{msg['id']}</b>\n"
                 text += f"👤 Клієнт: {msg['user_name']} (@{msg['username']})\n"
-                text += f"📅 Час: {msg['created_at'][:16]}\n"
+                text += f"📅 Час: {format_datetime(msg.get('created_at'))}\n"
                 text += f"📝 {msg['text'][:100]}{'...' if len(msg['text']) > 100 else ''}\n"
                 text += f"{'─'*40}\n"
             
@@ -3596,7 +5250,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             for msg in more_messages:
                 text += f"💬 <b>Повідомлення #{msg['id']}</b>\n"
                 text += f"👤 Клієнт: {msg['user_name']} (@{msg['username']})\n"
-                text += f"📅 Час: {msg['created_at'][:16]}\n"
+                text += f"📅 Час: {format_datetime(msg.get('created_at'))}\n"
                 text += f"📝 {msg['text'][:100]}{'...' if len(msg['text']) > 100 else ''}\n"
                 text += f"{'─'*40}\n"
             
@@ -3615,7 +5269,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 for msg in messages:
                     text += f"💬 <b>Повідомлення #{msg['id']}</b>\n"
                     text += f"👤 Клієнт: {msg['user_name']} (@{msg['username']})\n"
-                    text += f"📅 Час: {msg['created_at'][:16]}\n"
+                    text += f"📅 Час: {format_datetime(msg.get('created_at'))}\n"
                     text += f"📝 {msg['text'][:100]}{'...' if len(msg['text']) > 100 else ''}\n"
                     text += f"{'─'*40}\n"
             
@@ -3625,6 +5279,32 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(text, reply_markup=get_messages_pagination_keyboard(user_id, has_more), parse_mode='HTML')
             return
         
+        elif data == "admin_messages_search":
+            admin_sessions[user_id] = {"state": "authenticated", "action": "search_messages"}
+            await query.edit_message_text(
+                "🔍 Пошук по повідомленнях та коментарях швидких замовлень\n\n"
+                "Введіть слова для пошуку (можна \"фразу в лапках\" або -виключення):",
+                reply_markup=get_back_keyboard("messages")
+            )
+            return
+        
+        elif data == "admin_messages_search_more":
+            session = admin_sessions.get(user_id, {})
+            search_query = session.get("search_query")
+            if not search_query or not session.get("search_after"):
+                await query.edit_message_text("🔍 Більше результатів немає", reply_markup=get_messages_menu())
+                return
+            rows, next_after = search_customer_texts(search_query, session["search_after"])
+            if not rows:
+                await query.edit_message_text("🔍 Більше результатів немає", reply_markup=get_messages_menu())
+                return
+            session["search_after"] = next_after
+            await query.edit_message_text(
+                format_search_results(search_query, rows),
+                reply_markup=get_search_results_keyboard(rows, next_after is not None)
+            )
+            return
+        
         elif data == "admin_messages_details":
             messages = get_all_messages(limit=50)
             if not messages:
@@ -3634,7 +5314,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             for msg in messages[:20]:
                 user_name = msg['user_name']
                 msg_id = msg['id']
-                created_at = msg['created_at'][:16] if msg['created_at'] else 'Н/Д'
+                created_at = format_datetime(msg.get('created_at'))
                 text_preview = msg['text'][:30] + ('...' if len(msg['text']) > 30 else '')
                 keyboard.append([InlineKeyboardButton(
                     f"💬 #{msg_id} - {user_name} - {created_at}\n📝 {text_preview}", 
@@ -3695,17 +5375,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         elif data == "messages_all_file":
-            messages = get_all_messages(limit=1000)
-            if not messages:
-                await query.edit_message_text("💬 Повідомлень поки немає", reply_markup=get_back_keyboard("messages"))
-                return
-            file_data = generate_messages_report(messages, "txt")
-            await query.message.reply_document(
-                document=file_data,
-                filename=f"all_messages_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.txt",
-                caption="💬 Всі повідомлення користувачів"
-            )
-            await query.edit_message_text("✅ Файл з повідомленнями згенеровано!", reply_markup=get_back_keyboard("messages"))
+            await start_report_job(query, context, "messages", "txt", "all_messages",
+                                   "💬 Всі повідомлення користувачів", get_back_keyboard("messages"))
             return
         
         elif data == "admin_customers":
@@ -3803,8 +5474,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     count += 1
                     last_order_date = "Немає"
                     if all_orders:
-                        last_order = all_orders[0].get('created_at', '')
-                        last_order_date = last_order[:16]
+                        last_order_date = format_datetime(all_orders[0].get('created_at'))
                     text += f"ID: {user['user_id']}\nІм'я: {user['first_name']} {user['last_name']}\nUsername: @{user['username']}\nОстаннє замовлення: {last_order_date}\n{'─'*30}\n"
             if count == 0:
                 text = "💤 Неактивних клієнтів не знайдено"
@@ -3813,23 +5483,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         elif data == "export_customers":
-            users = get_all_users()
-            if not users:
-                await query.edit_message_text("❌ Немає клієнтів для експорту", reply_markup=get_customers_menu())
-                return
-            
-            file_data = generate_users_report(users)
-            await query.message.reply_document(
-                document=file_data,
-                filename=f"customers_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.txt",
-                caption="👥 Повний звіт по клієнтах"
-            )
-            await query.edit_message_text("✅ Файл з клієнтами згенеровано!", reply_markup=get_customers_menu())
+            await start_report_job(query, context, "users", "txt", "customers",
+                                   "👥 Повний звіт по клієнтах", get_customers_menu())
             return
         
         elif data == "admin_customer_search":
             admin_sessions[user_id] = {"state": "authenticated", "action": "search_customer_by_phone"}
-            await query.edit_message_text("🔍 Пошук клієнта за телефоном\n\nВведіть номер телефону:", reply_markup=get_back_keyboard("customers"))
+            await query.edit_message_text("🔍 Пошук клієнта за телефоном\n\nВведіть номер телефону або його частину (мінімум 3 цифри):", reply_markup=get_back_keyboard("customers"))
             return
         
         elif data.startswith("customer_view_"):
@@ -3858,7 +5518,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text += f"ID: {user['user_id']}\n"
             text += f"Ім'я: {user['first_name']} {user['last_name']}\n"
             text += f"Username: @{user['username']}\n"
-            text += f"📅 Реєстрація: {user.get('created_at', 'Н/Д')[:16]}\n"
+            text += f"📅 Реєстрація: {format_datetime(user.get('created_at'))}\n"
             text += f"📊 Сегмент: {segment}\n\n"
             
             if all_orders:
@@ -3870,7 +5530,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 text += "🆕 Останнє замовлення:\n"
                 last = all_orders[0]
-                last_created = last.get('created_at', '')[:16]
+                last_created = format_datetime(last.get('created_at'))
                 last_id = last.get('order_id', last.get('id', 'Н/Д'))
                 text += f"   №{last_id} від {last_created}\n"
                 text += f"   Сума: {last.get('total', 0):.2f} грн\n"
@@ -3908,7 +5568,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 text = f"📋 ІСТОРІЯ ЗАМОВЛЕНЬ\n\nВсього: {len(all_orders)}\n\n"
                 for order in all_orders:
-                    created_at = order.get('created_at', '')[:16]
+                    created_at = format_datetime(order.get('created_at'))
                     order_id = order.get('order_id', order.get('id', 'Н/Д'))
                     order_type = "⚡" if order.get('order_type') == 'quick' else "📦"
                     text += f"{order_type} №{order_id} | {created_at}\n"
@@ -3941,7 +5601,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 text = f"💬 ПОВІДОМЛЕННЯ КЛІЄНТА\n\n"
                 for msg in messages[:10]:
-                    created_at = msg.get('created_at', '')[:16]
+                    created_at = format_datetime(msg.get('created_at'))
                     text += f"📅 {created_at}\n"
                     text += f"📝 {msg['text']}\n"
                     text += f"{'─'*30}\n"
@@ -4004,96 +5664,22 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("📁 Генерація звітів\n\nОберіть тип звіту та формат:", reply_markup=get_reports_menu())
             return
         
-        elif data == "report_orders_txt":
-            orders = get_all_orders(include_quick=True)
-            report_data = generate_orders_report(orders, "txt")
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"orders_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.txt",
-                caption="📋 Звіт по замовленнях"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
-            return
-        
-        elif data == "report_orders_csv":
-            orders = get_all_orders(include_quick=True)
-            report_data = generate_orders_report(orders, "csv")
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"orders_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.csv",
-                caption="📋 Звіт по замовленнях (CSV)"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
-            return
-        
-        elif data == "report_users_txt":
-            users = get_all_users()
-            report_data = generate_users_report(users)
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"users_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.txt",
-                caption="👥 Звіт по клієнтах"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
-            return
-        
         elif data == "report_users_csv":
             await query.edit_message_text("Функція в розробці, використовуйте TXT формат", reply_markup=get_reports_menu())
             return
         
-        elif data == "report_quick_txt":
-            orders = get_quick_orders()
-            report_data = generate_quick_orders_report(orders, "txt")
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"quick_orders_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.txt",
-                caption="⚡ Звіт по швидких замовленнях"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
-            return
-        
-        elif data == "report_quick_csv":
-            orders = get_quick_orders()
-            report_data = generate_quick_orders_report(orders, "csv")
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"quick_orders_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.csv",
-                caption="⚡ Звіт по швидких замовленнях (CSV)"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
-            return
-        
-        elif data == "report_messages_txt":
-            messages = get_all_messages(limit=1000)
-            report_data = generate_messages_report(messages, "txt")
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"messages_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.txt",
-                caption="💬 Звіт по повідомленнях"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
-            return
-        
-        elif data == "report_messages_csv":
-            messages = get_all_messages(limit=1000)
-            report_data = generate_messages_report(messages, "csv")
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"messages_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.csv",
-                caption="💬 Звіт по повідомленнях (CSV)"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
-            return
-        
-        elif data == "report_stats_txt":
-            stats = get_statistics()
-            report_data = generate_stats_report(stats, "txt")
-            await query.message.reply_document(
-                document=report_data,
-                filename=f"stats_report_{get_kyiv_time().strftime('%Y%m%d_%H%M%S')}.txt",
-                caption="📊 Статистика"
-            )
-            await query.edit_message_text("✅ Звіт згенеровано!", reply_markup=get_reports_menu())
+        elif data.startswith("report_"):
+            report_type, _, fmt = data[len("report_"):].rpartition("_")
+            if (report_type, fmt) not in REPORT_FORMATS:
+                await query.edit_message_text("❌ Невідомий тип звіту", reply_markup=get_reports_menu())
+                return
+            if fmt == "parquet" and not load_pyarrow():
+                await query.edit_message_text("⚠️ Експорт Parquet недоступний: бібліотека pyarrow не встановлена", reply_markup=get_reports_menu())
+                return
+            filename, caption = REPORT_TITLES[report_type]
+            if fmt == "csv":
+                caption += " (CSV)"
+            await start_report_job(query, context, report_type, fmt, filename, caption, get_reports_menu())
             return
         
         elif data == "admin_manage_admins":
@@ -4107,7 +5693,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 text = "📋 СПИСОК АДМІНІСТРАТОРІВ\n\n"
                 for admin in admins:
-                    added_at = admin.get('added_at', '')[:16]
+                    added_at = format_datetime(admin.get('added_at'))
                     text += f"ID: {admin['user_id']}\nUsername: @{admin['username']}\nДодано: {added_at}\n{'─'*30}\n"
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
             await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
@@ -4165,6 +5751,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text += "📊 Замовлення за останні 30 днів:\n"
             text += f"   Кількість: {stats.get('last_30_days_orders', 0)}\n"
             text += f"   Сума: {stats.get('last_30_days_revenue', 0):.2f} грн\n\n"
+            daily_trend = stats.get('daily_trend', [])
+            if daily_trend:
+                peak = max(day['orders'] for day in daily_trend)
+                text += f"📈 Замовлення за {len(daily_trend)} днів (макс. {peak} на день):\n"
+                text += f"   {sparkline([day['orders'] for day in daily_trend])}\n\n"
             text += "📊 Статуси замовлень:\n"
             for status, count in stats.get('orders_by_status', {}).items():
                 text += f"   • {status}: {count}\n"
@@ -4175,10 +5766,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text += f"   🆕 Нові: {segments.get('new', 0)}\n"
             text += f"   📊 Активні: {segments.get('active', 0)}\n"
             text += f"   💤 Неактивні: {segments.get('inactive', 0)}\n"
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
+            keyboard = [
+                [InlineKeyboardButton("📡 Живий режим", callback_data="admin_stats_live")],
+                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+            ]
             await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
             return
         
+        elif data == "admin_stats_live":
+            await start_live_dashboard(context.bot, query.message.chat_id)
+            return
+        
+        elif data == "admin_stats_live_stop":
+            if query.message.chat_id in live_dashboards:
+                await stop_live_dashboard(context.bot, query.message.chat_id)
+            else:
+                # Дашборд, відкритий до перезапуску бота
+                await query.edit_message_reply_markup(reply_markup=None)
+            return
+        
         elif data == "admin_settings":
             await query.edit_message_text("⚙️ Налаштування\n\nОберіть розділ:", reply_markup=get_settings_menu())
             return
@@ -4426,26 +6032,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 admin_sessions[user_id].pop("action", None)
                 return
             
-            # Завантажуємо зображення за URL
-            image_bytes = await download_image_from_url_to_bytes(text)
-            
-            if image_bytes:
-                # Оновлюємо товар в БД - зберігаємо байти
-                if update_product(product_id, image_data=image_bytes):
-                    await update.message.reply_text(
-                        f"✅ Фото товару #{product_id} оновлено! (збережено в БД)", 
-                        reply_markup=get_products_menu()
-                    )
-                else:
-                    await update.message.reply_text(
-                        "❌ Помилка при оновленні фото в базі даних", 
-                        reply_markup=get_products_menu()
-                    )
-            else:
-                await update.message.reply_text(
-                    "❌ Помилка при завантаженні зображення за URL. Перевірте посилання та спробуйте ще раз.", 
-                    reply_markup=get_products_menu()
-                )
+            # Завантаження йде окремою задачею, щоб не затримувати обробку інших оновлень
+            await update.message.reply_text("⏰ Завантажую зображення...")
+            context.application.create_task(
+                save_product_image_from_url(context.bot, update.effective_chat.id, product_id, text.strip()),
+                update=update
+            )
             
             admin_sessions[user_id].pop("action", None)
             return
@@ -4469,10 +6061,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 # Завантажуємо фото в пам'ять як байти
                 image_bytes = await download_telegram_file_to_bytes(file_id, context.bot)
+                image = await prepare_product_image(image_bytes) if image_bytes else None
                 
-                if image_bytes:
-                    # Оновлюємо товар в БД - зберігаємо байти
-                    if update_product(product_id, image_data=image_bytes):
+                if image:
+                    # Оновлюємо товар в БД - зберігаємо нормалізоване фото
+                    if save_product_image(product_id, *image):
                         await update.message.reply_text(
                             f"✅ Фото товару #{product_id} оновлено! (збережено в БД)", 
                             reply_markup=get_products_menu()
@@ -4529,6 +6122,21 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             admin_sessions[user_id].pop("action", None)
             return
         
+        elif action == "search_messages":
+            rows, next_after = search_customer_texts(text)
+            if not rows:
+                await update.message.reply_text(f"🔍 За запитом \"{text}\" нічого не знайдено", reply_markup=get_messages_menu())
+                admin_sessions[user_id].pop("action", None)
+                return
+            admin_sessions[user_id]["search_query"] = text
+            admin_sessions[user_id]["search_after"] = next_after
+            await update.message.reply_text(
+                format_search_results(text, rows),
+                reply_markup=get_search_results_keyboard(rows, next_after is not None)
+            )
+            admin_sessions[user_id].pop("action", None)
+            return
+        
         elif action == "search_orders_by_phone":
             orders = get_orders_by_phone(text)
             if not orders:
@@ -4536,7 +6144,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 response = f"📋 Знайдено замовлень: {len(orders)}\n\n"
                 for order in orders[:5]:
-                    created_at = order.get('created_at', '')[:16]
+                    created_at = format_datetime(order.get('created_at'))
                     order_id = order.get('order_id', order.get('id', 'Н/Д'))
                     response += f"№{order_id} | {created_at}\n"
                     response += f"Сума: {order.get('total', 0):.2f} грн\n"
@@ -4568,7 +6176,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 response += f"ID: {user_data['user_id']}\n"
                 response += f"Ім'я: {user_data['first_name']} {user_data['last_name']}\n"
                 response += f"Username: @{user_data['username']}\n"
-                response += f"📅 Реєстрація: {user_data.get('created_at', '')[:16]}\n"
+                response += f"📅 Реєстрація: {format_datetime(user_data.get('created_at'))}\n"
                 response += f"📊 Сегмент: {segment}\n"
                 response += f"📦 Замовлень: {len(all_orders)}\n\n"
                 
@@ -4875,83 +6483,93 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обробник помилок"""
     try:
         if isinstance(context.error, Conflict):
-            logger.error("❌ Конфлікт з іншим екземпляром бота! Переконайтеся, що запущено тільки один екземпляр.")
+            logger.error("❌ Конфлікт з іншим екземпляром бота! getUpdates викликає процес поза вибором лідера.")
             return
         
         logger.error(f"Помилка: {context.error}")
     except Exception as e:
         logger.error(f"Помилка в обробнику помилок: {e}")
 
+# ========== ЗАПУСК ==========
+
+class StartupTimer:
+    """Тривалість фаз запуску для звіту в лог"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.lock = threading.Lock()
+    
+    def run(self, name: str, func, *args):
+        """Виконує фазу і записує її тривалість"""
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.phases.append((name, time.perf_counter() - started))
+    
+    def report(self):
+        total = time.perf_counter() - self.started
+        details = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.phases)
+        logger.info(f"⏱️ Запуск за {total * 1000:.0f} мс: {details}")
+
+def build_application() -> Application:
+    """Створює застосунок з усіма обробниками"""
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    application.add_handler(MessageHandler(filters.PHOTO, message_handler))
+    application.add_error_handler(error_handler)
+    return application
+
 def main():
     """Головна функція запуску бота"""
+    setup_logging()
     logger.info("=" * 80)
     logger.info("🚀 ЗАПУСК АДМІН-БОТА БОНЕЛЕТ")
+    logger.info(f"✅ ADMIN_BOT_TOKEN отримано: {TOKEN[:10]}...")
+    logger.info(f"✅ MAIN_BOT_TOKEN отримано: {MAIN_BOT_TOKEN[:10]}...")
+    logger.info(f"✅ ADMIN_PASSWORD конфігуровано: {'так' if ADMIN_PASSWORD else 'ні'}")
+    logger.info(f"✅ ADMIN_IDS: {ADMIN_IDS}")
+    logger.info(f"✅ DATABASE_URL отримано: {DATABASE_URL[:20]}...")
     logger.info("=" * 80)
     
-    # Тимчасово вимикаємо перевірку на унікальний екземпляр через конфлікти на Railway
-    # if not check_single_instance():
-    #     logger.error("🚫 Бот вже запущено в іншому процесі! Завершуємо...")
-    #     sys.exit(1)
-    
     try:
-        conn = get_db_connection()
-        if conn:
-            logger.info(f"✅ Підключення до бази даних успішне")
-            logger.info("🔄 Викликаю init_database_if_empty()...")
-            init_result = init_database_if_empty()
-            logger.info(f"📊 Результат ініціалізації: {init_result}")
-            
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM users")
-                users_count = cursor.fetchone()['count']
-                cursor.execute("SELECT COUNT(*) FROM orders")
-                orders_count = cursor.fetchone()['count']
-                cursor.execute("SELECT COUNT(*) FROM products")
-                products_count = cursor.fetchone()['count']
-                cursor.execute("SELECT COUNT(*) FROM quick_orders")
-                quick_orders_count = cursor.fetchone()['count']
-                cursor.execute("SELECT COUNT(*) FROM messages")
-                messages_count = cursor.fetchone()['count']
-                cursor.execute("SELECT COUNT(*) FROM faq")
-                faq_count = cursor.fetchone()['count']
-                cursor.execute("SELECT COUNT(*) FROM admins")
-                admins_count = cursor.fetchone()['count']
-                
-                logger.info(f"📊 Статистика БД:")
-                logger.info(f"   • Користувачів: {users_count}")
-                logger.info(f"   • Замовлень: {orders_count}")
-                logger.info(f"   • Швидких замовлень: {quick_orders_count}")
-                logger.info(f"   • Товарів: {products_count}")
-                logger.info(f"   • Повідомлень: {messages_count}")
-                logger.info(f"   • FAQ: {faq_count}")
-                logger.info(f"   • Адмінів: {admins_count}")
-                
-            except Exception as e:
-                logger.error(f"❌ Помилка отримання статистики: {e}")
-                logger.error(traceback.format_exc())
-            
-            conn.close()
-        else:
-            logger.warning("⚠️ Не вдалося підключитись до БД")
-            init_database_if_empty()
-        
-        application = Application.builder().token(TOKEN).build()
-        
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-        application.add_handler(MessageHandler(filters.PHOTO, message_handler))
-        application.add_error_handler(error_handler)
-        
+        timer = StartupTimer()
+        if not timer.run("міграції", run_migrations):
+            logger.error("❌ Не вдалося ініціалізувати базу даних")
+            # Ненульовий код, щоб платформа перезапустила процес (restartPolicy ON_FAILURE)
+            sys.exit(1)
+        
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        timer.run("клавіатури", warm_markup_cache)
+        threading.Thread(target=listen_for_activity, name="activity-listener", daemon=True).start()
+        timer.report()
         logger.info("✅ Адмін-бот готовий до роботи")
-        logger.info("🚀 Запуск polling...")
-        application.run_polling(drop_pending_updates=True)
+        while True:
+            leader.wait_for_leadership()
+            application = build_application()
+            logger.info("🚀 Запуск polling...")
+            application.run_polling(drop_pending_updates=True, close_loop=False)
+            if not leader.lost:
+                break
+            logger.warning("🔄 Екземпляр повертається в резерв")
+        leader.release()
         
     except Exception as e:
         logger.error(f"❌ Критична помилка: {e}")
         logger.error(traceback.format_exc())
         time.sleep(5)
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
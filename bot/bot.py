@@ -4,18 +4,34 @@ import re
 import logging
 import sys
 import time
+import uuid
+import select
+import threading
+import functools
+import hashlib
+import mmap
+import multiprocessing
+import httpx
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json, execute_batch
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import asyncio
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Bot
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes
 )
@@ -53,172 +69,347 @@ def get_db_connection():
         logger.error(f"❌ Помилка підключення до БД: {e}")
         return None
 
-def init_database():
-    conn = get_db_connection()
-    if not conn:
-        return False
+# ========== МІГРАЦІЇ СХЕМИ ==========
+
+# Схема змінюється лише нумерованими міграціями з MIGRATIONS: застосовані версії
+# записуються в schema_migrations, нова зміна схеми - це нова міграція в кінці списку
+# Регулярне обслуговування (партиції, невикористані фото) сюди не входить - його виконує retention_sweeper
+SCHEMA_COMPONENT = "bot"
+SCHEMA_MIGRATIONS_LOCK_ID = 7310000
+
+def migration_001_baseline(cursor):
+    """Базова схема: таблиці, індекси, тригери та початковий контент"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     
-    try:
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id BIGINT PRIMARY KEY,
-                state TEXT DEFAULT '',
-                temp_data TEXT DEFAULT '{}',
-                last_section TEXT DEFAULT 'main_menu',
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS carts (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                product_id INTEGER,
-                quantity REAL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                order_id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                user_name TEXT,
-                username TEXT,
-                phone TEXT,
-                city TEXT,
-                np_department TEXT,
-                total REAL,
-                status TEXT DEFAULT 'нове',
-                order_type TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS order_items (
-                id SERIAL PRIMARY KEY,
-                order_id INTEGER,
-                product_name TEXT,
-                quantity REAL,
-                price_per_unit REAL
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                user_name TEXT,
-                username TEXT,
-                text TEXT,
-                message_type TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS quick_orders (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                user_name TEXT,
-                username TEXT,
-                phone TEXT,
-                product_id INTEGER,
-                product_name TEXT,
-                quantity REAL,
-                contact_method TEXT,
-                message TEXT,
-                status TEXT DEFAULT 'нове',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                price REAL NOT NULL,
-                category TEXT,
-                description TEXT,
-                unit TEXT DEFAULT 'шт',
-                image TEXT,
-                image_data BYTEA,
-                details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                added_by INTEGER,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # ========== ТАБЛИЦІ ДЛЯ КОНТЕНТУ ==========
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS company_info (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                text TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_by BIGINT
-            )
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id BIGINT PRIMARY KEY,
+            state TEXT DEFAULT '',
+            temp_data JSONB DEFAULT '{}'::jsonb,
+            last_section TEXT DEFAULT 'main_menu',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS carts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            product_id INTEGER,
+            quantity REAL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            user_name TEXT,
+            username TEXT,
+            phone TEXT,
+            city TEXT,
+            np_department TEXT,
+            total REAL,
+            status TEXT DEFAULT 'нове',
+            order_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            id SERIAL PRIMARY KEY,
+            order_id INTEGER,
+            product_name TEXT,
+            quantity REAL,
+            price_per_unit REAL
+        )
+    ''')
+    
+    # Ключі ідемпотентності оформлення: повторне підтвердження повертає вже створене замовлення
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS checkout_requests (
+            idempotency_key TEXT PRIMARY KEY,
+            user_id BIGINT,
+            order_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Покинуті кошики, прибрані з carts фоновим очищенням
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS abandoned_carts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            product_id INTEGER,
+            quantity REAL,
+            added_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Індекси для пакетного очищення застарілих сесій, кошиків і ключів оформлення
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_sessions_updated_at ON user_sessions (updated_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_carts_user_added ON carts (user_id, added_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_checkout_requests_created_at ON checkout_requests (created_at)')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            user_name TEXT,
+            username TEXT,
+            text TEXT,
+            message_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS quick_orders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            user_name TEXT,
+            username TEXT,
+            phone TEXT,
+            product_id INTEGER,
+            product_name TEXT,
+            quantity REAL,
+            contact_method TEXT,
+            message TEXT,
+            status TEXT DEFAULT 'нове',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            category TEXT,
+            description TEXT,
+            unit TEXT DEFAULT 'шт',
+            image TEXT,
+            image_data BYTEA,
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            added_by INTEGER,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # ========== ТАБЛИЦІ ДЛЯ КОНТЕНТУ ==========
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS company_info (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            text TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_by BIGINT
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS welcome_message (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            text TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_by BIGINT
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS faq (
+            id SERIAL PRIMARY KEY,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            position INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Додаємо колонки якщо їх немає
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image TEXT')
+    logger.info("✅ Колонка image додана до таблиці products")
+    
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image_data BYTEA')
+    logger.info("✅ Колонка image_data додана до таблиці products")
+    
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS telegram_file_id TEXT')
+    logger.info("✅ Колонка telegram_file_id додана до таблиці products")
+    
+    # Нормалізовані зображення товарів, дедупліковані за хешем вмісту
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_images (
+            hash TEXT PRIMARY KEY,
+            data BYTEA NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image_hash TEXT')
+    logger.info("✅ Таблиця product_images та колонка image_hash готові")
+    
+    # Версії контенту: тригери збільшують лічильник і надсилають NOTIFY content_changed
+    # при зміні каталогу, FAQ чи текстів, а боти оновлюють кеші лише коли версія змінилась
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS content_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION bump_content_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO content_versions (name, version) VALUES (TG_ARGV[0], 1)
+            ON CONFLICT (name) DO UPDATE
+            SET version = content_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+            PERFORM pg_notify('content_changed', TG_ARGV[0]);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    content_triggers = (
+        ("products", "catalog", "INSERT OR DELETE OR TRUNCATE OR UPDATE OF name, price, category, description, unit, image, details"),
+        ("faq", "faq", "INSERT OR DELETE OR TRUNCATE OR UPDATE"),
+        ("company_info", "company", "INSERT OR DELETE OR TRUNCATE OR UPDATE"),
+        ("welcome_message", "welcome", "INSERT OR DELETE OR TRUNCATE OR UPDATE"),
+    )
+    for table, name, events in content_triggers:
+        cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_content_version ON {table}')
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_content_version
+            AFTER {events} ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_content_version('{name}')
         ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS welcome_message (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                text TEXT NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_by BIGINT
-            )
+    logger.info("✅ Версіонування контенту налаштовано")
+    
+    # Місячні партиції за created_at - до створення індексів, щоб вони стали партиційними
+    migrate_to_partitions(cursor)
+    ensure_partitions(cursor)
+    
+    # Нормалізований телефон (E.164) з індексами для точного, префіксного та суфіксного пошуку
+    for table in ("orders", "quick_orders"):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS phone_normalized TEXT')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_phone_normalized ON {table} (phone_normalized text_pattern_ops)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_phone_normalized_rev ON {table} (reverse(phone_normalized) text_pattern_ops)')
+        logger.info(f"✅ Колонка phone_normalized додана до таблиці {table}")
+    
+    backfill_normalized_phones(cursor)
+    migrate_legacy_product_images(cursor)
+    migrate_session_temp_data(cursor)
+    
+    # Повнотекстовий пошук по повідомленнях та коментарях швидких замовлень
+    cursor.execute("SELECT 1 FROM pg_ts_config WHERE cfgname = 'ukrainian'")
+    fts_config = 'ukrainian' if cursor.fetchone() else 'simple'
+    for table, column in (("messages", "text"), ("quick_orders", "message")):
+        cursor.execute(f'''
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('{fts_config}'::regconfig, COALESCE({column}, ''))) STORED
         ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS faq (
-                id SERIAL PRIMARY KEY,
-                question TEXT NOT NULL,
-                answer TEXT NOT NULL,
-                position INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_search_tsv ON {table} USING GIN (search_tsv)')
+    logger.info(f"✅ Повнотекстовий пошук налаштовано (конфігурація {fts_config})")
+    
+    # Щоденна зведена статистика: тригери оновлюють daily_metrics при кожній зміні замовлень
+    # і повідомлень, а статистика читає кілька рядків замість повного перегляду таблиць.
+    # Кожна зміна також надсилається в NOTIFY activity для живого дашборду адмін-бота
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_metrics (
+            day DATE NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT '',
+            count INTEGER NOT NULL DEFAULT 0,
+            revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, kind, status)
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE OR REPLACE FUNCTION track_daily_metrics() RETURNS trigger AS $$
+        DECLARE
+            rec JSONB;
+            delta INTEGER;
+            metric_day DATE;
+        BEGIN
+            FOR rec, delta IN
+                SELECT to_jsonb(OLD), -1 WHERE TG_OP IN ('UPDATE', 'DELETE')
+                UNION ALL
+                SELECT to_jsonb(NEW), 1 WHERE TG_OP IN ('INSERT', 'UPDATE')
+            LOOP
+                CONTINUE WHEN rec->>'created_at' IS NULL;
+                metric_day := ((rec->>'created_at')::timestamp AT TIME ZONE 'UTC' AT TIME ZONE '{METRICS_TZ_NAME}')::date;
+                INSERT INTO daily_metrics AS m (day, kind, status, count, revenue)
+                VALUES (
+                    metric_day, TG_ARGV[0], COALESCE(rec->>'status', ''), delta,
+                    delta * COALESCE((rec->>'total')::float8, 0)
+                )
+                ON CONFLICT (day, kind, status) DO UPDATE
+                SET count = m.count + EXCLUDED.count, revenue = m.revenue + EXCLUDED.revenue;
+                -- id у payload, щоб однакові сповіщення в одній транзакції не злились
+                PERFORM pg_notify('activity', json_build_object(
+                    'kind', TG_ARGV[0], 'id', COALESCE(rec->>'order_id', rec->>'id'),
+                    'status', COALESCE(rec->>'status', ''), 'day', metric_day, 'delta', delta,
+                    'revenue', delta * COALESCE((rec->>'total')::float8, 0)
+                )::text);
+            END LOOP;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION notify_user_activity() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('activity', json_build_object(
+                'kind', 'user', 'id', COALESCE(NEW.user_id, OLD.user_id),
+                'delta', CASE WHEN TG_OP = 'DELETE' THEN -1 ELSE 1 END
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_users_activity ON users')
+    cursor.execute('''
+        CREATE TRIGGER trg_users_activity
+        AFTER INSERT OR DELETE ON users
+        FOR EACH ROW EXECUTE FUNCTION notify_user_activity()
+    ''')
+    for table, kind, events in DAILY_METRICS_SOURCES:
+        cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_daily_metrics ON {table}')
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_daily_metrics
+            AFTER {events} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION track_daily_metrics('{kind}')
         ''')
-        
-        # Додаємо колонки якщо їх немає
-        try:
-            cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image TEXT')
-            logger.info("✅ Колонка image додана до таблиці products")
-        except Exception as e:
-            logger.error(f"❌ Помилка додавання колонки image: {e}")
-        
-        try:
-            cursor.execute('ALTER TABLE products ADD COLUMN IF NOT EXISTS image_data BYTEA')
-            logger.info("✅ Колонка image_data додана до таблиці products")
-        except Exception as e:
-            logger.error(f"❌ Помилка додавання колонки image_data: {e}")
-        
-        # Додаємо початкові дані для company_info, якщо їх немає
-        cursor.execute("SELECT COUNT(*) FROM company_info")
-        company_count = cursor.fetchone()['count']
-        
-        if company_count == 0:
-            company_text = """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM daily_metrics) AS filled")
+    if not cursor.fetchone()['filled']:
+        backfill_daily_metrics(cursor)
+    logger.info("✅ Щоденна статистика daily_metrics налаштована")
+    
+    # Додаємо початкові дані для company_info, якщо їх немає
+    cursor.execute("SELECT COUNT(*) FROM company_info")
+    company_count = cursor.fetchone()['count']
+    
+    if company_count == 0:
+        company_text = """
 Компанія Бонелет
 
 Ми спеціалізуємося на вирощуванні овочів та фруктів на полях Одещини.
@@ -241,16 +432,16 @@ def init_database():
 • Самовивіз з Одеської області, с. Великий Дальник
 • Терміни доставки: 1-4 дні в залежності від регіону
 """
-            cursor.execute('''
-                INSERT INTO company_info (id, text) VALUES (1, %s)
-            ''', (company_text,))
-        
-        # Додаємо початкові дані для welcome_message, якщо їх немає
-        cursor.execute("SELECT COUNT(*) FROM welcome_message")
-        welcome_count = cursor.fetchone()['count']
-        
-        if welcome_count == 0:
-            welcome_text = """
+        cursor.execute('''
+            INSERT INTO company_info (id, text) VALUES (1, %s)
+        ''', (company_text,))
+    
+    # Додаємо початкові дані для welcome_message, якщо їх немає
+    cursor.execute("SELECT COUNT(*) FROM welcome_message")
+    welcome_count = cursor.fetchone()['count']
+    
+    if welcome_count == 0:
+        welcome_text = """
 Вітаємо у боті компанії Бонелет!
 
 Ми спеціалізуємося на вирощуванні овочів та фруктів на полях Одещини.
@@ -261,109 +452,475 @@ def init_database():
 • Доставка Новою Поштою по всій Україні
 
 Оберіть опцію з меню
-    """
+"""
+        cursor.execute('''
+            INSERT INTO welcome_message (id, text) VALUES (1, %s)
+        ''', (welcome_text,))
+    
+    # Додаємо початкові FAQ, якщо їх немає
+    cursor.execute("SELECT COUNT(*) FROM faq")
+    faq_count = cursor.fetchone()['count']
+    
+    if faq_count == 0:
+        faqs = [
+            ("Які способи оплати ви приймаєте?", "Готівка при отриманні\nПереказ на карту ПриватБанку\nОплата через LiqPay", 0),
+            ("Які терміни доставки?", "Київ - 1-2 дні\nУкраїна - 2-4 дні\nВеликі партії - 3-5 днів", 1)
+        ]
+        for question, answer, position in faqs:
             cursor.execute('''
-                INSERT INTO welcome_message (id, text) VALUES (1, %s)
-            ''', (welcome_text,))
-        
-        # Додаємо початкові FAQ, якщо їх немає
-        cursor.execute("SELECT COUNT(*) FROM faq")
-        faq_count = cursor.fetchone()['count']
-        
-        if faq_count == 0:
-            faqs = [
-                ("Які способи оплати ви приймаєте?", "Готівка при отриманні\nПереказ на карту ПриватБанку\nОплата через LiqPay", 0),
-                ("Які терміни доставки?", "Київ - 1-2 дні\nУкраїна - 2-4 дні\nВеликі партії - 3-5 днів", 1)
-            ]
-            for question, answer, position in faqs:
-                cursor.execute('''
-                    INSERT INTO faq (question, answer, position) VALUES (%s, %s, %s)
-                ''', (question, answer, position))
-        
-        conn.commit()
-        logger.info("✅ База даних PostgreSQL ініціалізована")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Помилка ініціалізації бази даних: {e}")
-        return False
-    finally:
-        conn.close()
+                INSERT INTO faq (question, answer, position) VALUES (%s, %s, %s)
+            ''', (question, answer, position))
 
-# ========== ФУНКЦІЇ ДЛЯ РОБОТИ З КОНТЕНТОМ ==========
+def migration_002_phone_digits_fallback(cursor):
+    """Номери, що не пройшли перевірку, отримують phone_normalized у вигляді '+' і цифр"""
+    backfill_normalized_phones(cursor)
 
-def get_company_info() -> str:
-    """Отримує текст про компанію з БД"""
+
+MIGRATIONS = (
+    (1, "baseline", migration_001_baseline),
+    (2, "phone_digits_fallback", migration_002_phone_digits_fallback),
+)
+
+def run_migrations() -> bool:
+    """Застосовує нові міграції схеми; звичайний старт робить лише один SELECT"""
     conn = get_db_connection()
     if not conn:
-        return "Помилка отримання даних"
+        return False
     
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT text FROM company_info WHERE id = 1')
-        row = cursor.fetchone()
-        return row['text'] if row else "Інформацію не знайдено"
+        # Обидва боти та всі репліки застосовують міграції по черзі
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_MIGRATIONS_LOCK_ID,))
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                component TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (component, version)
+            )
+        ''')
+        cursor.execute("SELECT version FROM schema_migrations WHERE component = %s", (SCHEMA_COMPONENT,))
+        applied = {row['version'] for row in cursor.fetchall()}
+        
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            started = time.perf_counter()
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (component, version, name) VALUES (%s, %s, %s)",
+                (SCHEMA_COMPONENT, version, name)
+            )
+            logger.info(f"✅ Міграція {version:03d}_{name} застосована за {time.perf_counter() - started:.2f} с")
+        
+        conn.commit()
+        return True
     except Exception as e:
-        logger.error(f"Помилка отримання company_info: {e}")
-        return "Помилка отримання даних"
+        conn.rollback()
+        logger.error(f"❌ Помилка міграції схеми: {e}")
+        return False
     finally:
         conn.close()
 
-def get_welcome_message() -> str:
-    """Отримує вітальне повідомлення з БД"""
-    conn = get_db_connection()
-    if not conn:
-        return "Помилка отримання даних"
+def backfill_normalized_phones(cursor):
+    """Заповнює phone_normalized для записів, створених до появи колонки"""
+    for table, key in (("orders", "order_id"), ("quick_orders", "id")):
+        cursor.execute(f'''
+            SELECT {key} AS row_id, phone FROM {table}
+            WHERE phone_normalized IS NULL AND phone IS NOT NULL AND phone <> ''
+        ''')
+        updates = []
+        for row in cursor.fetchall():
+            phone_normalized = normalize_phone(row['phone'])
+            if phone_normalized:
+                updates.append((phone_normalized, row['row_id']))
+        if updates:
+            execute_batch(cursor, f'UPDATE {table} SET phone_normalized = %s WHERE {key} = %s', updates)
+            logger.info(f"✅ Нормалізовано телефонів у {table}: {len(updates)}")
+
+def reset_invalid_temp_data(cursor):
+    """Скидає в '{}' значення temp_data, що не є JSON-об'єктом (перед переведенням у JSONB)"""
+    cursor.execute("SELECT user_id, temp_data FROM user_sessions WHERE NULLIF(temp_data, '') IS NOT NULL")
+    invalid = []
+    for row in cursor.fetchall():
+        try:
+            value = json.loads(row['temp_data'])
+        except ValueError:
+            value = None
+        if not isinstance(value, dict):
+            invalid.append(row['user_id'])
+    if invalid:
+        cursor.execute("UPDATE user_sessions SET temp_data = '{}' WHERE user_id = ANY(%s)", (invalid,))
+        logger.info(f"🧹 Скинуто некоректних temp_data: {len(invalid)}")
+
+def migrate_session_temp_data(cursor):
+    """Переводить user_sessions.temp_data з TEXT у JSONB"""
+    cursor.execute('''
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'user_sessions' AND column_name = 'temp_data'
+    ''')
+    row = cursor.fetchone()
+    if not row or row['data_type'] != 'text':
+        return
     
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT text FROM welcome_message WHERE id = 1')
+    # Сесії тимчасові - непарсабельні значення просто скидаємо
+    reset_invalid_temp_data(cursor)
+    cursor.execute('''
+        ALTER TABLE user_sessions
+            ALTER COLUMN temp_data DROP DEFAULT,
+            ALTER COLUMN temp_data TYPE JSONB USING COALESCE(NULLIF(temp_data, ''), '{}')::jsonb,
+            ALTER COLUMN temp_data SET DEFAULT '{}'::jsonb
+    ''')
+    logger.info("✅ user_sessions.temp_data переведено в JSONB")
+
+def migrate_legacy_product_images(cursor):
+    """Переносить фото з products.image_data у product_images"""
+    cursor.execute('SELECT id FROM products WHERE image_data IS NOT NULL AND image_hash IS NULL')
+    product_ids = [row['id'] for row in cursor.fetchall()]
+    for product_id in product_ids:
+        # По одному товару, щоб не тримати в пам'яті всі фото одночасно
+        cursor.execute('SELECT image_data FROM products WHERE id = %s', (product_id,))
+        image_data = bytes(cursor.fetchone()['image_data'])
+        image_hash = hashlib.sha256(image_data).hexdigest()
+        cursor.execute('''
+            INSERT INTO product_images (hash, data, size) VALUES (%s, %s, %s)
+            ON CONFLICT (hash) DO NOTHING
+        ''', (image_hash, psycopg2.Binary(image_data), len(image_data)))
+        cursor.execute('UPDATE products SET image_hash = %s, image_data = NULL WHERE id = %s', (image_hash, product_id))
+    if product_ids:
+        logger.info(f"✅ Перенесено фото товарів у product_images: {len(product_ids)}")
+
+# ========== ЩОДЕННА СТАТИСТИКА ==========
+
+# Часовий пояс, за яким замовлення розкладаються по днях у daily_metrics
+METRICS_TZ_NAME = 'Europe/Kyiv'
+
+# Джерела daily_metrics: таблиця, вид запису та події, що змінюють підсумки
+DAILY_METRICS_SOURCES = (
+    ("orders", "order", "INSERT OR DELETE OR UPDATE OF status, total, created_at"),
+    ("quick_orders", "quick_order", "INSERT OR DELETE OR UPDATE OF status, created_at"),
+    ("messages", "message", "INSERT OR DELETE OR UPDATE OF created_at"),
+)
+
+def backfill_daily_metrics(cursor):
+    """Перераховує daily_metrics з таблиць замовлень і повідомлень"""
+    cursor.execute('DELETE FROM daily_metrics')
+    cursor.execute('''
+        INSERT INTO daily_metrics (day, kind, status, count, revenue)
+        SELECT (created_at AT TIME ZONE 'UTC' AT TIME ZONE %s)::date, kind, status, COUNT(*), COALESCE(SUM(total), 0)
+        FROM (
+            SELECT 'order' AS kind, COALESCE(status, '') AS status, total, created_at FROM orders
+            UNION ALL
+            SELECT 'quick_order', COALESCE(status, ''), 0, created_at FROM quick_orders
+            UNION ALL
+            SELECT 'message', '', 0, created_at FROM messages
+        ) source
+        WHERE created_at IS NOT NULL
+        GROUP BY 1, 2, 3
+    ''', (METRICS_TZ_NAME,))
+    logger.info(f"✅ daily_metrics перераховано: {cursor.rowcount} рядків")
+
+# ========== ПАРТИЦІОНУВАННЯ ==========
+
+# Таблиці з місячними партиціями за created_at та їхні ключові колонки
+PARTITIONED_TABLES = (("orders", "order_id"), ("quick_orders", "id"), ("messages", "id"))
+# На скільки місяців наперед створюються партиції
+PARTITION_MONTHS_AHEAD = 3
+# Партиції, старші за стільки місяців, від'єднуються в схему archive (0 - не архівувати)
+PARTITION_ARCHIVE_AFTER_MONTHS = int(os.getenv("PARTITION_ARCHIVE_AFTER_MONTHS", "0"))
+
+def month_start(value: datetime, shift: int = 0) -> datetime:
+    """Початок місяця value, зсунутого на shift місяців"""
+    index = value.year * 12 + value.month - 1 + shift
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def is_partitioned(cursor, table: str) -> bool:
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cursor.fetchone()
+    return bool(row) and row['relkind'] == 'p'
+
+def insertable_columns(cursor, table: str) -> str:
+    """Список колонок таблиці без згенерованих - для INSERT ... SELECT"""
+    cursor.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (table,))
+    return ", ".join(row['column_name'] for row in cursor.fetchall())
+
+def create_month_partition(cursor, table: str, start: datetime):
+    """Створює партицію місяця; рядки цього місяця з партиції за замовчуванням переносяться в неї"""
+    name = f"{table}_y{start.year}m{start.month:02d}"
+    end = month_start(start, 1)
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS found", (name,))
+    if cursor.fetchone()['found']:
+        return
+    
+    default = f"{table}_default"
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS found", (default,))
+    moved = 0
+    if cursor.fetchone()['found']:
+        cursor.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {default} WHERE created_at >= %s AND created_at < %s) AS found",
+            (start, end)
+        )
+        moved = cursor.fetchone()['found']
+    
+    if not moved:
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (start, end))
+        return
+    
+    # Інакше Postgres відмовить: обмеження партиції за замовчуванням порушили б її ж рядки.
+    # Рядки переносяться між від'єднаними таблицями, тож тригери daily_metrics не спрацьовують
+    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {default}")
+    cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED)")
+    columns = insertable_columns(cursor, table)
+    cursor.execute(
+        f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {default} WHERE created_at >= %s AND created_at < %s",
+        (start, end)
+    )
+    moved = cursor.rowcount
+    cursor.execute(f"DELETE FROM {default} WHERE created_at >= %s AND created_at < %s", (start, end))
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end))
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT")
+    logger.info(f"📦 Партиція {name}: перенесено з {default} записів: {moved}")
+
+def migrate_to_partitions(cursor):
+    """Перетворює звичайні orders, quick_orders і messages на партиційовані з перенесенням даних"""
+    for table, key in PARTITIONED_TABLES:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
         row = cursor.fetchone()
-        return row['text'] if row else "Повідомлення не знайдено"
-    except Exception as e:
-        logger.error(f"Помилка отримання welcome_message: {e}")
-        return "Помилка отримання даних"
-    finally:
-        conn.close()
+        if not row or row['relkind'] != 'r':
+            continue
+        
+        legacy = f"{table}_unpartitioned"
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        cursor.execute(f"UPDATE {legacy} SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL")
+        cursor.execute(f"""
+            CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING GENERATED)
+            PARTITION BY RANGE (created_at)
+        """)
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN created_at SET NOT NULL")
+        
+        cursor.execute(f"SELECT MIN(created_at) AS first_at FROM {legacy}")
+        first_at = cursor.fetchone()['first_at'] or datetime.now()
+        start = month_start(first_at)
+        last = month_start(datetime.now(), PARTITION_MONTHS_AHEAD)
+        while start <= last:
+            create_month_partition(cursor, table, start)
+            start = month_start(start, 1)
+        
+        columns = insertable_columns(cursor, legacy)
+        cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy}")
+        moved = cursor.rowcount
+        
+        # Лічильник ідентифікаторів переходить до нової таблиці разом із колонкою
+        cursor.execute("SELECT pg_get_serial_sequence(%s, %s) AS seq", (legacy, key))
+        sequence = cursor.fetchone()['seq']
+        if sequence:
+            cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.{key}")
+        cursor.execute(f"DROP TABLE {legacy}")
+        # Ключ партиції має входити до первинного ключа
+        cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY ({key}, created_at)")
+        logger.info(f"✅ Таблицю {table} розбито на місячні партиції, перенесено записів: {moved}")
 
-def get_all_faqs() -> List[Dict]:
-    """Отримує всі FAQ з БД, відсортовані за позицією"""
-    conn = get_db_connection()
-    if not conn:
-        return []
+def ensure_partitions(cursor):
+    """Створює партиції на поточний і наступні місяці, партицію за замовчуванням та індекс за датою.
     
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, question, answer, position FROM faq ORDER BY position, id')
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
-    except Exception as e:
-        logger.error(f"Помилка отримання faq: {e}")
+    Місяці, чиї рядки вже потрапили в партицію за замовчуванням (обслуговування довго не працювало
+    або розійшовся годинник), теж отримують власні партиції з перенесенням цих рядків.
+    """
+    now = datetime.now()
+    for table, _ in PARTITIONED_TABLES:
+        if not is_partitioned(cursor, table):
+            continue
+        months = {month_start(now, shift) for shift in range(PARTITION_MONTHS_AHEAD + 1)}
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS found", (f"{table}_default",))
+        if cursor.fetchone()['found']:
+            cursor.execute(f"SELECT DISTINCT date_trunc('month', created_at) AS month FROM {table}_default")
+            months.update(row['month'] for row in cursor.fetchall())
+        for start in sorted(months):
+            create_month_partition(cursor, table, start)
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_created_at ON {table} (created_at)")
+
+def archive_cold_partitions(cursor) -> List[str]:
+    """Від'єднує партиції старших місяців і переносить їх у схему archive"""
+    if PARTITION_ARCHIVE_AFTER_MONTHS <= 0:
         return []
-    finally:
-        conn.close()
+    
+    cutoff = month_start(datetime.now(), -PARTITION_ARCHIVE_AFTER_MONTHS)
+    archived = []
+    for table, _ in PARTITIONED_TABLES:
+        if not is_partitioned(cursor, table):
+            continue
+        cursor.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+        """, (table,))
+        for row in cursor.fetchall():
+            match = re.fullmatch(rf"{table}_y(\d{{4}})m(\d{{2}})", row['relname'])
+            if not match or datetime(int(match.group(1)), int(match.group(2)), 1) >= cutoff:
+                continue
+            cursor.execute("CREATE SCHEMA IF NOT EXISTS archive")
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {row['relname']}")
+            cursor.execute(f"ALTER TABLE {row['relname']} SET SCHEMA archive")
+            archived.append(row['relname'])
+    return archived
 
-def get_faq_by_id(faq_id: int) -> Optional[Dict]:
-    """Отримує FAQ за ID"""
-    conn = get_db_connection()
+def maintain_partitions():
+    """Регулярне обслуговування партицій: нові місяці наперед і архівування холодних"""
+    conn = Database.get_connection()
     if not conn:
-        return None
+        return
     
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT id, question, answer FROM faq WHERE id = %s', (faq_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        ensure_partitions(cursor)
+        archived = archive_cold_partitions(cursor)
+        conn.commit()
+        if archived:
+            logger.info(f"📦 Від'єднано в архів партицій: {', '.join(archived)}")
     except Exception as e:
-        logger.error(f"Помилка отримання faq за ID: {e}")
-        return None
+        conn.rollback()
+        logger.error(f"❌ Помилка обслуговування партицій: {e}")
     finally:
         conn.close()
 
+# ========== ФУНКЦІЇ ДЛЯ РОБОТИ З КОНТЕНТОМ ==========
+
+CONTENT_CACHE_TTL = int(os.getenv("CONTENT_CACHE_TTL", "300"))
+CONTENT_CHANNEL = "content_changed"
+CONTENT_NAMES = ("welcome", "company", "faq")
+
+class ContentStore:
+    """Вітання, інформація про компанію та FAQ у пам'яті.
+    
+    Тригери в БД надсилають NOTIFY при змінах з адмін-бота, фоновий потік
+    скидає відповідні записи, а TTL страхує від пропущених сповіщень.
+    """
+    
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {}
+        self.loaded_at = {}
+        self.generation = 0
+    
+    def load(self, names) -> bool:
+        """Читає вказані розділи з БД одним з'єднанням"""
+        generation = self.generation
+        conn = get_db_connection()
+        if not conn:
+            return False
+        
+        try:
+            cursor = conn.cursor()
+            loaded = {}
+            for name in names:
+                if name == "welcome":
+                    cursor.execute('SELECT text FROM welcome_message WHERE id = 1')
+                    row = cursor.fetchone()
+                    loaded[name] = row['text'] if row else "Повідомлення не знайдено"
+                elif name == "company":
+                    cursor.execute('SELECT text FROM company_info WHERE id = 1')
+                    row = cursor.fetchone()
+                    loaded[name] = row['text'] if row else "Інформацію не знайдено"
+                elif name == "faq":
+                    cursor.execute('SELECT id, question, answer, position FROM faq ORDER BY position, id')
+                    loaded[name] = [dict(row) for row in cursor.fetchall()]
+            now = time.monotonic()
+            with self.lock:
+                self.values.update(loaded)
+                # Якщо під час читання прийшло сповіщення, дані могли вже застаріти
+                if generation == self.generation:
+                    for name in loaded:
+                        self.loaded_at[name] = now
+            return True
+        except Exception as e:
+            logger.error(f"Помилка завантаження контенту {', '.join(names)}: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    def get(self, name: str, default):
+        with self.lock:
+            loaded_at = self.loaded_at.get(name)
+            if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+                return self.values[name]
+        self.load((name,))
+        with self.lock:
+            # Якщо БД недоступна, застарілий текст кращий за повідомлення про помилку
+            return self.values.get(name, default)
+    
+    def invalidate(self, name: Optional[str] = None):
+        with self.lock:
+            self.generation += 1
+            if name is None:
+                self.loaded_at.clear()
+            else:
+                self.loaded_at.pop(name, None)
+
+content_store = ContentStore(CONTENT_CACHE_TTL)
+
+def on_content_changed(name: Optional[str]):
+    """Скидає кеш контенту та змушує перечитати версії для клавіатур"""
+    content_store.invalidate(name)
+    mark_content_versions_stale()
+
+def listen_for_content_changes():
+    """Фоновий потік: слухає NOTIFY content_changed і перепідключається при обриві"""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {CONTENT_CHANNEL}")
+            # Поки підписки не було, сповіщення могли загубитись
+            on_content_changed(None)
+            logger.info("👂 Підписка на зміни контенту активна")
+            while True:
+                if not select.select([conn], [], [], 60)[0]:
+                    cursor.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    logger.info(f"🔔 Змінено контент: {notify.payload}")
+                    on_content_changed(notify.payload)
+        except Exception as e:
+            logger.warning(f"⚠️ Підписка на зміни контенту перервалась: {e}")
+        finally:
+            if conn:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(5)
+
+def get_company_info() -> str:
+    """Повертає текст про компанію з кешу"""
+    return content_store.get("company", "Помилка отримання даних")
+
+def get_welcome_message() -> str:
+    """Повертає вітальне повідомлення з кешу"""
+    return content_store.get("welcome", "Помилка отримання даних")
+
+def get_all_faqs() -> List[Dict]:
+    """Повертає всі FAQ з кешу, відсортовані за позицією"""
+    return content_store.get("faq", [])
+
+def get_faq_by_id(faq_id: int) -> Optional[Dict]:
+    """Повертає FAQ за ID з кешу"""
+    return next((faq for faq in get_all_faqs() if faq['id'] == faq_id), None)
+
 # ========== РЕШТА КОДУ ==========
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOGS_DIR = os.path.join(BASE_DIR, "logs")
-os.makedirs(LOGS_DIR, exist_ok=True)
 
 ORDERS_LOG = os.path.join(LOGS_DIR, "orders.txt")
 USERS_LOG = os.path.join(LOGS_DIR, "users.txt")
@@ -428,21 +985,6 @@ def log_quick_order(order_data: dict):
     except Exception as e:
         logger.error(f"Помилка запису швидкого замовлення: {e}")
 
-def check_single_instance():
-    import socket
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)
-        result = sock.connect_ex(('127.0.0.1', 9999))
-        sock.close()
-        if result == 0:
-            logger.error("⚠️ Другий екземпляр бота вже запущено!")
-            return False
-        return True
-    except Exception as e:
-        logger.error(f"⚠️ Помилка перевірки екземпляра: {e}")
-        return True
-
 async def notify_admins_about_new_order(order_data: dict):
     try:
         conn = get_db_connection()
@@ -599,10 +1141,10 @@ class Database:
         return get_db_connection()
     
     @staticmethod
-    def save_user(user_id: int, first_name: str = "", last_name: str = "", username: str = ""):
+    def save_user(user_id: int, first_name: str = "", last_name: str = "", username: str = "") -> bool:
         conn = Database.get_connection()
         if not conn:
-            return
+            return False
         
         try:
             cursor = conn.cursor()
@@ -615,30 +1157,40 @@ class Database:
                     username = EXCLUDED.username
             ''', (user_id, first_name, last_name, username))
             conn.commit()
+            return True
         except Exception as e:
             logger.error(f"Помилка збереження користувача: {e}")
+            return False
         finally:
             conn.close()
     
     @staticmethod
-    def get_user_session(user_id: int) -> Dict:
+    def get_user_session(user_id: int, keys: Optional[Tuple[str, ...]] = None) -> Dict:
+        """Сесія користувача; keys обмежує temp_data лише потрібними ключами"""
         conn = Database.get_connection()
         if not conn:
             return {"state": "", "temp_data": {}, "last_section": "main_menu"}
         
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT state, temp_data, last_section 
-                FROM user_sessions 
-                WHERE user_id = %s
-            ''', (user_id,))
+            if keys is None:
+                cursor.execute('''
+                    SELECT state, temp_data, last_section 
+                    FROM user_sessions 
+                    WHERE user_id = %s
+                ''', (user_id,))
+            else:
+                cursor.execute('''
+                    SELECT state, last_section,
+                           (SELECT jsonb_object_agg(key, value) FROM jsonb_each(temp_data)
+                            WHERE key = ANY(%s)) AS temp_data
+                    FROM user_sessions 
+                    WHERE user_id = %s
+                ''', (list(keys), user_id))
             
             row = cursor.fetchone()
             if row:
-                state, temp_data_json, last_section = row['state'], row['temp_data'], row['last_section']
-                temp_data = json.loads(temp_data_json) if temp_data_json else {}
-                return {"state": state, "temp_data": temp_data, "last_section": last_section}
+                return {"state": row['state'], "temp_data": row['temp_data'] or {}, "last_section": row['last_section']}
             return {"state": "", "temp_data": {}, "last_section": "main_menu"}
         except Exception as e:
             logger.error(f"Помилка отримання сесії: {e}")
@@ -653,7 +1205,6 @@ class Database:
             return
         
         try:
-            temp_data_json = json.dumps(temp_data) if temp_data else "{}"
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO user_sessions (user_id, state, temp_data, last_section, updated_at)
@@ -663,7 +1214,7 @@ class Database:
                     temp_data = EXCLUDED.temp_data,
                     last_section = EXCLUDED.last_section,
                     updated_at = CURRENT_TIMESTAMP
-            ''', (user_id, state, temp_data_json, last_section))
+            ''', (user_id, state, Json(temp_data or {}), last_section))
             conn.commit()
         except Exception as e:
             logger.error(f"Помилка збереження сесії: {e}")
@@ -684,6 +1235,55 @@ class Database:
         finally:
             conn.close()
     
+    @staticmethod
+    def transition(user_id: int, from_state: Optional[str], to_state: str = "", patch: Dict = None,
+                   last_section: Optional[str] = None, replace: bool = False) -> bool:
+        """Атомарний перехід сесії from_state -> to_state одним записом; False якщо стан уже інший"""
+        conn = Database.get_connection()
+        if not conn:
+            return False
+        
+        try:
+            cursor = conn.cursor()
+            # from_state=None - перехід з будь-якого стану; відсутня сесія вважається станом ""
+            cursor.execute('''
+                INSERT INTO user_sessions (user_id, state, temp_data, last_section, updated_at)
+                SELECT %(user_id)s, %(to_state)s, %(patch)s, COALESCE(%(last_section)s, 'main_menu'), CURRENT_TIMESTAMP
+                WHERE %(from_state)s::text IS NULL OR %(from_state)s = ''
+                   OR EXISTS (SELECT 1 FROM user_sessions WHERE user_id = %(user_id)s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    state = EXCLUDED.state,
+                    temp_data = CASE WHEN %(replace)s THEN EXCLUDED.temp_data
+                                     ELSE user_sessions.temp_data || EXCLUDED.temp_data
+                                END,
+                    last_section = COALESCE(%(last_section)s, user_sessions.last_section),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE %(from_state)s::text IS NULL OR COALESCE(user_sessions.state, '') = %(from_state)s
+                RETURNING user_id
+            ''', {
+                "user_id": user_id,
+                "from_state": from_state,
+                "to_state": to_state,
+                "patch": Json(patch or {}),
+                "last_section": last_section,
+                "replace": replace,
+            })
+            applied = cursor.fetchone() is not None
+            conn.commit()
+            if not applied:
+                logger.info(f"⏭️ Застарілий перехід сесії {user_id}: {from_state!r} -> {to_state!r}")
+            return applied
+        except Exception as e:
+            logger.error(f"Помилка переходу сесії: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def reset_user_session(user_id: int, last_section: str = "main_menu"):
+        """Скидає сесію до початкового стану одним записом"""
+        Database.transition(user_id, None, "", last_section=last_section, replace=True)
+    
     @staticmethod
     def add_to_cart(user_id: int, product_id: int, quantity: float) -> bool:
         conn = Database.get_connection()
@@ -777,48 +1377,112 @@ class Database:
             conn.close()
     
     @staticmethod
-    def create_order(order_data: Dict) -> int:
+    def create_order(order_data: Dict, idempotency_key: Optional[str] = None) -> Tuple[int, bool]:
+        """Створює замовлення з корзини одним запитом; повертає (order_id, чи створено нове)"""
         conn = Database.get_connection()
         if not conn:
-            return 0
+            return 0, False
         
         try:
             cursor = conn.cursor()
+            # Ціни беруться з products у момент підтвердження, позиції копіюються з корзини
+            # і корзина очищується в тому ж операторі - один запит незалежно від розміру корзини
             cursor.execute('''
-                INSERT INTO orders (user_id, user_name, username, phone, city, np_department, total, order_type, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING order_id
-            ''', (
-                order_data.get("user_id"),
-                order_data.get("user_name"),
-                order_data.get("username"),
-                order_data.get("phone"),
-                order_data.get("city"),
-                order_data.get("np_department"),
-                order_data.get("total"),
-                order_data.get("order_type"),
-                "нове"
-            ))
-            
-            result = cursor.fetchone()
-            order_id = result['order_id'] if result else 0
-            
-            for item in order_data.get("items", []):
-                cursor.execute('''
+                WITH cart AS (
+                    SELECT c.id, p.name AS product_name, c.quantity, p.price
+                    FROM carts c
+                    JOIN products p ON p.id = c.product_id
+                    WHERE c.user_id = %(user_id)s
+                      AND (%(key)s::text IS NULL OR NOT EXISTS (
+                          SELECT 1 FROM checkout_requests WHERE idempotency_key = %(key)s
+                      ))
+                ),
+                summary AS (
+                    SELECT COUNT(*) AS item_count,
+                           COALESCE(SUM(price::float8 * quantity), 0) AS subtotal
+                    FROM cart
+                ),
+                new_order AS (
+                    INSERT INTO orders (user_id, user_name, username, phone, phone_normalized, city, np_department, total, order_type, status)
+                    SELECT %(user_id)s, %(user_name)s, %(username)s, %(phone)s, %(phone_normalized)s,
+                           %(city)s, %(np_department)s,
+                           CASE WHEN item_count >= 3 THEN subtotal * 0.95 ELSE subtotal END,
+                           %(order_type)s, 'нове'
+                    FROM summary
+                    WHERE item_count > 0
+                    RETURNING order_id, total
+                ),
+                items AS (
                     INSERT INTO order_items (order_id, product_name, quantity, price_per_unit)
-                    VALUES (%s, %s, %s, %s)
-                ''', (order_id, item.get("product_name"), item.get("quantity"), item.get("price")))
+                    SELECT new_order.order_id, cart.product_name, cart.quantity, cart.price
+                    FROM new_order, cart
+                    ORDER BY cart.id
+                    RETURNING id, product_name, quantity, price_per_unit
+                ),
+                cleared AS (
+                    DELETE FROM carts
+                    WHERE id IN (SELECT id FROM cart) AND EXISTS (SELECT 1 FROM new_order)
+                ),
+                claimed AS (
+                    INSERT INTO checkout_requests (idempotency_key, user_id, order_id)
+                    SELECT %(key)s, %(user_id)s, order_id FROM new_order
+                    WHERE %(key)s::text IS NOT NULL
+                )
+                SELECT new_order.order_id, new_order.total,
+                       (SELECT COALESCE(json_agg(json_build_object(
+                                   'product_name', product_name,
+                                   'quantity', quantity,
+                                   'price', price_per_unit
+                               ) ORDER BY id), '[]'::json)
+                        FROM items) AS items
+                FROM new_order
+            ''', {
+                "key": idempotency_key,
+                "user_id": order_data.get("user_id"),
+                "user_name": order_data.get("user_name"),
+                "username": order_data.get("username"),
+                "phone": order_data.get("phone"),
+                "phone_normalized": normalize_phone(order_data.get("phone")),
+                "city": order_data.get("city"),
+                "np_department": order_data.get("np_department"),
+                "order_type": order_data.get("order_type"),
+            })
             
-            cursor.execute('DELETE FROM carts WHERE user_id = %s', (order_data.get("user_id"),))
-            conn.commit()
-            logger.info(f"✅ Замовлення #{order_id} створено успішно")
-            return order_id
+            row = cursor.fetchone()
+            if row:
+                conn.commit()
+                # Фактична сума та позиції - для сповіщень і тексту підтвердження
+                order_data["total"] = float(row['total'])
+                order_data["items"] = row['items']
+                logger.info(f"✅ Замовлення #{row['order_id']} створено успішно")
+                return row['order_id'], True
+            
+            conn.rollback()
+            if idempotency_key:
+                return Database._existing_checkout_order(cursor, idempotency_key)
+            logger.warning(f"⚠️ Корзина користувача {order_data.get('user_id')} порожня, замовлення не створено")
+            return 0, False
+        except psycopg2.errors.UniqueViolation:
+            # Паралельне підтвердження з тим самим ключем встигло першим
+            conn.rollback()
+            return Database._existing_checkout_order(conn.cursor(), idempotency_key)
         except Exception as e:
             logger.error(f"Помилка створення замовлення: {e}")
-            return 0
+            return 0, False
         finally:
             conn.close()
     
+    @staticmethod
+    def _existing_checkout_order(cursor, idempotency_key: str) -> Tuple[int, bool]:
+        """Повертає замовлення, вже створене для ключа оформлення"""
+        cursor.execute('SELECT order_id FROM checkout_requests WHERE idempotency_key = %s', (idempotency_key,))
+        row = cursor.fetchone()
+        if not row or not row['order_id']:
+            logger.warning(f"⚠️ Корзина порожня, замовлення за ключем {idempotency_key} не створено")
+            return 0, False
+        logger.info(f"🔁 Повторне підтвердження, замовлення #{row['order_id']} вже існує")
+        return row['order_id'], False
+    
     @staticmethod
     def save_message(user_id: int, user_name: str, username: str, text: str, message_type: str):
         conn = Database.get_connection()
@@ -848,10 +1512,11 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO quick_orders (user_id, user_name, username, product_id, product_name, 
-                                        quantity, phone, contact_method, message, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                        quantity, phone, phone_normalized, contact_method, message, status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 RETURNING id
-            ''', (user_id, user_name, username, product_id, product_name, quantity, phone, contact_method, message, "нове"))
+            ''', (user_id, user_name, username, product_id, product_name, quantity, phone,
+                  normalize_phone(phone), contact_method, message, "нове"))
             
             result = cursor.fetchone()
             order_id = result['id'] if result else 0
@@ -872,18 +1537,22 @@ class Database:
         
         try:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM orders")
-            total_orders = cursor.fetchone()['count']
-            cursor.execute("SELECT COUNT(*) FROM messages")
-            total_messages = cursor.fetchone()['count']
+            cursor.execute('''
+                SELECT COALESCE(SUM(count) FILTER (WHERE kind = 'order'), 0) AS total_orders,
+                       COALESCE(SUM(count) FILTER (WHERE kind = 'message'), 0) AS total_messages,
+                       COALESCE(SUM(count) FILTER (WHERE kind = 'quick_order'), 0) AS quick_orders,
+                       COALESCE(SUM(revenue) FILTER (WHERE kind = 'order'), 0) AS total_revenue
+                FROM daily_metrics
+            ''')
+            totals = cursor.fetchone()
+            total_orders = totals['total_orders']
+            total_messages = totals['total_messages']
+            quick_orders = totals['quick_orders']
+            total_revenue = totals['total_revenue']
             cursor.execute("SELECT COUNT(DISTINCT user_id) FROM users")
             total_users = cursor.fetchone()['count']
             cursor.execute("SELECT COUNT(DISTINCT user_id) FROM carts")
             active_carts = cursor.fetchone()['count']
-            cursor.execute("SELECT COUNT(*) FROM quick_orders")
-            quick_orders = cursor.fetchone()['count']
-            cursor.execute("SELECT SUM(total) FROM orders")
-            total_revenue = cursor.fetchone()['sum'] or 0
             
             return {
                 "total_orders": total_orders,
@@ -939,7 +1608,12 @@ class Database:
         
         try:
             cursor = conn.cursor()
-            cursor.execute('SELECT image_data FROM products WHERE id = %s', (product_id,))
+            cursor.execute('''
+                SELECT COALESCE(pi.data, p.image_data) AS image_data
+                FROM products p
+                LEFT JOIN product_images pi ON pi.hash = p.image_hash
+                WHERE p.id = %s
+            ''', (product_id,))
             row = cursor.fetchone()
             if row and row['image_data']:
                 if hasattr(row['image_data'], 'tobytes'):
@@ -952,6 +1626,100 @@ class Database:
         finally:
             conn.close()
     
+    @staticmethod
+    def get_product_photo_ref(product_id: int) -> Tuple[Optional[str], Optional[str], bool]:
+        """Повертає (telegram_file_id, хеш фото, чи є фото в БД) без читання самих байтів"""
+        conn = Database.get_connection()
+        if not conn:
+            return None, None, False
+        
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT telegram_file_id, image_hash, (image_hash IS NOT NULL OR image_data IS NOT NULL) AS has_image
+                FROM products WHERE id = %s
+            ''', (product_id,))
+            row = cursor.fetchone()
+            if row:
+                return row['telegram_file_id'], row['image_hash'], row['has_image']
+            return None, None, False
+        except Exception as e:
+            logger.error(f"Помилка отримання file_id товару: {e}")
+            return None, None, False
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def get_image_blob(image_hash: str) -> Optional[bytes]:
+        """Читає байти зображення з product_images за хешем"""
+        conn = Database.get_connection()
+        if not conn:
+            return None
+        
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT data FROM product_images WHERE hash = %s', (image_hash,))
+            row = cursor.fetchone()
+            return bytes(row['data']) if row else None
+        except Exception as e:
+            logger.error(f"Помилка читання зображення {image_hash[:12]}: {e}")
+            return None
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def get_image_hashes() -> Optional[set]:
+        """Повертає хеші всіх зображень з індексу product_images"""
+        conn = Database.get_connection()
+        if not conn:
+            return None
+        
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT hash FROM product_images')
+            return {row['hash'] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Помилка отримання хешів зображень: {e}")
+            return None
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def save_product_file_id(product_id: int, file_id: Optional[str], image_hash: Optional[str]):
+        """Зберігає (або скидає) file_id фото товару, якщо зображення не змінилось після відправки"""
+        conn = Database.get_connection()
+        if not conn:
+            return
+        
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE products SET telegram_file_id = %s
+                WHERE id = %s AND image_hash IS NOT DISTINCT FROM %s
+            ''', (file_id, product_id, image_hash))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Помилка збереження file_id товару: {e}")
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def get_content_versions() -> Optional[Dict[str, int]]:
+        """Повертає поточні версії контенту (каталог, FAQ)"""
+        conn = Database.get_connection()
+        if not conn:
+            return None
+        
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name, version FROM content_versions')
+            return {row['name']: row['version'] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Помилка отримання версій контенту: {e}")
+            return None
+        finally:
+            conn.close()
+    
     @staticmethod
     def get_product_by_id(product_id: int):
         products = Database.get_all_products()
@@ -961,16 +1729,25 @@ class Database:
         return None
     
     @staticmethod
-    def update_product_image(product_id: int, image_data: bytes) -> bool:
-        """Оновлює зображення товару в БД"""
+    def update_product_image(product_id: int, image_data: bytes, image_hash: str, width: Optional[int] = None, height: Optional[int] = None) -> bool:
+        """Зберігає нормалізоване зображення в product_images (без дублікатів) і прив'язує до товару"""
         conn = Database.get_connection()
         if not conn:
             return False
         
         try:
             cursor = conn.cursor()
-            cursor.execute('UPDATE products SET image_data = %s WHERE id = %s', (psycopg2.Binary(image_data), product_id))
+            cursor.execute('''
+                INSERT INTO product_images (hash, data, width, height, size)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (hash) DO NOTHING
+            ''', (image_hash, psycopg2.Binary(image_data), width, height, len(image_data)))
+            cursor.execute('''
+                UPDATE products SET image_hash = %s, image_data = NULL, telegram_file_id = NULL
+                WHERE id = %s
+            ''', (image_hash, product_id))
             conn.commit()
+            blob_store.put(image_hash, image_data)
             logger.info(f"✅ Зображення товару #{product_id} оновлено в БД")
             return True
         except Exception as e:
@@ -988,7 +1765,7 @@ class Database:
         
         try:
             cursor = conn.cursor()
-            cursor.execute('UPDATE products SET image_data = NULL WHERE id = %s', (product_id,))
+            cursor.execute('UPDATE products SET image_hash = NULL, image_data = NULL, telegram_file_id = NULL WHERE id = %s', (product_id,))
             conn.commit()
             logger.info(f"✅ Зображення товару #{product_id} видалено з БД")
             return True
@@ -1048,14 +1825,360 @@ def get_product_by_id(product_id: int):
 def get_products_from_db():
     return Database.get_all_products()
 
-PRODUCTS = get_products_from_db()
+# Каталог завантажується під час прогріву в main(), а не при імпорті модуля
+PRODUCTS = []
 
 def refresh_products():
     global PRODUCTS
     PRODUCTS = get_products_from_db()
     logger.info(f"🔄 Оновлено товари: {len(PRODUCTS)} позицій")
 
-refresh_products()
+# ========== КЕШ КЛАВІАТУР ==========
+
+# Як часто перевіряти версії контенту в БД (секунди); зміни з адмін-бота
+# приходять раніше через NOTIFY, інтервал лише страхує від пропущених сповіщень
+CONTENT_VERSION_CHECK_INTERVAL = 30.0
+content_versions = {}
+content_versions_checked_at = 0.0
+products_version = None
+markup_cache: Dict[str, Tuple[Optional[int], InlineKeyboardMarkup]] = {}
+
+def get_content_version(name: str) -> int:
+    """Повертає версію контенту, звертаючись до БД не частіше ніж раз на інтервал"""
+    global content_versions, content_versions_checked_at
+    now = time.monotonic()
+    if now - content_versions_checked_at >= CONTENT_VERSION_CHECK_INTERVAL:
+        versions = Database.get_content_versions()
+        if versions is not None:
+            content_versions = versions
+        content_versions_checked_at = now
+    return content_versions.get(name, 0)
+
+def mark_content_versions_stale():
+    """Змушує перечитати версії контенту при наступному зверненні"""
+    global content_versions_checked_at
+    content_versions_checked_at = 0.0
+
+def ensure_products_fresh():
+    """Перечитує товари з БД лише якщо змінилась версія каталогу"""
+    global products_version
+    version = get_content_version("catalog")
+    if version != products_version:
+        refresh_products()
+        products_version = version
+
+def cached_markup(name: str, version_key: Optional[str] = None):
+    """Декоратор: кешує клавіатуру за назвою меню та версією контенту"""
+    def decorator(builder):
+        @functools.wraps(builder)
+        def wrapper() -> InlineKeyboardMarkup:
+            version = get_content_version(version_key) if version_key else None
+            cached = markup_cache.get(name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            markup = builder()
+            markup_cache[name] = (version, markup)
+            return markup
+        return wrapper
+    return decorator
+
+def warm_markup_cache():
+    """Будує кешовані меню наперед, щоб перші користувачі не чекали"""
+    for builder in (get_main_menu, get_contact_menu, get_order_confirmation_keyboard, get_products_menu, get_faq_menu):
+        builder()
+    logger.info(f"✅ Клавіатури підготовлено: {len(markup_cache)}")
+
+# ========== ОБРОБКА ЗОБРАЖЕНЬ ==========
+
+Image = None
+ImageOps = None
+
+@functools.lru_cache(maxsize=None)
+def load_pillow() -> bool:
+    """Імпортує Pillow при першій обробці фото, а не під час запуску"""
+    global Image, ImageOps
+    try:
+        from PIL import Image, ImageOps
+        logger.info("✅ Бібліотека Pillow завантажена, фото товарів нормалізуються")
+        return True
+    except ImportError:
+        logger.warning("⚠️ Бібліотека Pillow не встановлена, фото зберігаються без обробки")
+        return False
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+image_executor = None
+
+def normalize_product_image(raw: bytes) -> Tuple[bytes, str, Optional[int], Optional[int]]:
+    """Зменшує фото, перестискає в JPEG без метаданих і рахує sha256 (виконується в пулі процесів)"""
+    if not load_pillow():
+        return raw, hashlib.sha256(raw).hexdigest(), None, None
+    
+    with Image.open(BytesIO(raw)) as img:
+        # Для JPEG декодуємо одразу в зменшеному масштабі
+        img.draft('RGB', (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        # EXIF та інші метадані не передаються в save, тому не потрапляють у файл
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+        data = output.getvalue()
+        width, height = img.size
+    
+    return data, hashlib.sha256(data).hexdigest(), width, height
+
+def get_image_executor() -> ProcessPoolExecutor:
+    """Пул процесів для декодування зображень (створюється при першому використанні)"""
+    global image_executor
+    if image_executor is None:
+        # spawn, а не fork: у процесі вже працюють потоки, і форкнута дитина могла б успадкувати
+        # захоплене блокування (logging, libpq, OpenSSL); імпорт модуля тепер без побічних ефектів
+        image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return image_executor
+
+async def prepare_product_image(raw: bytes) -> Optional[Tuple[bytes, str, Optional[int], Optional[int]]]:
+    """Нормалізує зображення в пулі процесів, не блокуючи цикл подій"""
+    global image_executor
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(get_image_executor(), normalize_product_image, raw)
+    except BrokenProcessPool as e:
+        logger.error(f"❌ Пул обробки зображень зупинився, буде створено новий: {e}")
+        image_executor = None
+        return None
+    except Exception as e:
+        logger.error(f"❌ Не вдалося обробити зображення: {e}")
+        return None
+    
+    data, image_hash, width, height = result
+    logger.info(f"🖼 Зображення нормалізовано: {len(raw)} → {len(data)} байт, {width}x{height}, {image_hash[:12]}")
+    return result
+
+class BlobStore:
+    """Контентно-адресоване сховище зображень на томі /app/data з LRU-кешем гарячих файлів.
+    
+    Оригінал завжди лежить у product_images (адмін-бот не має доступу до тому),
+    тут зберігаються копії, щоб не читати байти з БД при кожному показі.
+    """
+    
+    def __init__(self, root: str, max_cache_bytes: int):
+        self.root = root
+        self.max_cache_bytes = max_cache_bytes
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.enabled = False
+    
+    def open(self):
+        """Готує каталог сховища (під час запуску, не при імпорті)"""
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            self.enabled = True
+        except OSError as e:
+            logger.warning(f"⚠️ Сховище зображень {self.root} недоступне, використовується лише БД: {e}")
+            self.enabled = False
+    
+    def path_for(self, image_hash: str) -> str:
+        return os.path.join(self.root, image_hash[:2], image_hash)
+    
+    def get(self, image_hash: str) -> Optional[bytes]:
+        """Повертає байти з LRU або з файлу через mmap"""
+        data = self.cache.get(image_hash)
+        if data is not None:
+            self.cache.move_to_end(image_hash)
+            return data
+        if not self.enabled:
+            return None
+        
+        path = self.path_for(image_hash)
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data = mapped[:]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Помилка читання {path}: {e}")
+            return None
+        
+        # Файл міг бути пошкоджений - вміст зобов'язаний збігатися з іменем
+        if hashlib.sha256(data).hexdigest() != image_hash:
+            logger.warning(f"⚠️ Пошкоджений файл зображення {path}, видаляємо")
+            self.discard(image_hash)
+            return None
+        
+        self.remember(image_hash, data)
+        return data
+    
+    def put(self, image_hash: str, data: bytes):
+        """Атомарно записує файл (якщо його ще немає) і кладе байти в LRU"""
+        self.remember(image_hash, data)
+        if not self.enabled:
+            return
+        
+        path = self.path_for(image_hash)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не вдалося записати {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    
+    def remember(self, image_hash: str, data: bytes):
+        if len(data) > self.max_cache_bytes or image_hash in self.cache:
+            return
+        self.cache[image_hash] = data
+        self.cache_bytes += len(data)
+        while self.cache_bytes > self.max_cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= len(evicted)
+    
+    def discard(self, image_hash: str):
+        data = self.cache.pop(image_hash, None)
+        if data is not None:
+            self.cache_bytes -= len(data)
+        try:
+            os.remove(self.path_for(image_hash))
+        except OSError:
+            pass
+    
+    def prune(self, keep: set, min_age: float = 0) -> int:
+        """Видаляє з тому файли, яких більше немає в product_images; повертає їх кількість.
+        
+        Файли, молодші за min_age секунд, лишаються: їх могла щойно записати інша репліка.
+        """
+        if not self.enabled:
+            return 0
+        removed = 0
+        cutoff = time.time() - min_age
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename in keep:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.warning(f"⚠️ Не вдалося видалити {filename}: {e}")
+        return removed
+
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "/app/data/blobs")
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+blob_store = BlobStore(BLOB_STORE_DIR, BLOB_CACHE_MAX_BYTES)
+
+def load_product_image(product_id: int, image_hash: Optional[str]) -> Optional[bytes]:
+    """Читає фото товару з локального сховища, а при промаху - з БД із записом на том"""
+    if not image_hash:
+        # Фото, збережене до появи product_images
+        return Database.get_product_image(product_id)
+    
+    data = blob_store.get(image_hash)
+    if data is None:
+        data = Database.get_image_blob(image_hash)
+        if data:
+            blob_store.put(image_hash, data)
+    return data
+
+# ========== ЗАВАНТАЖЕННЯ ЗОБРАЖЕНЬ ЗА URL ==========
+
+IMAGE_DOWNLOAD_MAX_BYTES = int(os.getenv("IMAGE_DOWNLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_DOWNLOAD_TIMEOUT = 30
+IMAGE_SNIFF_BYTES = 16
+http_client = None
+
+class ImageDownloadError(Exception):
+    """Помилка завантаження зображення, текст якої можна показати адміну"""
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Визначає формат зображення за сигнатурою перших байтів"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    return None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Спільний HTTP-клієнт з пулом з'єднань для завантаження зображень"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(IMAGE_DOWNLOAD_TIMEOUT, connect=10),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            follow_redirects=True,
+            headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+        )
+    return http_client
+
+async def close_http_client(application: Application):
+    """Закриває HTTP-клієнт при зупинці бота"""
+    if http_client is not None and not http_client.is_closed:
+        await http_client.aclose()
+
+async def download_image(url: str, client: Optional[httpx.AsyncClient] = None, max_bytes: int = IMAGE_DOWNLOAD_MAX_BYTES) -> bytes:
+    """Потоково завантажує зображення, обриваючи передачу при перевищенні ліміту або не-зображенні"""
+    client = client or get_http_client()
+    try:
+        async with client.stream('GET', url) as response:
+            if response.status_code >= 400:
+                raise ImageDownloadError(f"сервер відповів кодом {response.status_code}")
+            
+            content_length = response.headers.get('content-length', '')
+            if content_length.isdigit() and int(content_length) > max_bytes:
+                raise ImageDownloadError(f"файл завеликий ({int(content_length) // 1024} КБ, максимум {max_bytes // 1024} КБ)")
+            
+            buffer = bytearray()
+            sniffed = False
+            async for chunk in response.aiter_bytes():
+                buffer.extend(chunk)
+                if len(buffer) > max_bytes:
+                    raise ImageDownloadError(f"файл завеликий (понад {max_bytes // 1024} КБ)")
+                # Заголовку Content-Type не довіряємо - перевіряємо сигнатуру вмісту
+                if not sniffed and len(buffer) >= IMAGE_SNIFF_BYTES:
+                    if not sniff_image_type(bytes(buffer[:IMAGE_SNIFF_BYTES])):
+                        content_type = response.headers.get('content-type', 'невідомий тип')
+                        raise ImageDownloadError(f"посилання веде не на зображення ({content_type})")
+                    sniffed = True
+            
+            if not sniffed and not sniff_image_type(bytes(buffer)):
+                raise ImageDownloadError("посилання веде не на зображення")
+    except httpx.TimeoutException:
+        raise ImageDownloadError(f"сервер не відповів за {IMAGE_DOWNLOAD_TIMEOUT} с")
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
+        raise ImageDownloadError(f"помилка з'єднання: {e}")
+    
+    logger.info(f"✅ Зображення завантажено, розмір: {len(buffer)} байт")
+    return bytes(buffer)
 
 # ========== КОМАНДИ ДЛЯ АДМІНІВ ==========
 
@@ -1133,9 +2256,15 @@ async def handle_admin_photo(update: Update, context: ContextTypes.DEFAULT_TYPE)
         file_id = update.message.photo[-1].file_id
         file = await context.bot.get_file(file_id)
         file_bytes = await file.download_as_bytearray()
+        image = await prepare_product_image(bytes(file_bytes))
         
         # Зберігаємо в БД
-        if Database.update_product_image(product_id, bytes(file_bytes)):
+        if not image:
+            await update.message.reply_text(
+                f"❌ Не вдалося обробити зображення",
+                reply_markup=get_main_menu()
+            )
+        elif Database.update_product_image(product_id, *image):
             await update.message.reply_text(
                 f"✅ Фото для товару #{product_id} - {product['name']} успішно збережено!",
                 reply_markup=get_main_menu()
@@ -1173,31 +2302,35 @@ async def handle_admin_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     product_id = context.user_data['setphoto_product_id']
     product = get_product_by_id(product_id)
     
-    # Завантажуємо зображення за URL
-    await update.message.reply_text("⏰ Завантажую зображення...")
+    # Очищаємо сесію
+    del context.user_data['setphoto_product_id']
+    del context.user_data['setphoto_mode']
     
+    # Завантаження йде окремою задачею, щоб не затримувати обробку інших оновлень
+    await update.message.reply_text("⏰ Завантажую зображення...")
+    context.application.create_task(
+        save_product_image_from_url(context.bot, update.effective_chat.id, product_id, product['name'], text),
+        update=update
+    )
+
+async def save_product_image_from_url(bot: Bot, chat_id: int, product_id: int, product_name: str, url: str):
+    """Завантажує, нормалізує та зберігає фото товару за URL"""
     try:
-        import requests
-        response = requests.get(text, timeout=30)
-        response.raise_for_status()
-        
-        # Зберігаємо в БД
-        if Database.update_product_image(product_id, response.content):
-            await update.message.reply_text(
-                f"✅ Фото для товару #{product_id} - {product['name']} успішно збережено!",
-                reply_markup=get_main_menu()
-            )
-        else:
-            await update.message.reply_text(
-                f"❌ Помилка при збереженні фото",
-                reply_markup=get_main_menu()
-            )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Помилка завантаження зображення: {e}")
+        raw = await download_image(url)
+    except ImageDownloadError as e:
+        await bot.send_message(chat_id, f"❌ Помилка завантаження зображення: {e}", reply_markup=get_main_menu())
+        return
     
-    # Очищаємо сесію
-    del context.user_data['setphoto_product_id']
-    del context.user_data['setphoto_mode']
+    image = await prepare_product_image(raw)
+    
+    # Зберігаємо в БД
+    if not image:
+        text = "❌ Не вдалося обробити зображення. Перевірте, що посилання веде на картинку."
+    elif Database.update_product_image(product_id, *image):
+        text = f"✅ Фото для товару #{product_id} - {product_name} успішно збережено!"
+    else:
+        text = "❌ Помилка при збереженні фото"
+    await bot.send_message(chat_id, text, reply_markup=get_main_menu())
 
 def create_inline_keyboard(buttons: List[List[Dict]]) -> InlineKeyboardMarkup:
     keyboard = []
@@ -1213,6 +2346,7 @@ def create_inline_keyboard(buttons: List[List[Dict]]) -> InlineKeyboardMarkup:
         keyboard.append(keyboard_row)
     return InlineKeyboardMarkup(keyboard)
 
+@cached_markup("main_menu")
 def get_main_menu() -> InlineKeyboardMarkup:
     buttons = [
         [{"text": "🏢 Про компанію", "callback_data": "company"}],
@@ -1226,12 +2360,14 @@ def get_main_menu() -> InlineKeyboardMarkup:
     ]
     return create_inline_keyboard(buttons)
 
+@functools.lru_cache(maxsize=128)
 def get_back_keyboard(back_to: str) -> InlineKeyboardMarkup:
     buttons = [[{"text": "🔙 Назад", "callback_data": f"back_{back_to}"}]]
     return create_inline_keyboard(buttons)
 
+@cached_markup("products", "catalog")
 def get_products_menu() -> InlineKeyboardMarkup:
-    refresh_products()
+    ensure_products_fresh()
     buttons = []
     for product in PRODUCTS:
         button_text = f"{product['name']}\n{product['price']} грн/{product['unit']}"
@@ -1248,6 +2384,7 @@ def get_products_menu() -> InlineKeyboardMarkup:
     buttons.append([{"text": "🔙 Назад", "callback_data": "back_main_menu"}])
     return create_inline_keyboard(buttons)
 
+@functools.lru_cache(maxsize=256)
 def get_product_detail_menu(product_id: int) -> InlineKeyboardMarkup:
     buttons = [
         [{"text": "🛒 Додати в кошик", "callback_data": f"add_to_cart_{product_id}"}],
@@ -1256,6 +2393,7 @@ def get_product_detail_menu(product_id: int) -> InlineKeyboardMarkup:
     ]
     return create_inline_keyboard(buttons)
 
+@functools.lru_cache(maxsize=256)
 def get_quick_order_menu(product_id: int) -> InlineKeyboardMarkup:
     buttons = [
         [{"text": "📞 Зателефонуйте мені", "callback_data": f"quick_call_{product_id}"}],
@@ -1264,8 +2402,9 @@ def get_quick_order_menu(product_id: int) -> InlineKeyboardMarkup:
     ]
     return create_inline_keyboard(buttons)
 
+@cached_markup("faq", "faq")
 def get_faq_menu() -> InlineKeyboardMarkup:
-    # Отримуємо свіжі FAQ з БД при кожному запиті
+    # Перебудовується лише коли змінилась версія FAQ
     faqs = get_all_faqs()
     buttons = []
     for faq in faqs:
@@ -1277,6 +2416,7 @@ def get_faq_menu() -> InlineKeyboardMarkup:
     buttons.append([{"text": "🔙 Назад", "callback_data": "back_main_menu"}])
     return create_inline_keyboard(buttons)
 
+@cached_markup("contact")
 def get_contact_menu() -> InlineKeyboardMarkup:
     buttons = [
         [{"text": "📞 Зателефонувати", "callback_data": "call_us"}],
@@ -1303,6 +2443,7 @@ def get_cart_menu(cart_items: List) -> InlineKeyboardMarkup:
     buttons.append([{"text": "🔙 Назад", "callback_data": "back_main_menu"}])
     return create_inline_keyboard(buttons)
 
+@cached_markup("order_confirmation")
 def get_order_confirmation_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         [{"text": "✅ Так, продовжити", "callback_data": "confirm_order_yes"}],
@@ -1353,16 +2494,27 @@ def validate_phone(phone: str) -> Tuple[bool, str]:
         return True, phone
     return False, phone
 
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    """Номер у форматі E.164 (+380XXXXXXXXX); іноземні та нестандартні номери - '+' і лише цифри"""
+    if not phone:
+        return None
+    is_valid, formatted_phone = validate_phone(phone)
+    if is_valid:
+        return formatted_phone
+    # Щоб такі номери теж потрапляли в індекс і знаходились пошуком за початком чи кінцем
+    digits = re.sub(r'\D', '', phone)
+    return "+" + digits if digits else None
+
 def get_welcome_text() -> str:
-    # Отримуємо актуальне вітальне повідомлення з БД
+    # Кешоване вітальне повідомлення, оновлюється після змін в адмін-боті
     return get_welcome_message()
 
 def get_company_text() -> str:
-    # Отримуємо актуальний текст з БД
+    # Кешований текст, оновлюється після змін в адмін-боті
     return get_company_info()
 
 def get_product_text(product_id: int) -> str:
-    refresh_products()
+    ensure_products_fresh()
     product = next((p for p in PRODUCTS if p["id"] == product_id), None)
     if not product:
         return "❌ Продукт не знайдено"
@@ -1376,7 +2528,7 @@ def get_product_text(product_id: int) -> str:
     return text
 
 def get_quick_order_text(product_id: int) -> str:
-    refresh_products()
+    ensure_products_fresh()
     product = next((p for p in PRODUCTS if p["id"] == product_id), None)
     if not product:
         return "❌ Продукт не знайдено"
@@ -1395,29 +2547,16 @@ def get_quick_order_text(product_id: int) -> str:
 """
 
 def get_faq_text(faq_id: int) -> str:
-    # Отримуємо конкретний FAQ з БД
-    conn = get_db_connection()
-    if not conn:
-        return "❌ Помилка отримання даних"
-    
-    try:
-        cursor = conn.cursor()
-        cursor.execute('SELECT question, answer FROM faq WHERE id = %s', (faq_id,))
-        row = cursor.fetchone()
-        if row:
-            return f"""
-{row['question']}
+    faq = get_faq_by_id(faq_id)
+    if faq:
+        return f"""
+{faq['question']}
 
-{row['answer']}
+{faq['answer']}
 
 Маєте інші запитання? Зв'яжіться з нами: +380932599103
             """
-        return "❌ Питання не знайдено"
-    except Exception as e:
-        logger.error(f"Помилка отримання faq за ID: {e}")
-        return "❌ Помилка отримання даних"
-    finally:
-        conn.close()
+    return "❌ Питання не знайдено"
 
 def get_contact_text() -> str:
     return """
@@ -1479,7 +2618,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         logger.info(f"👤 [{datetime.now().strftime('%H:%M:%S')}] {user.first_name or 'Користувач'}: /start")
         
-        Database.save_user(user_id, user.first_name, user.last_name or "", user.username or "")
+        remember_user(user)
         
         log_user({
             "user_id": user_id,
@@ -1488,10 +2627,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "username": user.username or ""
         })
         
-        Database.clear_user_session(user_id)
+        Database.reset_user_session(user_id)
         welcome = get_welcome_text()
         await update.message.reply_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
-        Database.save_user_session(user_id, last_section="main_menu")
         
     except Exception as e:
         logger.error(f"❌ Помилка в start: {e}")
@@ -1509,10 +2647,194 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         del context.user_data['setphoto_mode']
         await update.message.reply_text("❌ Встановлення фото скасовано", reply_markup=get_main_menu())
     
-    Database.clear_user_session(user_id)
+    Database.reset_user_session(user_id)
     welcome = get_welcome_text()
     await update.message.reply_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
-    Database.save_user_session(user_id, last_section="main_menu")
+
+# ========== ЗАХИСТ ВІД ФЛУДУ ==========
+
+FLOOD_BUCKET_CAPACITY = 8
+FLOOD_REFILL_PER_SECOND = 2.0
+CALLBACK_DEBOUNCE_SECONDS = 1.0
+FLOOD_TRACKED_USERS = 10000
+EDIT_CACHE_SIZE = 5000
+
+class FloodGuard:
+    """Токен-бакет на користувача та відсікання повторних натискань тієї ж кнопки"""
+    
+    def __init__(self, capacity: int, refill_per_second: float, debounce_seconds: float, max_users: int):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.debounce_seconds = debounce_seconds
+        self.max_users = max_users
+        # user_id -> [токени, час оновлення, останній callback_data, час останнього callback]
+        self.states = OrderedDict()
+    
+    def check(self, user_id: int, callback_data: Optional[str] = None) -> Optional[str]:
+        """Повертає None, якщо оновлення можна обробити, або причину відмови"""
+        now = time.monotonic()
+        state = self.states.get(user_id)
+        if state is None:
+            state = [float(self.capacity), now, None, 0.0]
+            self.states[user_id] = state
+            if len(self.states) > self.max_users:
+                self.states.popitem(last=False)
+        else:
+            self.states.move_to_end(user_id)
+        
+        if callback_data is not None and callback_data == state[2] and now - state[3] < self.debounce_seconds:
+            return "debounce"
+        
+        state[0] = min(self.capacity, state[0] + (now - state[1]) * self.refill_per_second)
+        state[1] = now
+        if state[0] < 1:
+            return "rate"
+        state[0] -= 1
+        
+        if callback_data is not None:
+            state[2] = callback_data
+            state[3] = now
+        return None
+
+flood_guard = FloodGuard(FLOOD_BUCKET_CAPACITY, FLOOD_REFILL_PER_SECOND, CALLBACK_DEBOUNCE_SECONDS, FLOOD_TRACKED_USERS)
+
+async def flood_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Проміжний обробник (група -1): відкидає оновлення понад ліміт до звернень у БД"""
+    user = update.effective_user
+    if not user:
+        return
+    
+    query = update.callback_query
+    verdict = flood_guard.check(user.id, query.data if query else None)
+    if verdict is None:
+        return
+    
+    logger.info(f"🚦 Відкинуто оновлення від {user.id}: {verdict}")
+    if query:
+        try:
+            await query.answer("⏳ Зачекайте трохи..." if verdict == "rate" else None)
+        except Exception:
+            pass
+    raise ApplicationHandlerStop
+
+# Останній вміст, встановлений у кожне повідомлення: (chat_id, message_id) -> хеш
+edited_messages = OrderedDict()
+
+async def edit_message(query, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, parse_mode: Optional[str] = None) -> bool:
+    """Редагує повідомлення, пропускаючи виклик API, якщо текст і клавіатура не змінились"""
+    message = query.message
+    key = (message.chat_id, message.message_id) if message else None
+    fingerprint = hash((text, parse_mode, reply_markup))
+    if key is not None and edited_messages.get(key) == fingerprint:
+        edited_messages.move_to_end(key)
+        return True
+    
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+    
+    if key is not None:
+        edited_messages[key] = fingerprint
+        edited_messages.move_to_end(key)
+        if len(edited_messages) > EDIT_CACHE_SIZE:
+            edited_messages.popitem(last=False)
+    return True
+
+# Профілі користувачів, які вже збережені в БД: user_id -> (ім'я, прізвище, username)
+seen_users = OrderedDict()
+
+def remember_user(user) -> None:
+    """Зберігає користувача в БД лише коли він новий або змінив профіль"""
+    profile = (user.first_name, user.last_name or "", user.username or "")
+    if seen_users.get(user.id) == profile:
+        seen_users.move_to_end(user.id)
+        return
+    if Database.save_user(user.id, *profile):
+        seen_users[user.id] = profile
+        seen_users.move_to_end(user.id)
+        if len(seen_users) > FLOOD_TRACKED_USERS:
+            seen_users.popitem(last=False)
+
+# ========== ІДЕМПОТЕНТНЕ ОФОРМЛЕННЯ ==========
+
+CHECKOUT_MEMO_SIZE = 1000
+# (chat_id, message_id) кнопки підтвердження -> текст результату оформлення
+completed_checkouts = OrderedDict()
+
+def get_checkout_key(user_id: int, temp_data: Dict) -> Optional[str]:
+    """Ключ ідемпотентності з ідентифікатора оформлення та вмісту кошика"""
+    if not temp_data.get("checkout_id") or not temp_data.get("items"):
+        return None
+    payload = json.dumps({
+        "user_id": user_id,
+        "checkout_id": temp_data["checkout_id"],
+        "items": temp_data["items"],
+        "total": round(temp_data.get("total", 0), 2)
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def remember_checkout(key: Tuple[int, int], text: str):
+    completed_checkouts[key] = text
+    if len(completed_checkouts) > CHECKOUT_MEMO_SIZE:
+        completed_checkouts.popitem(last=False)
+
+def is_invalid_file_id_error(error: BadRequest) -> bool:
+    """Чи стосується помилка самого file_id (а не чату чи користувача)"""
+    message = str(error).lower()
+    return "file identifier" in message or "file_id" in message or "wrong type of the web page content" in message
+
+async def send_product_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, product_id: int, caption: str) -> bool:
+    """Відправляє фото товару: за кешованим file_id, а якщо його немає - байтами зі сховища"""
+    file_id, image_hash, has_image = Database.get_product_photo_ref(product_id)
+    
+    if file_id:
+        try:
+            await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                parse_mode='HTML',
+                reply_markup=get_product_detail_menu(product_id)
+            )
+            return True
+        except BadRequest as e:
+            # Скидаємо спільний file_id лише коли Telegram відкинув сам ідентифікатор файлу
+            if not is_invalid_file_id_error(e):
+                logger.warning(f"⚠️ Не вдалося відправити фото товару #{product_id}: {e}")
+                return False
+            logger.warning(f"⚠️ file_id фото товару #{product_id} недійсний, завантажуємо заново: {e}")
+            Database.save_product_file_id(product_id, None, image_hash)
+        except Exception as e:
+            logger.warning(f"⚠️ Не вдалося відправити фото товару #{product_id}: {e}")
+            return False
+    
+    if not has_image:
+        return False
+    
+    image_data = load_product_image(product_id, image_hash)
+    if not image_data:
+        return False
+    
+    try:
+        photo = BytesIO(image_data)
+        photo.name = f"product_{product_id}.jpg"
+        logger.info(f"📸 Відправляємо фото з БД для товару #{product_id}")
+        
+        sent_message = await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=caption,
+            parse_mode='HTML',
+            reply_markup=get_product_detail_menu(product_id)
+        )
+        if sent_message.photo:
+            Database.save_product_file_id(product_id, sent_message.photo[-1].file_id, image_hash)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Помилка відправки фото з БД: {e}")
+        return False
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -1526,7 +2848,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         logger.info(f"🖱️ [{datetime.now().strftime('%H:%M:%S')}] {user.first_name or 'Користувач'} натиснув: {data}")
         
-        Database.save_user(user_id, user.first_name, user.last_name or "", user.username or "")
+        remember_user(user)
         
         # Обробка кнопок "Назад"
         if data.startswith("back_"):
@@ -1534,28 +2856,28 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if back_target == "main_menu":
                 welcome = get_welcome_text()
                 try:
-                    await query.edit_message_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
+                    await edit_message(query, welcome, reply_markup=get_main_menu(), parse_mode='HTML')
                 except Exception:
                     await query.message.reply_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
                 Database.save_user_session(user_id, last_section="main_menu")
             elif back_target == "products":
                 products_text = "📦 Наші продукти\n\nОберіть продукт для детальної інформації:"
                 try:
-                    await query.edit_message_text(products_text, reply_markup=get_products_menu(), parse_mode='HTML')
+                    await edit_message(query, products_text, reply_markup=get_products_menu(), parse_mode='HTML')
                 except Exception:
                     await query.message.reply_text(products_text, reply_markup=get_products_menu(), parse_mode='HTML')
                 Database.save_user_session(user_id, last_section="products")
             elif back_target == "faq":
                 faq_text = "❓ Часті запитання\n\nОберіть питання для отримання відповіді:"
                 try:
-                    await query.edit_message_text(faq_text, reply_markup=get_faq_menu(), parse_mode='HTML')
+                    await edit_message(query, faq_text, reply_markup=get_faq_menu(), parse_mode='HTML')
                 except Exception:
                     await query.message.reply_text(faq_text, reply_markup=get_faq_menu(), parse_mode='HTML')
                 Database.save_user_session(user_id, last_section="faq")
             elif back_target == "contact":
                 contact_text = get_contact_text()
                 try:
-                    await query.edit_message_text(contact_text, reply_markup=get_contact_menu(), parse_mode='HTML')
+                    await edit_message(query, contact_text, reply_markup=get_contact_menu(), parse_mode='HTML')
                 except Exception:
                     await query.message.reply_text(contact_text, reply_markup=get_contact_menu(), parse_mode='HTML')
                 Database.save_user_session(user_id, last_section="contact")
@@ -1563,7 +2885,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 cart_items = Database.get_cart_items(user_id)
                 cart_text = get_cart_text(cart_items)
                 try:
-                    await query.edit_message_text(cart_text, reply_markup=get_cart_menu(cart_items), parse_mode='HTML')
+                    await edit_message(query, cart_text, reply_markup=get_cart_menu(cart_items), parse_mode='HTML')
                 except Exception:
                     await query.message.reply_text(cart_text, reply_markup=get_cart_menu(cart_items), parse_mode='HTML')
                 Database.save_user_session(user_id, last_section="cart")
@@ -1571,14 +2893,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 orders = Database.get_user_orders(user_id)
                 text = get_my_orders_text(orders)
                 try:
-                    await query.edit_message_text(text, reply_markup=get_my_orders_menu(orders), parse_mode='HTML')
+                    await edit_message(query, text, reply_markup=get_my_orders_menu(orders), parse_mode='HTML')
                 except Exception:
                     await query.message.reply_text(text, reply_markup=get_my_orders_menu(orders), parse_mode='HTML')
                 Database.save_user_session(user_id, last_section="my_orders")
             else:
                 welcome = get_welcome_text()
                 try:
-                    await query.edit_message_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
+                    await edit_message(query, welcome, reply_markup=get_main_menu(), parse_mode='HTML')
                 except Exception:
                     await query.message.reply_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
                 Database.save_user_session(user_id, last_section="main_menu")
@@ -1587,39 +2909,39 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Основні розділи меню
         elif data == "company":
             company_text = get_company_text()
-            await query.edit_message_text(company_text, reply_markup=get_back_keyboard("main_menu"), parse_mode='HTML')
+            await edit_message(query, company_text, reply_markup=get_back_keyboard("main_menu"), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="company")
             return
         
         elif data == "products":
             products_text = "📦 Наші продукти\n\nОберіть продукт для детальної інформації:"
-            await query.edit_message_text(products_text, reply_markup=get_products_menu(), parse_mode='HTML')
+            await edit_message(query, products_text, reply_markup=get_products_menu(), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="products")
             return
         
         elif data == "faq":
             faq_text = "❓ Часті запитання\n\nОберіть питання для отримання відповіді:"
-            await query.edit_message_text(faq_text, reply_markup=get_faq_menu(), parse_mode='HTML')
+            await edit_message(query, faq_text, reply_markup=get_faq_menu(), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="faq")
             return
         
         elif data == "cart":
             cart_items = Database.get_cart_items(user_id)
             cart_text = get_cart_text(cart_items)
-            await query.edit_message_text(cart_text, reply_markup=get_cart_menu(cart_items), parse_mode='HTML')
+            await edit_message(query, cart_text, reply_markup=get_cart_menu(cart_items), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="cart")
             return
         
         elif data == "my_orders":
             orders = Database.get_user_orders(user_id)
             text = get_my_orders_text(orders)
-            await query.edit_message_text(text, reply_markup=get_my_orders_menu(orders), parse_mode='HTML')
+            await edit_message(query, text, reply_markup=get_my_orders_menu(orders), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="my_orders")
             return
         
         elif data == "contact":
             contact_text = get_contact_text()
-            await query.edit_message_text(contact_text, reply_markup=get_contact_menu(), parse_mode='HTML')
+            await edit_message(query, contact_text, reply_markup=get_contact_menu(), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="contact")
             return
         
@@ -1635,7 +2957,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 contact_info += "Самовивіз можливий за попереднім домовленням\n\n"
                 contact_info += "Графік самовивозу: Пн-Пт 9:00-18:00, Сб 10:00-15:00"
             
-            await query.edit_message_text(contact_info, reply_markup=get_back_keyboard("contact"), parse_mode='HTML')
+            await edit_message(query, contact_info, reply_markup=get_back_keyboard("contact"), parse_mode='HTML')
             return
         
         elif data == "write_here":
@@ -1654,48 +2976,30 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif data.startswith("product_"):
             product_id = int(data.split("_")[1])
-            refresh_products()
+            ensure_products_fresh()
             product = get_product_by_id(product_id)
             product_text = get_product_text(product_id)
             
             logger.info(f"📦 Відкрито товар #{product_id}")
             
-            # Отримуємо зображення з БД
-            image_data = Database.get_product_image(product_id)
-            
-            if image_data:
-                try:
-                    from io import BytesIO
-                    photo = BytesIO(image_data)
-                    photo.name = f"product_{product_id}.jpg"
-                    logger.info(f"📸 Відправляємо фото з БД для товару #{product_id}")
-                    
-                    await context.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=photo,
-                        caption=product_text,
-                        parse_mode='HTML',
-                        reply_markup=get_product_detail_menu(product_id)
-                    )
-                    await query.message.delete()
-                    Database.save_user_session(user_id, last_section=f"product_{product_id}")
-                    return
-                except Exception as e:
-                    logger.error(f"❌ Помилка відправки фото з БД: {e}")
+            if await send_product_photo(context, chat_id, product_id, product_text):
+                await query.message.delete()
+                Database.save_user_session(user_id, last_section=f"product_{product_id}")
+                return
             
             # Якщо немає фото або помилка, відправляємо тільки текст
-            await query.edit_message_text(product_text, reply_markup=get_product_detail_menu(product_id), parse_mode='HTML')
+            await edit_message(query, product_text, reply_markup=get_product_detail_menu(product_id), parse_mode='HTML')
             
             Database.save_user_session(user_id, last_section=f"product_{product_id}")
             return
         
         elif data.startswith("add_to_cart_"):
             product_id = int(data.split("_")[3])
-            refresh_products()
+            ensure_products_fresh()
             product = next((p for p in PRODUCTS if p["id"] == product_id), None)
             
             if not product:
-                await query.edit_message_text("❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
+                await edit_message(query, "❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
                 return
             
             temp_data = {"product_id": product_id}
@@ -1713,11 +3017,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif data.startswith("quick_order_"):
             product_id = int(data.split("_")[2])
-            refresh_products()
+            ensure_products_fresh()
             product = next((p for p in PRODUCTS if p["id"] == product_id), None)
             
             if not product:
-                await query.edit_message_text("❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
+                await edit_message(query, "❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
                 return
             
             quick_order_text = get_quick_order_text(product_id)
@@ -1735,7 +3039,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.delete()
             else:
                 # Якщо звичайне текстове повідомлення - редагуємо
-                await query.edit_message_text(
+                await edit_message(
+                    query,
                     quick_order_text, 
                     reply_markup=get_quick_order_menu(product_id), 
                     parse_mode='HTML'
@@ -1746,11 +3051,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif data.startswith("quick_call_"):
             product_id = int(data.split("_")[2])
-            refresh_products()
+            ensure_products_fresh()
             product = next((p for p in PRODUCTS if p["id"] == product_id), None)
             
             if not product:
-                await query.edit_message_text("❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
+                await edit_message(query, "❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
                 return
             
             temp_data = {"product_id": product_id}
@@ -1767,11 +3072,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif data.startswith("quick_chat_"):
             product_id = int(data.split("_")[2])
-            refresh_products()
+            ensure_products_fresh()
             product = next((p for p in PRODUCTS if p["id"] == product_id), None)
             
             if not product:
-                await query.edit_message_text("❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
+                await edit_message(query, "❌ Продукт не знайдено", reply_markup=get_back_keyboard("products"))
                 return
             
             user_name = f"{user.first_name or ''} {user.last_name or ''}"
@@ -1816,9 +3121,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 faq_id = int(data.split("_")[1])
                 faq_text = get_faq_text(faq_id)
-                await query.edit_message_text(faq_text, reply_markup=get_back_keyboard("faq"), parse_mode='HTML')
+                await edit_message(query, faq_text, reply_markup=get_back_keyboard("faq"), parse_mode='HTML')
             except (IndexError, ValueError):
-                await query.edit_message_text("❌ Помилка", reply_markup=get_back_keyboard("faq"))
+                await edit_message(query, "❌ Помилка", reply_markup=get_back_keyboard("faq"))
             return
         
         # ============== ОБРОБНИКИ КОРЗИНИ ==============
@@ -1828,7 +3133,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             Database.remove_from_cart(cart_id)
             cart_items = Database.get_cart_items(user_id)
             cart_text = get_cart_text(cart_items)
-            await query.edit_message_text(cart_text, reply_markup=get_cart_menu(cart_items), parse_mode='HTML')
+            await edit_message(query, cart_text, reply_markup=get_cart_menu(cart_items), parse_mode='HTML')
             return
         
         elif data == "checkout_cart":
@@ -1837,10 +3142,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not cart_items:
                 response = "🛒 Ваша корзина порожня\n\n"
                 response += "Додайте товари з каталогу перед оформленням замовлення!"
-                await query.edit_message_text(response, reply_markup=get_back_keyboard("main_menu"), parse_mode='HTML')
+                await edit_message(query, response, reply_markup=get_back_keyboard("main_menu"), parse_mode='HTML')
                 return
             
-            Database.save_user_session(user_id, "full_order_name", {})
+            # Ідентифікатор цього оформлення - основа ключа ідемпотентності
+            Database.save_user_session(user_id, "full_order_name", {"checkout_id": uuid.uuid4().hex})
             
             response = "🛒 Оформлення замовлення\n\n"
             response += f"📦 У вашій корзині: {len(cart_items)} товар(ів)\n"
@@ -1858,7 +3164,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response = "🗑️ Корзина очищена!\n\n"
             response += "Ваша корзина тепер порожня.\n"
             response += "Додайте товари з каталогу."
-            await query.edit_message_text(response, reply_markup=get_back_keyboard("main_menu"), parse_mode='HTML')
+            await edit_message(query, response, reply_markup=get_back_keyboard("main_menu"), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="main_menu")
             return
         
@@ -1866,7 +3172,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif data.startswith("user_order_"):
             order_id = int(data.split("_")[2])
-            await query.edit_message_text(
+            await edit_message(
+                query,
                 f"📋 Деталі замовлення #{order_id} (в розробці)",
                 reply_markup=get_back_keyboard("my_orders")
             )
@@ -1875,33 +3182,43 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # ============== ОБРОБНИКИ ПІДТВЕРДЖЕННЯ ЗАМОВЛЕННЯ ==============
         
         elif data.startswith("confirm_order_"):
+            memo_key = (query.message.chat_id, query.message.message_id) if query.message else None
+            if memo_key in completed_checkouts:
+                # Повторне натискання тієї ж кнопки - без звернень до БД і сповіщень
+                await edit_message(query, completed_checkouts[memo_key], reply_markup=get_main_menu(), parse_mode='HTML')
+                return
+            
             if data == "confirm_order_yes":
                 session = Database.get_user_session(user_id)
                 temp_data = session["temp_data"]
+                idempotency_key = get_checkout_key(user_id, temp_data)
                 
                 try:
-                    order_id = Database.create_order(temp_data)
+                    if not idempotency_key:
+                        # Сесію оформлення вже використано або вона застаріла
+                        order_id, created = 0, False
+                    else:
+                        order_id, created = Database.create_order(temp_data, idempotency_key)
                     
                     if order_id > 0:
-                        logger.info(f"\n{'='*80}")
-                        logger.info(f"✅ НОВЕ ЗАМОВЛЕННЯ #{order_id}:")
-                        logger.info(f"👤 Клієнт: {temp_data.get('user_name', '')}")
-                        logger.info(f"📞 Телефон: {temp_data.get('phone', '')}")
-                        logger.info(f"🏙️ Місто: {temp_data.get('city', '')}")
-                        logger.info(f"🏣 НП: {temp_data.get('np_department', '')}")
-                        logger.info(f"💰 Сума: {temp_data.get('total', 0):.2f} грн")
-                        logger.info(f"🛒 Товарів: {len(temp_data.get('items', []))}")
-                        logger.info(f"🆔 User ID: {user_id}")
-                        logger.info(f"{'='*80}\n")
-                        
-                        temp_data["order_id"] = order_id
-                        temp_data["status"] = "нове"
-                        temp_data["order_type"] = "regular"
-                        log_order(temp_data)
-                        
-                        await notify_admins_about_new_order(temp_data)
-                        
-                        Database.clear_user_session(user_id)
+                        if created:
+                            logger.info(f"\n{'='*80}")
+                            logger.info(f"✅ НОВЕ ЗАМОВЛЕННЯ #{order_id}:")
+                            logger.info(f"👤 Клієнт: {temp_data.get('user_name', '')}")
+                            logger.info(f"📞 Телефон: {temp_data.get('phone', '')}")
+                            logger.info(f"🏙️ Місто: {temp_data.get('city', '')}")
+                            logger.info(f"🏣 НП: {temp_data.get('np_department', '')}")
+                            logger.info(f"💰 Сума: {temp_data.get('total', 0):.2f} грн")
+                            logger.info(f"🛒 Товарів: {len(temp_data.get('items', []))}")
+                            logger.info(f"🆔 User ID: {user_id}")
+                            logger.info(f"{'='*80}\n")
+                            
+                            temp_data["order_id"] = order_id
+                            temp_data["status"] = "нове"
+                            temp_data["order_type"] = "regular"
+                            log_order(temp_data)
+                            
+                            await notify_admins_about_new_order(temp_data)
                         
                         text = f"✅ Замовлення оформлено!\n\n"
                         text += f"🆔 Номер замовлення: #{order_id}\n"
@@ -1912,31 +3229,33 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         text += f"💰 Сума: {temp_data.get('total', 0):.2f} грн\n\n"
                         text += "📞 Ми зв'яжемось з вами для підтвердження!\n\n"
                         text += "Дякуємо за замовлення!"
+                        if memo_key:
+                            remember_checkout(memo_key, text)
+                    elif not idempotency_key:
+                        text = "⚠️ Це оформлення вже завершено або застаріло.\n\n"
+                        text += "Перевірте розділ «Мої замовлення» або оформіть замовлення з корзини ще раз."
                     else:
                         text = "❌ Помилка оформлення замовлення!\n\n"
                         text += "Будь ласка, спробуйте ще раз або зв'яжіться з нами.\n\n"
                         text += "Вибачте за незручності."
-                        Database.clear_user_session(user_id)
                 except Exception as e:
                     logger.error(f"❌ Помилка при створенні замовлення: {e}")
                     text = "❌ Помилка оформлення замовлення!\n\n"
                     text += "Будь ласка, спробуйте ще раз.\n\n"
                     text += "Вибачте за незручності."
-                    Database.clear_user_session(user_id)
             else:
                 text = "❌ Замовлення скасовано\n\n"
                 text += "Ви можете продовжити покупки.\n"
                 text += "Ваша корзина збережена."
-                Database.clear_user_session(user_id)
             
-            await query.edit_message_text(text, reply_markup=get_main_menu(), parse_mode='HTML')
-            Database.save_user_session(user_id, last_section="main_menu")
+            Database.reset_user_session(user_id)
+            await edit_message(query, text, reply_markup=get_main_menu(), parse_mode='HTML')
             return
         
         else:
             logger.warning(f"⚠️ Невідомий callback: {data}")
             welcome = get_welcome_text()
-            await query.edit_message_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
+            await edit_message(query, welcome, reply_markup=get_main_menu(), parse_mode='HTML')
             Database.save_user_session(user_id, last_section="main_menu")
             
     except Exception as e:
@@ -1945,10 +3264,173 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text = "❌ Сталася помилка\n\n"
             text += "Будь ласка, спробуйте ще раз або використайте /start"
             keyboard = get_main_menu()
-            await query.edit_message_text(text, keyboard, parse_mode='HTML')
+            await edit_message(query, text, reply_markup=keyboard, parse_mode='HTML')
         except:
             pass
 
+# ========== ОФОРМЛЕННЯ ЗАМОВЛЕННЯ ==========
+
+class CheckoutPayload:
+    """Дані оформлення замовлення, що зберігаються в temp_data сесії"""
+    __slots__ = ("checkout_id", "user_name", "username", "phone", "city", "np_department",
+                 "total", "order_type", "user_id", "items")
+    
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+    
+    def apply(self, patch: Dict):
+        for name, value in patch.items():
+            setattr(self, name, value)
+
+class CheckoutStep:
+    """Крок оформлення: розбір введення у стані state та підказка для next_state"""
+    __slots__ = ("state", "next_state", "collect", "on_enter")
+    
+    def __init__(self, state: str, next_state: str, collect, on_enter):
+        self.state = state
+        self.next_state = next_state
+        self.collect = collect
+        self.on_enter = on_enter
+
+class CheckoutProfiler:
+    """Кількість та час обробки кожного кроку оформлення"""
+    
+    def __init__(self):
+        self.timings: Dict[str, List[float]] = {}
+    
+    def record(self, state: str, elapsed: float):
+        count, total, longest = self.timings.get(state, (0, 0.0, 0.0))
+        self.timings[state] = [count + 1, total + elapsed, max(longest, elapsed)]
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            state: {"count": count, "avg_ms": round(total / count * 1000, 1), "max_ms": round(longest * 1000, 1)}
+            for state, (count, total, longest) in self.timings.items()
+        }
+
+checkout_profiler = CheckoutProfiler()
+
+async def collect_checkout_name(update: Update, text: str, payload: CheckoutPayload) -> Optional[Dict]:
+    return {"user_name": text, "username": update.effective_user.username or "немає"}
+
+async def collect_checkout_phone(update: Update, text: str, payload: CheckoutPayload) -> Optional[Dict]:
+    is_valid, formatted_phone = validate_phone(text.strip())
+    if not is_valid:
+        response = f"❌ Невірний номер телефону!\n\n"
+        response += "📱 Введіть ваш номер телефону ще раз:\n"
+        response += "Приклад: +380932599103 або 0932599103"
+        await update.message.reply_text(response, parse_mode='HTML')
+        return None
+    return {"phone": formatted_phone}
+
+async def collect_checkout_city(update: Update, text: str, payload: CheckoutPayload) -> Optional[Dict]:
+    return {"city": text}
+
+async def collect_checkout_np(update: Update, text: str, payload: CheckoutPayload) -> Optional[Dict]:
+    user_id = update.effective_user.id
+    cart_items = Database.get_cart_items(user_id)
+    total = sum(item["product"]["price"] * item["quantity"] for item in cart_items)
+    
+    if len(cart_items) >= 3:
+        total = total * 0.95
+    
+    order_items = []
+    for item in cart_items:
+        order_items.append({
+            "product_name": item["product"]["name"],
+            "quantity": item["quantity"],
+            "price": item["product"]["price"]
+        })
+    
+    return {
+        "np_department": text,
+        "total": total,
+        "order_type": "повне замовлення",
+        "user_id": user_id,
+        "items": order_items
+    }
+
+async def prompt_checkout_phone(update: Update, payload: CheckoutPayload):
+    response = "📱 Введіть ваш номер телефону:\n\n"
+    response += "Приклад: +380932599103 або 0932599103"
+    await update.message.reply_text(response, parse_mode='HTML')
+
+async def prompt_checkout_city(update: Update, payload: CheckoutPayload):
+    response = "🏙️ Введіть місто доставки:\n\n"
+    response += "Наприклад: Київ, Львів, Одеса"
+    await update.message.reply_text(response, parse_mode='HTML')
+
+async def prompt_checkout_np(update: Update, payload: CheckoutPayload):
+    response = "🏣 Введіть номер відділення Нової Пошти:\n\n"
+    response += "Наприклад: Відділення №25, Поштомат №12345"
+    await update.message.reply_text(response, parse_mode='HTML')
+
+async def prompt_checkout_confirm(update: Update, payload: CheckoutPayload):
+    items = payload.items or []
+    
+    response = "✅ Дані отримано! Перевірте інформацію:\n\n"
+    response += f"👤 ПІБ: {payload.user_name or ''}\n"
+    response += f"📱 Телефон: {payload.phone or ''}\n"
+    response += f"🏙️ Місто: {payload.city or ''}\n"
+    response += f"🏣 Відділення Нової Пошти: {payload.np_department or ''}\n"
+    response += f"🛒 Товарів у кошику: {len(items)}\n"
+    
+    if len(items) >= 3:
+        original_total = sum(item["price"] * item["quantity"] for item in items)
+        discount = original_total * 0.05
+        response += f"🎁 Знижка 5% за 3+ банок: -{discount:.2f} грн\n"
+    
+    response += f"💰 Загальна сума: {payload.total or 0:.2f} грн\n\n"
+    response += "Підтвердити замовлення?"
+    
+    await update.message.reply_text(response, reply_markup=get_order_confirmation_keyboard(), parse_mode='HTML')
+
+CHECKOUT_STEPS = {
+    step.state: step for step in (
+        CheckoutStep("full_order_name", "full_order_phone", collect_checkout_name, prompt_checkout_phone),
+        CheckoutStep("full_order_phone", "full_order_city", collect_checkout_phone, prompt_checkout_city),
+        CheckoutStep("full_order_city", "full_order_np", collect_checkout_city, prompt_checkout_np),
+        CheckoutStep("full_order_np", "full_order_confirm", collect_checkout_np, prompt_checkout_confirm),
+    )
+}
+
+async def handle_checkout_step(update: Update, state: str, temp_data: Dict, text: str) -> bool:
+    """Виконує крок оформлення для стану; False якщо для стану немає кроку"""
+    step = CHECKOUT_STEPS.get(state)
+    if not step:
+        return False
+    
+    started = time.perf_counter()
+    try:
+        payload = CheckoutPayload(**temp_data)
+        patch = await step.collect(update, text, payload)
+        if patch is None:
+            # Невалідне введення - лишаємось у поточному стані
+            return True
+        
+        # У сесію пишуться лише нові поля кроку
+        if not Database.transition(update.effective_user.id, state, step.next_state, patch):
+            return True
+        
+        payload.apply(patch)
+        await step.on_enter(update, payload)
+        return True
+    finally:
+        checkout_profiler.record(state, time.perf_counter() - started)
+
+async def on_shutdown(application: Application):
+    """Звільняє ресурси та друкує профіль кроків оформлення при зупинці бота"""
+    for task in (retention_task, leader_task):
+        if task is not None:
+            task.cancel()
+    await close_http_client(application)
+    if checkout_profiler.timings:
+        logger.info(f"⏱️ Профіль оформлення замовлень: {checkout_profiler.stats()}")
+
+# Ключі temp_data, які читають стани message_handler (решту сесії не вибираємо)
+MESSAGE_SESSION_KEYS = ("product_id", "order_id", "product_name", "user_name", "phone", "city")
+
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
@@ -1957,7 +3439,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         logger.info(f"👤 [{datetime.now().strftime('%H:%M:%S')}] {user.first_name or 'Користувач'}: {text[:50]}...")
         
-        Database.save_user(user_id, user.first_name, user.last_name or "", user.username or "")
+        remember_user(user)
         
         # Спочатку перевіряємо чи це не команда для адміна
         if text.startswith('/'):
@@ -1971,28 +3453,27 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Звичайна обробка повідомлень
         if text == "/start" or text == "/cancel" or text.lower() == "скасувати":
-            Database.clear_user_session(user_id)
+            Database.reset_user_session(user_id)
             welcome = get_welcome_text()
             await update.message.reply_text(welcome, reply_markup=get_main_menu(), parse_mode='HTML')
-            Database.save_user_session(user_id, last_section="main_menu")
             return
         
         if text == "/help":
             await update.message.reply_text("ℹ️ Допомога: оберіть опцію з меню", reply_markup=get_main_menu())
             return
         
-        session = Database.get_user_session(user_id)
+        session = Database.get_user_session(user_id, keys=MESSAGE_SESSION_KEYS)
         state = session["state"]
         temp_data = session["temp_data"]
         
         if state == "waiting_quantity":
             product_id = temp_data.get("product_id")
-            refresh_products()
+            ensure_products_fresh()
             product = next((p for p in PRODUCTS if p["id"] == product_id), None)
             
             if not product:
+                Database.reset_user_session(user_id)
                 await update.message.reply_text("❌ Помилка: продукт не знайдено", reply_markup=get_main_menu())
-                Database.clear_user_session(user_id)
                 return
             
             success, quantity, error_msg = parse_quantity(text)
@@ -2006,8 +3487,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(response, parse_mode='HTML')
                 return
             
+            # Повторна доставка того ж повідомлення не додасть товар удруге
+            if not Database.transition(user_id, "waiting_quantity", "", last_section="products", replace=True):
+                return
+            
             Database.add_to_cart(user_id, product_id, quantity)
-            Database.clear_user_session(user_id)
             
             total_price = product["price"] * quantity
             response = f"✅ {product['name']} додано до кошика!\n\n"
@@ -2023,10 +3507,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             products_text = "📦 Наші продукти\n\nОберіть продукт для детальної інформації:"
             await update.message.reply_text(products_text, reply_markup=get_products_menu(), parse_mode='HTML')
-            Database.save_user_session(user_id, last_section="products")
             return
         
         elif state == "waiting_message":
+            if not Database.transition(user_id, "waiting_message", "", last_section="main_menu", replace=True):
+                return
+            
             user_name = f"{user.first_name or ''} {user.last_name or ''}"
             username = user.username or 'немає'
             
@@ -2058,11 +3544,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response += "Дякуємо за звернення!"
             
             await update.message.reply_text(response, reply_markup=get_main_menu(), parse_mode='HTML')
-            Database.clear_user_session(user_id)
-            Database.save_user_session(user_id, last_section="main_menu")
             return
         
         elif state == "waiting_message_for_quick_order":
+            if not Database.transition(user_id, "waiting_message_for_quick_order", "", last_section="main_menu", replace=True):
+                return
+            
             order_id = temp_data.get("order_id")
             product_name = temp_data.get("product_name")
             user_name = f"{user.first_name or ''} {user.last_name or ''}"
@@ -2115,100 +3602,21 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response += "Дякуємо за замовлення!"
             
             await update.message.reply_text(response, reply_markup=get_main_menu(), parse_mode='HTML')
-            Database.clear_user_session(user_id)
-            Database.save_user_session(user_id, last_section="main_menu")
             return
         
         elif state.startswith("full_order_"):
-            if state == "full_order_name":
-                temp_data["user_name"] = text
-                temp_data["username"] = user.username or "немає"
-                Database.save_user_session(user_id, "full_order_phone", temp_data)
-                
-                response = "📱 Введіть ваш номер телефону:\n\n"
-                response += "Приклад: +380932599103 або 0932599103"
-                await update.message.reply_text(response, parse_mode='HTML')
-                return
-            
-            elif state == "full_order_phone":
-                phone = text.strip()
-                is_valid, formatted_phone = validate_phone(phone)
-                
-                if not is_valid:
-                    response = f"❌ Невірний номер телефону!\n\n"
-                    response += "📱 Введіть ваш номер телефону ще раз:\n"
-                    response += "Приклад: +380932599103 або 0932599103"
-                    await update.message.reply_text(response, parse_mode='HTML')
-                    return
-                
-                temp_data["phone"] = formatted_phone
-                Database.save_user_session(user_id, "full_order_city", temp_data)
-                
-                response = "🏙️ Введіть місто доставки:\n\n"
-                response += "Наприклад: Київ, Львів, Одеса"
-                await update.message.reply_text(response, parse_mode='HTML')
-                return
-            
-            elif state == "full_order_city":
-                temp_data["city"] = text
-                Database.save_user_session(user_id, "full_order_np", temp_data)
-                
-                response = "🏣 Введіть номер відділення Нової Пошти:\n\n"
-                response += "Наприклад: Відділення №25, Поштомат №12345"
-                await update.message.reply_text(response, parse_mode='HTML')
-                return
-            
-            elif state == "full_order_np":
-                temp_data["np_department"] = text
-                
-                cart_items = Database.get_cart_items(user_id)
-                total = sum(item["product"]["price"] * item["quantity"] for item in cart_items)
-                
-                if len(cart_items) >= 3:
-                    total = total * 0.95
-                
-                temp_data["total"] = total
-                temp_data["order_type"] = "повне замовлення"
-                temp_data["user_id"] = user_id
-                
-                order_items = []
-                for item in cart_items:
-                    order_items.append({
-                        "product_name": item["product"]["name"],
-                        "quantity": item["quantity"],
-                        "price": item["product"]["price"]
-                    })
-                
-                temp_data["items"] = order_items
-                Database.save_user_session(user_id, "full_order_confirm", temp_data)
-                
-                response = "✅ Дані отримано! Перевірте інформацію:\n\n"
-                response += f"👤 ПІБ: {temp_data.get('user_name', '')}\n"
-                response += f"📱 Телефон: {temp_data.get('phone', '')}\n"
-                response += f"🏙️ Місто: {temp_data.get('city', '')}\n"
-                response += f"🏣 Відділення Нової Пошти: {text}\n"
-                response += f"🛒 Товарів у кошику: {len(cart_items)}\n"
-                
-                if len(cart_items) >= 3:
-                    original_total = sum(item["product"]["price"] * item["quantity"] for item in cart_items)
-                    discount = original_total * 0.05
-                    response += f"🎁 Знижка 5% за 3+ банок: -{discount:.2f} грн\n"
-                
-                response += f"💰 Загальна сума: {total:.2f} грн\n\n"
-                response += "Підтвердити замовлення?"
-                
-                await update.message.reply_text(response, reply_markup=get_order_confirmation_keyboard(), parse_mode='HTML')
-                return
+            await handle_checkout_step(update, state, temp_data, text)
+            return
         
         elif state == "waiting_phone_for_quick_order":
             phone = text.strip()
             product_id = temp_data.get("product_id")
             
-            refresh_products()
+            ensure_products_fresh()
             product = next((p for p in PRODUCTS if p["id"] == product_id), None)
             if not product:
+                Database.reset_user_session(user_id)
                 await update.message.reply_text("❌ Помилка: продукт не знайдено", reply_markup=get_main_menu())
-                Database.clear_user_session(user_id)
                 return
             
             is_valid, formatted_phone = validate_phone(phone)
@@ -2220,6 +3628,9 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(response, parse_mode='HTML')
                 return
             
+            if not Database.transition(user_id, "waiting_phone_for_quick_order", "", last_section="main_menu", replace=True):
+                return
+            
             user_name = f"{user.first_name or ''} {user.last_name or ''}"
             username = user.username or 'немає'
             
@@ -2263,8 +3674,6 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info(f"📱 Username: {username}")
             logger.info(f"{'='*80}\n")
             
-            Database.clear_user_session(user_id)
-            
             response = f"✅ Швидке замовлення прийнято!\n\n"
             response += f"🆔 Номер замовлення: #{order_id}\n"
             response += f"📦 Продукт: {product['name']}\n"
@@ -2273,7 +3682,6 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response += "Дякуємо за замовлення!"
             
             await update.message.reply_text(response, reply_markup=get_main_menu(), parse_mode='HTML')
-            Database.save_user_session(user_id, last_section="main_menu")
             return
         
         else:
@@ -2299,7 +3707,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response += "Дякуємо за звернення!"
             
             await update.message.reply_text(response, reply_markup=get_main_menu(), parse_mode='HTML')
-            Database.save_user_session(user_id, last_section="main_menu")
+            Database.reset_user_session(user_id)
             
     except Exception as e:
         logger.error(f"❌ Помилка в message_handler: {e}")
@@ -2309,7 +3717,7 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"⚠️ Помилка під час обробки оновлення {update}: {context.error}")
         
         if 'Conflict' in str(context.error):
-            logger.warning("🔄 Виявлено конфлікт - можливо запущено дублюючий бот")
+            logger.warning("🔄 Виявлено конфлікт - getUpdates викликає екземпляр поза вибором лідера")
             return
         
         if update and update.effective_chat:
@@ -2324,70 +3732,448 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"❌ Помилка в обробнику помилок: {e}")
 
-def main():
+# ========== ОЧИЩЕННЯ ЗАСТАРІЛИХ ДАНИХ ==========
+
+# Сесія без активності довше за цей час видаляється
+SESSION_TTL_HOURS = int(os.getenv("SESSION_TTL_HOURS", "72"))
+# Кошик, у який нічого не додавали довше за цей час, вважається покинутим
+CART_TTL_DAYS = int(os.getenv("CART_TTL_DAYS", "30"))
+# Покинуті кошики переносяться в abandoned_carts замість простого видалення
+ARCHIVE_ABANDONED_CARTS = os.getenv("ARCHIVE_ABANDONED_CARTS", "1") == "1"
+RETENTION_SWEEP_INTERVAL = int(os.getenv("RETENTION_SWEEP_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = 500
+# Файли зображень, молодші за цей час, не видаляються, навіть якщо їх немає в product_images
+BLOB_PRUNE_MIN_AGE = 3600
+
+retention_task: Optional[asyncio.Task] = None
+
+def sweep_stale_sessions(cursor, conn, cutoff: datetime) -> int:
+    """Видаляє неактивні сесії пакетами по первинному ключу"""
+    removed = 0
+    last_user_id = 0
+    while True:
+        cursor.execute('''
+            WITH batch AS (
+                SELECT user_id FROM user_sessions
+                WHERE updated_at < %(cutoff)s
+                  AND user_id > %(after)s
+                ORDER BY user_id
+                LIMIT %(limit)s
+            )
+            DELETE FROM user_sessions s
+            USING batch
+            WHERE s.user_id = batch.user_id AND s.updated_at < %(cutoff)s
+            RETURNING s.user_id
+        ''', {"cutoff": cutoff, "after": last_user_id, "limit": RETENTION_BATCH_SIZE})
+        rows = cursor.fetchall()
+        conn.commit()
+        if not rows:
+            return removed
+        removed += len(rows)
+        last_user_id = max(row['user_id'] for row in rows)
+
+def sweep_abandoned_carts(cursor, conn, cutoff: datetime) -> Tuple[int, int]:
+    """Видаляє (або архівує) кошики без змін з cutoff; повертає (кошиків, позицій)"""
+    carts_removed = 0
+    items_removed = 0
+    last_user_id = 0
+    while True:
+        # Кошик прибирається цілком, лише якщо жодна позиція не новіша за cutoff
+        cursor.execute('''
+            WITH stale AS (
+                SELECT user_id FROM carts
+                WHERE user_id > %(after)s
+                GROUP BY user_id
+                HAVING MAX(added_at) < %(cutoff)s
+                ORDER BY user_id
+                LIMIT %(limit)s
+            ),
+            removed AS (
+                DELETE FROM carts c
+                USING stale
+                WHERE c.user_id = stale.user_id
+                RETURNING c.user_id, c.product_id, c.quantity, c.added_at
+            ),
+            archived AS (
+                INSERT INTO abandoned_carts (user_id, product_id, quantity, added_at)
+                SELECT user_id, product_id, quantity, added_at FROM removed
+                WHERE %(archive)s
+            )
+            SELECT (SELECT MAX(user_id) FROM stale) AS last_user_id,
+                   (SELECT COUNT(*) FROM stale) AS carts,
+                   (SELECT COUNT(*) FROM removed) AS items
+        ''', {"cutoff": cutoff, "after": last_user_id, "limit": RETENTION_BATCH_SIZE, "archive": ARCHIVE_ABANDONED_CARTS})
+        row = cursor.fetchone()
+        conn.commit()
+        if not row['carts']:
+            return carts_removed, items_removed
+        carts_removed += row['carts']
+        items_removed += row['items']
+        last_user_id = row['last_user_id']
+
+def sweep_checkout_requests(cursor, conn, cutoff: datetime) -> int:
+    """Видаляє ключі оформлення, старші за будь-яку живу сесію"""
+    removed = 0
+    while True:
+        cursor.execute('''
+            DELETE FROM checkout_requests
+            WHERE idempotency_key IN (
+                SELECT idempotency_key FROM checkout_requests
+                WHERE created_at < %s
+                ORDER BY created_at
+                LIMIT %s
+            )
+        ''', (cutoff, RETENTION_BATCH_SIZE))
+        deleted = cursor.rowcount
+        conn.commit()
+        removed += deleted
+        if deleted < RETENTION_BATCH_SIZE:
+            return removed
+
+def sweep_orphan_product_images(cursor, conn) -> int:
+    """Видаляє фото з product_images, на які вже не посилається жоден товар (після заміни фото)"""
+    cursor.execute('''
+        DELETE FROM product_images pi
+        WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.image_hash = pi.hash)
+    ''')
+    conn.commit()
+    return cursor.rowcount
+
+def sweep_orphan_blob_files() -> int:
+    """Видаляє зі спільного тому файли зображень, яких більше немає в product_images"""
+    image_hashes = Database.get_image_hashes()
+    if image_hashes is None:
+        return 0
+    return blob_store.prune(image_hashes, BLOB_PRUNE_MIN_AGE)
+
+def run_retention_sweep() -> Dict[str, int]:
+    """Один прохід очищення застарілих сесій, кошиків, ключів оформлення та невикористаних фото"""
+    conn = Database.get_connection()
+    if not conn:
+        return {}
+    
     try:
-        if not check_single_instance():
-            logger.error("🚫 Бот вже запущено в іншому процесі! Завершуємо...")
-            sys.exit(1)
+        cursor = conn.cursor()
+        now = datetime.now()
+        session_cutoff = now - timedelta(hours=SESSION_TTL_HOURS)
+        carts, cart_items = sweep_abandoned_carts(cursor, conn, now - timedelta(days=CART_TTL_DAYS))
+        return {
+            "sessions": sweep_stale_sessions(cursor, conn, session_cutoff),
+            "carts": carts,
+            "cart_items": cart_items,
+            "checkout_requests": sweep_checkout_requests(cursor, conn, session_cutoff),
+            "product_images": sweep_orphan_product_images(cursor, conn),
+            "image_files": sweep_orphan_blob_files(),
+        }
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"❌ Помилка очищення застарілих даних: {e}")
+        return {}
+    finally:
+        conn.close()
+
+async def retention_sweeper():
+    """Періодично прибирає застарілі дані, не блокуючи цикл подій"""
+    while True:
+        await asyncio.to_thread(maintain_partitions)
+        started = time.perf_counter()
+        removed = await asyncio.to_thread(run_retention_sweep)
+        if any(removed.values()):
+            action = "архівовано" if ARCHIVE_ABANDONED_CARTS else "видалено"
+            logger.info(
+                f"🧹 Очищення за {time.perf_counter() - started:.1f} с: "
+                f"сесій {removed['sessions']}, кошиків {removed['carts']} ({removed['cart_items']} позицій, {action}), "
+                f"ключів оформлення {removed['checkout_requests']}, невикористаних фото {removed['product_images']} ({removed['image_files']} файлів)"
+            )
+        await asyncio.sleep(RETENTION_SWEEP_INTERVAL)
+
+async def on_startup(application: Application):
+    """Запускає фонові задачі після ініціалізації бота"""
+    global retention_task, leader_task
+    retention_task = asyncio.create_task(retention_sweeper())
+    leader_task = asyncio.create_task(leader_watchdog(application))
+
+# ========== ВИБІР ЛІДЕРА ==========
+
+# Polling і фонові задачі виконує лише репліка, що тримає advisory-блокування в Postgres.
+# Решта ініціалізують БД і кеші та чекають у резерві. Блокування звільняється разом
+# зі з'єднанням, тож при падінні лідера резервна репліка підхоплює роботу за LEADER_RETRY_INTERVAL
+LEADER_LOCK_ID = int(os.getenv("LEADER_LOCK_ID", "7310001"))
+LEADER_RETRY_INTERVAL = int(os.getenv("LEADER_RETRY_INTERVAL", "5"))
+
+class LeaderElector:
+    """Лідерство через pg_try_advisory_lock на окремому з'єднанні"""
+    
+    def __init__(self, lock_id: int, retry_interval: int = LEADER_RETRY_INTERVAL):
+        self.lock_id = lock_id
+        self.retry_interval = retry_interval
+        self.conn = None
+        self.is_leader = False
+        self.lost = False
+    
+    def _close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
+        self.is_leader = False
+    
+    def try_acquire(self) -> bool:
+        """Одна спроба захопити блокування"""
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(DATABASE_URL, keepalives=1, keepalives_idle=10, keepalives_interval=5, keepalives_count=3)
+                self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                # Блокування тримає серверний процес: без цих налаштувань Postgres помітить зниклого
+                # лідера лише через системний TCP keepalive (близько двох годин)
+                self.conn.cursor().execute("SET tcp_keepalives_idle = 10; SET tcp_keepalives_interval = 5; SET tcp_keepalives_count = 3")
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_id,))
+            self.is_leader = cursor.fetchone()[0]
+        except Exception as e:
+            logger.warning(f"⚠️ Помилка захоплення лідерства: {e}")
+            self._close()
+        return self.is_leader
+    
+    def wait_for_leadership(self):
+        """Блокує, поки цей екземпляр не стане лідером"""
+        self.lost = False
+        waiting = False
+        while not self.try_acquire():
+            if not waiting:
+                logger.info("⏳ Лідер уже працює, екземпляр чекає в резерві")
+                waiting = True
+            time.sleep(self.retry_interval)
+        logger.info("👑 Екземпляр став лідером")
+    
+    def check(self) -> bool:
+        """Перевіряє, що блокування досі наше; після обриву з'єднання пробує захопити знову"""
+        if self.is_leader and self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.cursor().execute("SELECT 1")
+                return True
+            except Exception as e:
+                logger.warning(f"⚠️ З'єднання лідера обірвалось: {e}")
+                self._close()
+        self.lost = not self.try_acquire()
+        return not self.lost
+    
+    def release(self):
+        if self.is_leader and self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (self.lock_id,))
+                logger.info("👋 Лідерство звільнено")
+            except Exception as e:
+                logger.warning(f"⚠️ Помилка звільнення лідерства: {e}")
+        self._close()
+
+leader = LeaderElector(LEADER_LOCK_ID)
+leader_task: Optional[asyncio.Task] = None
+
+async def leader_watchdog(application: Application):
+    """Зупиняє polling, якщо лідерство перейшло до іншої репліки"""
+    while True:
+        await asyncio.sleep(leader.retry_interval)
+        if not await asyncio.to_thread(leader.check):
+            logger.error("❌ Лідерство втрачено - зупиняємо polling")
+            application.stop_running()
+            return
+
+# ========== ПАРАЛЕЛЬНА ОБРОБКА ОНОВЛЕНЬ ==========
+
+# Скільки оновлень обробляється одночасно (для різних користувачів)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+# Скільки оновлень може чекати в черзі, перш ніж бот перестане їх забирати
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "512"))
+UPDATE_QUEUE_WARN_STEP = 50
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Оновлення різних користувачів обробляються паралельно, одного користувача - по черзі.
+    
+    Семафор базового класу обмежує лише кількість оновлень у черзі. Справжній ліміт
+    паралельності береться вже після блокування користувача, щоб оновлення, які чекають
+    своєї черги, не займали слоти інших користувачів.
+    """
+    
+    def __init__(self, concurrency: int, queue_limit: int):
+        super().__init__(max(queue_limit, concurrency, 2))
+        self.concurrency = asyncio.BoundedSemaphore(concurrency)
+        self.user_locks: Dict[int, asyncio.Lock] = {}
+        self.lock_refs: Dict[int, int] = {}
+        self.pending = 0
+        self.active = 0
+    
+    @staticmethod
+    def get_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self.get_key(update)
+        if key is None:
+            async with self.concurrency:
+                await coroutine
+            return
         
-        time.sleep(2)
+        lock = self.user_locks.get(key)
+        if lock is None:
+            lock = self.user_locks[key] = asyncio.Lock()
+        self.lock_refs[key] = self.lock_refs.get(key, 0) + 1
+        self.pending += 1
+        if self.pending % UPDATE_QUEUE_WARN_STEP == 0:
+            logger.warning(f"⚠️ Оновлень у черзі: {self.pending}, в обробці: {self.active}")
         
-        if not init_database():
+        started = False
+        try:
+            async with lock:
+                async with self.concurrency:
+                    self.pending -= 1
+                    started = True
+                    self.active += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+        finally:
+            if not started:
+                # Скасовано ще в черзі
+                self.pending -= 1
+                if asyncio.iscoroutine(coroutine):
+                    coroutine.close()
+            # Блокування живе лише поки є оновлення цього користувача
+            self.lock_refs[key] -= 1
+            if self.lock_refs[key] == 0:
+                del self.lock_refs[key]
+                del self.user_locks[key]
+    
+    def stats(self) -> Dict[str, int]:
+        """Глибина черги, кількість активних оновлень та користувачів з блокуванням"""
+        return {"pending": self.pending, "active": self.active, "users": len(self.user_locks)}
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        if self.pending or self.active:
+            logger.info(f"🛑 Зупинка обробника оновлень: {self.stats()}")
+
+# ========== ЗАПУСК ==========
+
+class StartupTimer:
+    """Тривалість фаз запуску для звіту в лог"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.lock = threading.Lock()
+    
+    def run(self, name: str, func, *args):
+        """Виконує фазу і записує її тривалість"""
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.phases.append((name, time.perf_counter() - started))
+    
+    def report(self):
+        total = time.perf_counter() - self.started
+        details = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.phases)
+        logger.info(f"⏱️ Запуск за {total * 1000:.0f} мс: {details}")
+
+def warm_up(timer: StartupTimer):
+    """Паралельно прогріває кеші товарів, контенту та зображень"""
+    tasks = (
+        ("товари", ensure_products_fresh),
+        ("контент", lambda: content_store.load(CONTENT_NAMES)),
+        ("зображення", blob_store.open),
+    )
+    with ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="warm-up") as pool:
+        futures = [pool.submit(timer.run, name, func) for name, func in tasks]
+        for future in futures:
+            future.result()
+
+def build_application() -> Application:
+    """Створює застосунок з усіма обробниками"""
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_QUEUE_LIMIT))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    # Захист від флуду - до всіх інших обробників
+    application.add_handler(TypeHandler(Update, flood_control), group=-1)
+    
+    # Звичайні команди
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    
+    # Адмін-команди (тільки для адмінів)
+    application.add_handler(CommandHandler("setphoto", setphoto_command))
+    
+    # Обробники
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_admin_photo))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    
+    application.add_error_handler(error_handler)
+    return application
+
+def main():
+    try:
+        timer = StartupTimer()
+        if not timer.run("міграції", run_migrations):
             logger.error("❌ Не вдалося ініціалізувати базу даних")
-            return
+            # Ненульовий код, щоб платформа перезапустила процес (restartPolicy ON_FAILURE)
+            sys.exit(1)
         
-        refresh_products()
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        timer.run("прогрів", warm_up, timer)
+        timer.run("клавіатури", warm_markup_cache)
+        threading.Thread(target=listen_for_content_changes, name="content-listener", daemon=True).start()
         
-        stats = Database.get_statistics()
         logger.info("=" * 80)
         logger.info("🌱 БОТ КОМПАНІЇ 'БОНЕЛЕТ' ЗАПУЩЕНО")
         logger.info(f"🔑 Токен: {TOKEN[:10]}...")
-        logger.info("=" * 80)
-        logger.info("📊 Статистика:")
-        logger.info(f"• Користувачів: {stats.get('total_users', 0)}")
-        logger.info(f"• Замовлень: {stats.get('total_orders', 0)}")
-        logger.info(f"• Повідомлень: {stats.get('total_messages', 0)}")
-        logger.info(f"• Швидких замовлень: {stats.get('quick_orders', 0)}")
-        logger.info(f"• Активних кошиків: {stats.get('active_carts', 0)}")
         logger.info(f"• Продуктів у базі: {len(PRODUCTS)}")
-        logger.info(f"• Виручка: {stats.get('total_revenue', 0):.2f} грн")
         logger.info("=" * 80)
-        logger.info("🔄 Очікування повідомлень...\n")
-        
-        application = Application.builder().token(TOKEN).build()
-        
-        # Звичайні команди
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("cancel", cancel_command))
-        
-        # Адмін-команди (тільки для адмінів)
-        application.add_handler(CommandHandler("setphoto", setphoto_command))
-        
-        # Обробники
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(MessageHandler(filters.PHOTO, handle_admin_photo))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-        
-        application.add_error_handler(error_handler)
-        
-        logger.info("🚀 Запуск polling...")
-        application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES,
-            poll_interval=2.0,
-            timeout=30,
-            read_timeout=30,
-            connect_timeout=30,
-            pool_timeout=30,
-            close_loop=False
-        )
+        timer.report()
+        
+        while True:
+            leader.wait_for_leadership()
+            application = build_application()
+            logger.info("🚀 Запуск polling...")
+            application.run_polling(
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES,
+                poll_interval=2.0,
+                timeout=30,
+                read_timeout=30,
+                connect_timeout=30,
+                pool_timeout=30,
+                close_loop=False
+            )
+            if not leader.lost:
+                break
+            logger.warning("🔄 Екземпляр повертається в резерв")
+        leader.release()
         
     except Exception as e:
         logger.error(f"❌ КРИТИЧНА ПОМИЛКА: {e}")
         import traceback
         logger.error(traceback.format_exc())
         time.sleep(10)
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()